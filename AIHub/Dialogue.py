@@ -1,38 +1,327 @@
 import asyncio
-from typing import Callable
+import time
+from typing import Callable, AsyncIterator, Dict, Iterator, List
 from loguru import logger
 
 from .Endpoint import Endpoint
+from .EndpointPool import EndpointPool
+from .Metrics import Metrics, TOKEN_BUCKETS
+from .RateLimiter import estimate_tokens
+from .Tracing import Tracer, get_tracer
+
+SUMMARY_PROMPT = "请用简洁的语言总结以上对话的要点，保留后续对话可能需要的关键信息。"
+
+
+class _HistorySegment:
+    __slots__ = ("parent", "messages", "token_counts", "length", "total_tokens")
+
+    def __init__(self, parent: '_HistorySegment | None', messages: tuple, token_counts: tuple):
+        """对话历史中不可变的一段，通过parent指向更早的一段；多个分支的Dialogue共享同一条链，而不复制其中的消息"""
+        self.parent = parent
+        self.messages = messages
+        self.token_counts = token_counts
+        self.length = (parent.length if parent else 0) + len(messages)
+        self.total_tokens = (parent.total_tokens if parent else 0) + sum(token_counts)
+
+    def chain(self) -> List['_HistorySegment']:
+        """从最早的一段到当前段"""
+        segments = []
+        segment = self
+        while segment is not None:
+            segments.append(segment)
+            segment = segment.parent
+        segments.reverse()
+        return segments
 
 
 class Dialogue:
-    def __init__(self, endpoint: Endpoint = None, endpoint_config_path: str = None):
-        self.messages = []
+    TRIM_STRATEGIES = ("sliding_window", "keep_head", "summarize")
+
+    def __init__(self, endpoint: Endpoint | EndpointPool = None, endpoint_config_path: str = None,
+                 max_context_tokens: int = None, trim_strategy: str = "sliding_window",
+                 keep_head_turns: int = 1, keep_recent_turns: int = 2,
+                 token_counter: Callable[[Dict[str, str]], int] = estimate_tokens,
+                 metrics: Metrics = None, tracer: Tracer = None):
+        """
+        :param endpoint: 该Dialogue使用的Endpoint，也可以是EndpointPool
+        :param endpoint_config_path: 该Dialogue使用的Endpoint的配置文件路径
+        :param max_context_tokens: 每次发送的对话历史的token上限，为空时不限制
+        :param trim_strategy: 超出上限时的裁剪策略。sliding_window：丢弃最早的对话轮次；
+            keep_head：保留最开始的keep_head_turns轮，丢弃其后最早的轮次；
+            summarize：在后台通过同一个Endpoint将较早的轮次总结为一轮摘要，总结完成前按sliding_window发送
+        :param keep_head_turns: keep_head策略保留的开头轮数
+        :param keep_recent_turns: summarize策略中不参与总结的最近轮数
+        :param token_counter: 计算单条消息token数的函数，默认按字符数估算
+        :param metrics: 记录指标的Metrics，多个Dialogue可以共用同一个；为空时创建新的
+        :param tracer: 记录请求span的追踪器，为空时使用进程内共享的追踪器
+        """
+        # 对话历史 = 与其他分支共享的不可变部分_base + 本Dialogue独有的_messages
+        # 只有需要修改整个历史（裁剪、总结或通过messages属性访问）时才复制_base中的消息，即写时复制
+        self._base: _HistorySegment | None = None
+        self._messages = []
+        self._token_counts: List[int] = []
+        self.total_tokens = 0
+        # 对话历史被裁剪、总结或清空（而非追加）时递增，供持久化时判断能否只追加新消息
+        self.revision = 0
         if not endpoint_config_path and not endpoint:
             raise ValueError("Either endpoint or endpoint_path must be specified")
         if endpoint_config_path and not endpoint:
             endpoint = Endpoint.load_from_yaml(endpoint_config_path)
+        if trim_strategy not in self.TRIM_STRATEGIES:
+            raise ValueError(f"Unsupported trim strategy: {trim_strategy}")
         self.endpoint = endpoint
         self.lock = asyncio.Lock()
 
+        self.max_context_tokens = max_context_tokens
+        self.trim_strategy = trim_strategy
+        self.keep_head_turns = keep_head_turns
+        self.keep_recent_turns = keep_recent_turns
+        self.token_counter = token_counter
+        self.summary_task: asyncio.Task | None = None
+        self.callback_tasks = set()
+        self.metrics = metrics if metrics is not None else Metrics("aihub_dialogue")
+        self.tracer = tracer or get_tracer()
+
+    def _materialize(self):
+        # 复制共享部分的引用（不复制消息本身），之后可以原地修改整个历史
+        if self._base is not None:
+            segments = self._base.chain()
+            self._messages = [message for segment in segments for message in segment.messages] + self._messages
+            self._token_counts = [count for segment in segments for count in segment.token_counts] + \
+                self._token_counts
+            self._base = None
+
+    @property
+    def messages(self) -> List[Dict[str, str]]:
+        """可修改的完整对话历史。分支共享历史时，第一次访问会为本Dialogue复制一份"""
+        self._materialize()
+        return self._messages
+
+    @messages.setter
+    def messages(self, messages: List[Dict[str, str]]):
+        self._base = None
+        self._messages = messages
+        self._token_counts = [self.token_counter(message) for message in messages]
+        self.total_tokens = sum(self._token_counts)
+
+    @property
+    def token_counts(self) -> List[int]:
+        self._materialize()
+        return self._token_counts
+
+    @property
+    def message_count(self) -> int:
+        return (self._base.length if self._base else 0) + len(self._messages)
+
+    def iter_messages(self, start: int = 0) -> Iterator[Dict[str, str]]:
+        """按顺序遍历从第start条开始的对话历史，不会复制共享部分"""
+        base_length = self._base.length if self._base else 0
+        if start < base_length:
+            position = 0
+            for segment in self._base.chain():
+                if position + len(segment.messages) > start:
+                    yield from segment.messages[max(start - position, 0):]
+                position += len(segment.messages)
+        yield from self._messages[max(start - base_length, 0):]
+
     def get_messages(self):
         return self.messages
 
     def clear_messages(self):
-        self.messages = []
+        self._base = None
+        self._messages = []
+        self._token_counts = []
+        self.total_tokens = 0
+        self.revision += 1
 
-    async def send_message(self, message: str, **kwargs) -> str:
+    def fork(self, **kwargs) -> 'Dialogue':
+        """
+        从当前的对话历史创建一个分支，两者之后的对话互不影响
+        历史以不可变的分段共享，创建分支不复制消息，各分支拥有各自的锁，可以并发进行对话
+        正在进行中的一轮对话（已发送、尚未收到回复）的消息也会包含在分支中
+        :param kwargs: 覆盖分支的构造参数，例如使用另一个endpoint进行对比；默认与当前Dialogue相同，并共用同一个Metrics
+        """
+        self._sync_token_counts()
+        if self._messages:
+            # 将独有部分冻结为新的一段，此后由两个Dialogue共享
+            self._base = _HistorySegment(self._base, tuple(self._messages), tuple(self._token_counts))
+            self._messages = []
+            self._token_counts = []
+        options = {
+            "endpoint": self.endpoint,
+            "max_context_tokens": self.max_context_tokens,
+            "trim_strategy": self.trim_strategy,
+            "keep_head_turns": self.keep_head_turns,
+            "keep_recent_turns": self.keep_recent_turns,
+            "token_counter": self.token_counter,
+            "metrics": self.metrics,
+            "tracer": self.tracer,
+        }
+        dialogue = Dialogue(**{**options, **kwargs})
+        dialogue._base = self._base
+        dialogue.total_tokens = self.total_tokens
+        dialogue.revision = self.revision
+        return dialogue
+
+    def _sync_token_counts(self):
+        # messages可能被外部直接修改，此时重新计算独有部分的token数；共享部分不可变，其token数不会变化
+        if len(self._token_counts) != len(self._messages):
+            self._token_counts = [self.token_counter(message) for message in self._messages]
+            self.total_tokens = (self._base.total_tokens if self._base else 0) + sum(self._token_counts)
+
+    def _append(self, message: Dict[str, str]):
+        self._sync_token_counts()
+        count = self.token_counter(message)
+        self._messages.append(message)
+        self._token_counts.append(count)
+        self.total_tokens += count
+
+    def _context(self) -> List[Dict[str, str]]:
+        # 未分支时直接使用历史列表本身；分支时拼接共享部分与独有部分，只复制消息的引用
+        if self._base is None:
+            return self._messages
+        return [message for segment in self._base.chain() for message in segment.messages] + self._messages
+
+    def _turn_starts(self) -> List[int]:
+        # 一轮对话以user消息开始；按轮裁剪可以保证user与assistant交替出现
+        return [i for i, message in enumerate(self.messages) if message["role"] == "user"] or [0]
+
+    def _overflow_range(self, head_turns: int) -> tuple:
+        """
+        保留开头head_turns轮，从其后最早的轮次开始整轮丢弃，直到不超过上限
+        返回需要丢弃的消息区间[start, end)；最后一轮（当前的user消息）永远不会被丢弃
+        """
+        starts = self._turn_starts()
+        start = end = starts[head_turns] if head_turns < len(starts) else len(self.messages)
+        total = self.total_tokens
+        for turn in range(head_turns, len(starts) - 1):
+            if total <= self.max_context_tokens:
+                break
+            end = starts[turn + 1]
+            total -= sum(self.token_counts[starts[turn]:end])
+        return start, end
+
+    def _delete(self, start: int, end: int):
+        self.revision += 1
+        self.total_tokens -= sum(self.token_counts[start:end])
+        del self.messages[start:end]
+        del self.token_counts[start:end]
+
+    def _prepare_context(self) -> List[Dict[str, str]]:
+        """返回本次需要发送的对话历史，必要时按裁剪策略裁剪"""
+        self._sync_token_counts()
+        self.metrics.inc("turns")
+        if self.max_context_tokens is None or self.total_tokens <= self.max_context_tokens:
+            self.metrics.observe("context_tokens", self.total_tokens, TOKEN_BUCKETS)
+            return self._context()
+
+        if self.trim_strategy == "summarize":
+            # 摘要在后台生成，生成前按滑动窗口发送，不修改对话历史
+            start, end = self._overflow_range(0)
+            self.metrics.observe("context_tokens", self.total_tokens - sum(self.token_counts[start:end]),
+                                 TOKEN_BUCKETS)
+            return self.messages[:start] + self.messages[end:]
+
+        start, end = self._overflow_range(self.keep_head_turns if self.trim_strategy == "keep_head" else 0)
+        if end > start:
+            self._delete(start, end)
+            self.metrics.inc("trimmed_messages", end - start)
+            logger.debug(f"Dialogue trimmed {end - start} messages to fit {self.max_context_tokens} tokens")
+        self.metrics.observe("context_tokens", self.total_tokens, TOKEN_BUCKETS)
+        return self.messages
+
+    def _maybe_summarize(self):
+        if self.trim_strategy != "summarize" or self.max_context_tokens is None:
+            return
+        if self.total_tokens <= self.max_context_tokens:
+            return
+        if self.summary_task is not None and not self.summary_task.done():
+            return
+        starts = self._turn_starts()
+        if len(starts) <= self.keep_recent_turns:
+            return
+        end = starts[-self.keep_recent_turns] if self.keep_recent_turns else len(self.messages)
+        # 较早的部分只剩上一次的摘要时无需再次总结，最近的轮次由滑动窗口裁剪
+        if end <= 2 and self.messages[0]["content"] == SUMMARY_PROMPT:
+            return
+        self.summary_task = asyncio.create_task(self._summarize(self.messages[:end]))
+
+    async def _summarize(self, older: List[Dict[str, str]]):
+        try:
+            summary = await self.endpoint.send_message([*older, {"role": "user", "content": SUMMARY_PROMPT}],
+                                                       priority=Endpoint.PRIORITY_BATCH)
+        except Exception as e:
+            self.metrics.inc("summary_failures")
+            logger.warning(f"Failed to summarize dialogue: {e}")
+            return
         async with self.lock:
-            self.messages.append({"role": "user", "content": message})
-            logger.debug(f"Sending message {message} to endpoint {self.endpoint.name}")
-            response = await self.endpoint.send_message(self.messages, **kwargs)
-            logger.debug(f"Received response {response} from endpoint {self.endpoint.name}")
-            self.messages.append({"role": "assistant", "content": response})
-            return response
+            # 总结期间对话历史可能已被清空或修改，此时放弃本次摘要
+            if self.messages[:len(older)] != older:
+                return
+            self._delete(0, len(older))
+            self.messages[0:0] = [{"role": "user", "content": SUMMARY_PROMPT},
+                                  {"role": "assistant", "content": summary}]
+            self.token_counts[0:0] = [self.token_counter(message) for message in self.messages[:2]]
+            self.total_tokens += sum(self.token_counts[:2])
+            self.metrics.inc("summaries")
+            logger.debug(f"Dialogue summarized {len(older)} messages")
+
+    async def send_message(self, message: str, **kwargs) -> str:
+        kwargs.setdefault("priority", Endpoint.PRIORITY_INTERACTIVE)
+        with self.tracer.start_span("dialogue.send", kwargs.pop("trace_span", None),
+                                    endpoint=self.endpoint.name, message=message) as span:
+            async with self.lock:
+                self._append({"role": "user", "content": message})
+                context = self._prepare_context()
+                span.set(context_messages=len(context))
+                start = time.monotonic()
+                response = await self.endpoint.send_message(context, trace_span=span, **kwargs)
+                self.metrics.observe("latency_seconds", time.monotonic() - start, mode="send")
+                span.set(response=response)
+                self._append({"role": "assistant", "content": response})
+                self._maybe_summarize()
+                return response
+
+    async def stream_message(self, message: str, **kwargs) -> AsyncIterator[str]:
+        kwargs.setdefault("priority", Endpoint.PRIORITY_INTERACTIVE)
+        span = self.tracer.start_span("dialogue.stream", kwargs.pop("trace_span", None),
+                                      endpoint=self.endpoint.name, message=message)
+        chunks = []
+        error = None
+        try:
+            async with self.lock:
+                self._append({"role": "user", "content": message})
+                context = self._prepare_context()
+                span.set(context_messages=len(context))
+                start = time.monotonic()
+                async for chunk in self.endpoint.stream_message(context, **{**kwargs, "only_text": True,
+                                                                            "trace_span": span}):
+                    chunks.append(chunk)
+                    yield chunk
+                self.metrics.observe("latency_seconds", time.monotonic() - start, mode="stream")
+                response = "".join(chunks)
+                self._append({"role": "assistant", "content": response})
+                self._maybe_summarize()
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            span.end(error, response=lambda: "".join(chunks))
 
     def send_message_with_callback(self, message: str, callback: Callable[[str], None], **kwargs) -> None:
+        """在后台发送消息，收到回复后调用callback。没有正在运行的事件循环时（例如在同步代码中）使用进程内共享的后台事件循环，callback在该线程中调用"""
         async def async_send_message():
             response = await self.send_message(message, **kwargs)
             callback(response)
 
-        asyncio.create_task(async_send_message())
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            from .Sync import get_background_loop
+
+            get_background_loop().submit(async_send_message())
+            return
+        task = asyncio.create_task(async_send_message())
+        # 保留任务的引用，避免任务在完成前被垃圾回收
+        self.callback_tasks.add(task)
+        task.add_done_callback(self.callback_tasks.discard)
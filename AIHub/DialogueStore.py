@@ -0,0 +1,309 @@
+import asyncio
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Dict, Iterable, List
+
+from loguru import logger
+
+from .Dialogue import Dialogue
+from .Endpoint import Endpoint
+from .EndpointPool import EndpointPool
+from .Metrics import Metrics
+from .SingleFlight import SingleFlight
+
+
+class SessionStorage:
+    def __init__(self, path: str):
+        """
+        基于SQLite的会话存储。消息按会话追加写入，只有对话历史被裁剪或清空时才整体重写该会话
+        所有读写都在线程池中执行，不会阻塞事件循环
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS messages ("
+                              "session_id TEXT, seq INTEGER, message TEXT, PRIMARY KEY (session_id, seq))")
+            self.conn.commit()
+
+    def _load(self, session_id: str) -> List[Dict[str, str]]:
+        with self.lock:
+            rows = self.conn.execute("SELECT message FROM messages WHERE session_id = ? ORDER BY seq",
+                                     (session_id,)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def _write(self, session_id: str, messages: List[Dict[str, str]], start: int, rewrite: bool):
+        rows = [(session_id, seq, json.dumps(message, ensure_ascii=False))
+                for seq, message in enumerate(messages[start:], start)]
+        with self.lock:
+            if rewrite:
+                self.conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+            self.conn.executemany("INSERT INTO messages (session_id, seq, message) VALUES (?, ?, ?)", rows)
+            self.conn.commit()
+
+    def _delete(self, session_id: str):
+        with self.lock:
+            self.conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+            self.conn.commit()
+
+    async def load(self, session_id: str) -> List[Dict[str, str]]:
+        return await asyncio.to_thread(self._load, session_id)
+
+    async def append(self, session_id: str, messages: List[Dict[str, str]], start: int):
+        """写入messages[start:]"""
+        await asyncio.to_thread(self._write, session_id, messages, start, False)
+
+    async def replace(self, session_id: str, messages: List[Dict[str, str]]):
+        await asyncio.to_thread(self._write, session_id, messages, 0, True)
+
+    async def delete(self, session_id: str):
+        await asyncio.to_thread(self._delete, session_id)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def _measure(messages: Iterable[Dict[str, str]]) -> int:
+    # 按消息内容的UTF-8长度估算；分支之间共享的消息在每个会话中都被计入，因此估算值偏大
+    return sum(len(str(message.get("content", "")).encode("utf-8")) for message in messages)
+
+
+class _Session:
+    __slots__ = ("dialogue", "persisted_count", "persisted_revision", "size", "measured_count", "measured_revision")
+
+    def __init__(self, dialogue: Dialogue, persisted: bool = True):
+        """
+        :param persisted: 对话历史是否已经在存储中；为False时（例如分支出的会话）第一次写入时整体写入
+        """
+        self.dialogue = dialogue
+        self.persisted_count = dialogue.message_count if persisted else 0
+        self.persisted_revision = dialogue.revision if persisted else -1
+        self.size = 0
+        self.measured_count = 0
+        self.measured_revision = dialogue.revision
+        self.resize()
+
+    def resize(self) -> int:
+        """
+        更新size并返回其变化量
+        对话历史只被追加时只计算新增的消息，每轮的开销与历史长度无关；被裁剪、总结或清空后才重新计算全部消息
+        """
+        dialogue = self.dialogue
+        count = dialogue.message_count
+        if dialogue.revision != self.measured_revision or count < self.measured_count:
+            size = _measure(dialogue.iter_messages())
+        else:
+            size = self.size + _measure(dialogue.iter_messages(self.measured_count))
+        self.measured_count = count
+        self.measured_revision = dialogue.revision
+        delta = size - self.size
+        self.size = size
+        return delta
+
+
+class DialogueStore:
+    def __init__(self, endpoint: Endpoint | EndpointPool, path: str,
+                 max_sessions: int = 1000, max_bytes: int = None, **dialogue_kwargs):
+        """
+        按会话ID管理大量Dialogue。活跃会话保存在内存中，超出数量或字节上限时，最久未使用的会话被写入磁盘并移出内存，
+        下次收到该会话的消息时再从磁盘加载。不同会话之间并发处理，同一会话内的消息按顺序处理
+        :param endpoint: 所有会话共用的Endpoint，也可以是EndpointPool
+        :param path: SQLite文件路径
+        :param max_sessions: 内存中最多保留的会话数
+        :param max_bytes: 内存中所有会话消息的总字节数上限（按消息内容的UTF-8长度估算），为空时不限制
+        :param dialogue_kwargs: 创建Dialogue时的其他参数，例如max_context_tokens
+            所有会话共用同一个Metrics，可以通过metrics属性读取或导出
+        """
+        self.endpoint = endpoint
+        self.storage = SessionStorage(path)
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.metrics = dialogue_kwargs.setdefault("metrics", Metrics("aihub_dialogue"))
+        self.metrics.gauge("sessions", lambda: len(self.sessions))
+        self.metrics.gauge("session_bytes", lambda: self.total_bytes)
+        self.dialogue_kwargs = dialogue_kwargs
+        self.sessions: OrderedDict[str, _Session] = OrderedDict()
+        self.total_bytes = 0
+        self.loading = SingleFlight()
+        # 正在使用的会话ID及其使用者数量，这些会话不会被淘汰
+        self.pins: Dict[str, int] = {}
+        self.persisting: Dict[str, asyncio.Task] = {}
+        self.evictions = 0
+        self.loads = 0
+
+    async def _load(self, session_id: str):
+        # 会话刚被淘汰、尚未写完时，等待写入完成后再加载；写入失败时会话已被放回内存
+        if (task := self.persisting.get(session_id)) is not None:
+            await asyncio.wait({task})
+            if session_id in self.sessions:
+                return
+        messages = await self.storage.load(session_id)
+        if session_id in self.sessions:
+            return
+        dialogue = Dialogue(self.endpoint, **self.dialogue_kwargs)
+        dialogue.messages = messages
+        session = _Session(dialogue)
+        self.total_bytes += session.size
+        self.sessions[session_id] = session
+        if messages:
+            self.loads += 1
+            self.metrics.inc("session_loads")
+
+    async def _acquire(self, session_id: str) -> _Session:
+        # 在加载之前锁定会话ID，避免刚加载的会话在被使用前又被其他协程淘汰
+        self.pins[session_id] = self.pins.get(session_id, 0) + 1
+        try:
+            while (session := self.sessions.get(session_id)) is None:
+                # 同一会话的并发加载只执行一次，保证每个会话在内存中只有一个Dialogue
+                await self.loading.do(session_id, lambda: self._load(session_id))
+        except BaseException:
+            self._unpin(session_id)
+            raise
+        self.sessions.move_to_end(session_id)
+        return session
+
+    def _unpin(self, session_id: str):
+        self.pins[session_id] -= 1
+        if not self.pins[session_id]:
+            del self.pins[session_id]
+
+    def _release(self, session_id: str, session: _Session):
+        self._unpin(session_id)
+        self.total_bytes += session.resize()
+        self._evict()
+
+    def _over_budget(self) -> bool:
+        if len(self.sessions) > self.max_sessions:
+            return True
+        return self.max_bytes is not None and self.total_bytes > self.max_bytes
+
+    async def _persist(self, session_id: str, session: _Session):
+        dialogue = session.dialogue
+        # 在线程池中写入期间对话可能继续进行，因此写入的是此刻的快照，记录的消息数与版本也取自同一时刻
+        messages, revision = list(dialogue.iter_messages()), dialogue.revision
+        count = len(messages)
+        if revision != session.persisted_revision:
+            await self.storage.replace(session_id, messages)
+        elif count > session.persisted_count:
+            await self.storage.append(session_id, messages, session.persisted_count)
+        session.persisted_count = count
+        session.persisted_revision = revision
+
+    def _evict(self):
+        # 从最久未使用的会话开始淘汰，正在处理消息的会话不会被淘汰
+        # 被淘汰的会话在后台写入磁盘，请求不等待写入完成；写入完成前再次使用该会话时由_load等待
+        for session_id in list(self.sessions):
+            if not self._over_budget():
+                return
+            if (session := self.sessions.get(session_id)) is None:
+                continue
+            dialogue = session.dialogue
+            if session_id in self.pins or dialogue.lock.locked() or \
+                    (dialogue.summary_task is not None and not dialogue.summary_task.done()):
+                continue
+            del self.sessions[session_id]
+            self.total_bytes -= session.size
+            self.evictions += 1
+            self.metrics.inc("session_evictions")
+            task = asyncio.ensure_future(self._persist_evicted(session_id, session))
+            self.persisting[session_id] = task
+            task.add_done_callback(lambda done, key=session_id: self._persisted(key, done))
+
+    async def _persist_evicted(self, session_id: str, session: _Session) -> _Session | None:
+        """写入被淘汰的会话，写入失败时返回该会话"""
+        try:
+            await self._persist(session_id, session)
+        except (sqlite3.Error, TypeError, ValueError) as e:
+            logger.error(f"Failed to persist session {session_id}: {e}")
+            return session
+        return None
+
+    def _persisted(self, session_id: str, task: asyncio.Task):
+        # 由写入任务自己移除记录，等待者被唤醒时记录一定已经移除
+        if self.persisting.get(session_id) is task:
+            del self.persisting[session_id]
+        if task.cancelled():
+            return
+        if (error := task.exception()) is not None:
+            logger.error(f"Failed to persist session {session_id}: {error}")
+            return
+        # 写入失败的会话放回内存中最久未使用的位置，下次淘汰时重新写入，避免之后从磁盘读到不完整的历史
+        if (session := task.result()) is not None and session_id not in self.sessions:
+            self.sessions[session_id] = session
+            self.sessions.move_to_end(session_id, last=False)
+            self.total_bytes += session.size
+
+    async def send_message(self, session_id: str, message: str, **kwargs) -> Any:
+        session = await self._acquire(session_id)
+        try:
+            return await session.dialogue.send_message(message, **kwargs)
+        finally:
+            self._release(session_id, session)
+
+    async def stream_message(self, session_id: str, message: str, **kwargs) -> AsyncIterator[str]:
+        session = await self._acquire(session_id)
+        try:
+            async for chunk in session.dialogue.stream_message(message, **kwargs):
+                yield chunk
+        finally:
+            self._release(session_id, session)
+
+    async def get_messages(self, session_id: str) -> List[Dict[str, str]]:
+        session = await self._acquire(session_id)
+        try:
+            return list(session.dialogue.get_messages())
+        finally:
+            self._release(session_id, session)
+
+    async def fork(self, session_id: str, new_session_id: str):
+        """
+        以session_id当前的对话历史创建新的会话new_session_id，new_session_id已存在时被覆盖
+        内存中的两个会话共享分支前的历史；该会话正在进行一轮对话时，等待这一轮结束后再分支
+        """
+        if new_session_id == session_id:
+            raise ValueError("Cannot fork a session into itself")
+        session = await self._acquire(session_id)
+        try:
+            async with session.dialogue.lock:
+                dialogue = session.dialogue.fork()
+        finally:
+            self._release(session_id, session)
+        await self.delete(new_session_id)
+        forked = _Session(dialogue, persisted=False)
+        self.total_bytes += forked.size
+        self.sessions[new_session_id] = forked
+        self._evict()
+
+    async def delete(self, session_id: str):
+        session = self.sessions.pop(session_id, None)
+        if session is not None:
+            self.total_bytes -= session.size
+        # 等待该会话尚未完成的写入，避免删除后又被写回
+        if (task := self.persisting.get(session_id)) is not None:
+            await asyncio.wait({task})
+        await self.storage.delete(session_id)
+
+    async def flush(self):
+        """将所有内存中的会话写入磁盘，但不移出内存，并等待被淘汰的会话在后台写入完成"""
+        for session_id, session in list(self.sessions.items()):
+            await self._persist(session_id, session)
+        if self.persisting:
+            await asyncio.wait(list(self.persisting.values()))
+
+    async def close(self):
+        await self.flush()
+        self.sessions.clear()
+        self.total_bytes = 0
+        self.storage.close()
+
+    def get_status(self) -> dict:
+        return {
+            "sessions": len(self.sessions),
+            "bytes": self.total_bytes,
+            "evictions": self.evictions,
+            "loads": self.loads,
+        }
@@ -1,14 +1,25 @@
 import asyncio
 import datetime
 import json
+import math
+import random
+import sys
 import time
+from email.utils import parsedate_to_datetime
 
-import aiohttp
-import yaml
-from aiohttp import ClientError, ClientOSError
 from loguru import logger
-from typing import List, Dict, runtime_checkable, Protocol, Any, Tuple
-from openai import AsyncOpenAI, OpenAIError
+from typing import List, Dict, runtime_checkable, Protocol, Any, Tuple, Callable, AsyncIterator
+
+from .HttpPool import create_aiohttp_session, acquire_httpx_client, release_httpx_client, resolve_http_config
+from .JsonStream import JsonStream
+from .Metrics import Metrics
+from .RateLimiter import RateLimiter, ConcurrencyLimiter, AdaptiveController, estimate_tokens
+from .RecordReplay import RecordingSender, ReplaySender
+from .RequestQueue import RequestQueue
+from .ResponseCache import ResponseCache, make_cache_key
+from .SingleFlight import SingleFlight
+from .TokenManager import get_token_manager
+from .Tracing import Tracer, NOOP_SPAN, get_tracer
 
 
 @runtime_checkable
@@ -16,9 +27,74 @@ class IMessageSender(Protocol):
     async def send_message(self, message: Any, **kwargs) -> Any:
         pass
 
+    def stream_message(self, message: Any, **kwargs) -> AsyncIterator[Any]:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+
+class BaiduAPIError(Exception):
+    # 百度千帆的限流错误码与可重试的服务端错误码
+    RATE_LIMIT_CODES = {4, 18, 336501, 336502}
+    # access token无效或已过期，刷新token后重试
+    TOKEN_CODES = {110, 111}
+    RETRYABLE_CODES = {1, 2, 336100} | RATE_LIMIT_CODES | TOKEN_CODES
+
+    def __init__(self, error_code: int, error_msg: str):
+        super().__init__(f"Baidu API error {error_code}: {error_msg}")
+        self.error_code = error_code
+        self.error_msg = error_msg
+
+    @property
+    def is_rate_limited(self) -> bool:
+        return self.error_code in self.RATE_LIMIT_CODES
+
+    @property
+    def is_retryable(self) -> bool:
+        return self.error_code in self.RETRYABLE_CODES
+
+
+def _parse_retry_after(headers) -> float | None:
+    # Retry-After可以是秒数，也可以是HTTP日期
+    value = headers.get("retry-after") if headers else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+        return max(0.0, (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def _classify_error(e: Exception) -> Tuple[bool, bool, float | None]:
+    """返回(是否可重试, 是否被服务商限流, Retry-After秒数)"""
+    if isinstance(e, BaiduAPIError):
+        return e.is_retryable, e.is_rate_limited, None
+    # 服务商的SDK在创建发送器时才导入，未导入的SDK不可能抛出异常
+    openai, aiohttp = sys.modules.get("openai"), sys.modules.get("aiohttp")
+    if openai is not None and isinstance(e, openai.APIStatusError):
+        status, headers = e.status_code, e.response.headers
+    elif aiohttp is not None and isinstance(e, aiohttp.ClientResponseError):
+        status, headers = e.status, e.headers
+    elif isinstance(e, (ConnectionError, asyncio.TimeoutError)) or \
+            openai is not None and isinstance(e, openai.OpenAIError) or \
+            aiohttp is not None and isinstance(e, aiohttp.ClientError):
+        return True, False, None
+    else:
+        return False, False, None
+    throttled = status == 429
+    retryable = throttled or status >= 500 or status in (408, 409)
+    return retryable, throttled, _parse_retry_after(headers) if retryable else None
+
 
 class OpenAIMessageSender:
-    def __init__(self, api_key: str, model: str, org_id: str = None, api_base: str = None, **kwargs):
+    def __init__(self, api_key: str, model: str, org_id: str = None, api_base: str = None,
+                 http: Dict[str, Any] = None, **kwargs):
         if api_key == "" or api_key is None:
             raise ValueError("API key cannot be empty")
         if not api_key.startswith("sk-"):
@@ -31,14 +107,25 @@ class OpenAIMessageSender:
         self.org_id = org_id
         self.api_base = api_base
         self.model = model
-        self.client = AsyncOpenAI(api_key=api_key, organization=org_id, base_url=api_base)
+        from openai import AsyncOpenAI
+
+        # 指向同一api_base的Endpoint共享同一个httpx连接池
+        self.http_client = acquire_httpx_client(api_base, http)
+        # 重试统一由Endpoint负责（限流器、退避与自适应限流都能看到每一次请求），关闭SDK内部的重试
+        self.client = AsyncOpenAI(api_key=api_key, organization=org_id, base_url=api_base,
+                                  http_client=self.http_client, max_retries=0)
 
         non_none_params = {k: v for k, v in self.__dict__.items() if v is not None}
         logger.debug(f"OpenAI Endpoint Created with params: {non_none_params}")
 
-    async def send_message(self, message: List[Dict[str, str]], **kwargs) -> str | Dict[str, str]:
+    @staticmethod
+    def _with_system_prompt(message: List[Dict[str, str]], kwargs: dict) -> List[Dict[str, str]]:
         if system_prompt := kwargs.get("system_prompt", False):
-            message = [{"role": "system", "content": system_prompt}, *message]
+            return [{"role": "system", "content": system_prompt}, *message]
+        return message
+
+    async def send_message(self, message: List[Dict[str, str]], **kwargs) -> str | Dict[str, str]:
+        message = self._with_system_prompt(message, kwargs)
         reportResponse = await self.client.chat.completions.create(
             response_format={"type": "json_object"} if kwargs.get("json_format") else None,
             model=self.model,
@@ -47,15 +134,41 @@ class OpenAIMessageSender:
 
         if get_token := kwargs.get("get_token_callback", None):
             get_token(reportResponse.usage.total_tokens)
+        if on_usage := kwargs.get("usage_callback", None):
+            on_usage(reportResponse.usage.prompt_tokens, reportResponse.usage.completion_tokens)
 
         if kwargs.get("only_text", True):
             return reportResponse.choices[0].message.content
         else:
             return reportResponse.dict()
 
+    async def stream_message(self, message: List[Dict[str, str]], **kwargs) -> AsyncIterator[str | Dict[str, Any]]:
+        message = self._with_system_prompt(message, kwargs)
+        stream = await self.client.chat.completions.create(
+            response_format={"type": "json_object"} if kwargs.get("json_format") else None,
+            model=self.model,
+            messages=message,
+            stream=True,
+        )
+
+        only_text = kwargs.get("only_text", True)
+        async for chunk in stream:
+            if not only_text:
+                yield chunk.dict()
+            elif chunk.choices and (content := chunk.choices[0].delta.content):
+                yield content
+
+    async def close(self) -> None:
+        if self.http_client is not None:
+            await release_httpx_client(self.http_client)
+            self.http_client = None
+
 
 class BaiduMessageSender:
-    def __init__(self, api_key: str, secret_key: str, **kwargs):
+    DEFAULT_API_BASE = "https://aip.baidubce.com"
+
+    def __init__(self, api_key: str, secret_key: str, http: Dict[str, Any] = None, api_base: str = None,
+                 token_cache: str = None, **kwargs):
         if api_key == "" or api_key is None:
             raise ValueError("API key cannot be empty")
         if secret_key == "" or secret_key is None:
@@ -63,105 +176,462 @@ class BaiduMessageSender:
 
         self.api_key = api_key
         self.secret_key = secret_key
+        self.api_base = (api_base or self.DEFAULT_API_BASE).rstrip("/")
         self.access_token = None
-        self.token_obtained_time = None
+        # 同一进程内使用同一缓存文件的发送器共享token，指定token_cache时同一台机器上的所有进程共享
+        self.token_cache = token_cache
+        self.token_manager = get_token_manager(token_cache)
+        self.http_config = resolve_http_config(http)
+        self.session: 'aiohttp.ClientSession | None' = None
+        self.session_loop: asyncio.AbstractEventLoop | None = None
 
         non_none_params = {k: v for k, v in self.__dict__.items() if v is not None}
         logger.debug(f"Baidu Endpoint Created with params: {non_none_params}")
 
-    @staticmethod
-    async def _get_access_token(api_key: str, secret_key: str):
-        url = "https://aip.baidubce.com/oauth/2.0/token"
-        params = {"grant_type": "client_credentials", "client_id": api_key, "client_secret": secret_key}
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, params=params) as response:
-                response_json = await response.json()
-                return response_json.get("access_token"), datetime.datetime.now()
-
-    async def check_and_refresh_token(self):
-        if self.access_token is None or (datetime.datetime.now() - self.token_obtained_time).days >= 25:
-            self.access_token, self.token_obtained_time = await self._get_access_token(self.api_key, self.secret_key)
-            logger.debug("Baidu access token refreshed")
+    def _get_session(self) -> 'aiohttp.ClientSession':
+        # 会话需要在事件循环中创建，因此在第一次发送时才创建，之后所有请求复用同一个连接池
+        # 会话只能在创建它的事件循环中使用，在新的事件循环中（例如再次asyncio.run）重新创建
+        loop = asyncio.get_running_loop()
+        if self.session is None or self.session.closed or self.session_loop is not loop:
+            self.session = create_aiohttp_session(self.http_config)
+            self.session_loop = loop
+        return self.session
+
+    async def check_and_refresh_token(self) -> str:
+        self.access_token = await self.token_manager.get(self._get_session(), self.api_base, self.api_key,
+                                                         self.secret_key)
+        return self.access_token
+
+    def _raise_api_error(self, response_json: dict, access_token: str):
+        error = BaiduAPIError(response_json["error_code"], response_json.get("error_msg"))
+        if error.error_code in BaiduAPIError.TOKEN_CODES:
+            self.token_manager.invalidate(self.api_base, self.api_key, access_token)
+        raise error
+
+    def _completions_url(self, access_token: str) -> str:
+        return f"{self.api_base}/rpc/2.0/ai_custom/v1/wenxinworkshop/chat/completions_pro?access_token={access_token}"
 
     async def send_message(self, message: List[Dict[str, str]], **kwargs) -> str | Dict[str, str]:
-        await self.check_and_refresh_token()
-        url = f"https://aip.baidubce.com/rpc/2.0/ai_custom/v1/wenxinworkshop/chat/completions_pro?access_token={self.access_token}"
+        access_token = await self.check_and_refresh_token()
         payload = json.dumps({"messages": message})
         headers = {'Content-Type': 'application/json'}
 
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, headers=headers, data=payload) as response:
-                response_json = await response.json()
-                logger.debug(f"Baidu response: {response_json}")
-                if kwargs.get("only_text", True):
-                    return response_json["result"]
-                else:
-                    return response_json
+        async with self._get_session().post(self._completions_url(access_token), headers=headers, data=payload) as response:
+            parse_span = kwargs.get("trace_span", NOOP_SPAN).child("parse")
+            response_json = await response.json()
+            parse_span.end(response=response_json)
+            if "error_code" in response_json:
+                self._raise_api_error(response_json, access_token)
+            usage = response_json.get("usage", {})
+            if get_token := kwargs.get("get_token_callback", None):
+                get_token(usage.get("total_tokens"))
+            if on_usage := kwargs.get("usage_callback", None):
+                on_usage(usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0))
+            if kwargs.get("only_text", True):
+                return response_json["result"]
+            else:
+                return response_json
+
+    async def stream_message(self, message: List[Dict[str, str]], **kwargs) -> AsyncIterator[str | Dict[str, Any]]:
+        access_token = await self.check_and_refresh_token()
+        payload = json.dumps({"messages": message, "stream": True})
+        headers = {'Content-Type': 'application/json'}
+
+        only_text = kwargs.get("only_text", True)
+        async with self._get_session().post(self._completions_url(access_token), headers=headers, data=payload) as response:
+            # 百度以SSE格式逐条返回，每条为"data: {...}"；出错时直接返回一个普通的JSON对象
+            async for line in response.content:
+                line = line.strip()
+                if line.startswith(b"data:"):
+                    line = line[5:].strip()
+                elif not line.startswith(b"{"):
+                    continue
+                chunk = json.loads(line)
+                if "error_code" in chunk:
+                    self._raise_api_error(chunk, access_token)
+                if chunk.get("is_end"):
+                    usage = chunk.get("usage", {})
+                    if get_token := kwargs.get("get_token_callback", None):
+                        get_token(usage.get("total_tokens"))
+                    if on_usage := kwargs.get("usage_callback", None):
+                        on_usage(usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0))
+                if not only_text:
+                    yield chunk
+                elif chunk.get("result"):
+                    yield chunk["result"]
+
+    async def close(self) -> None:
+        # 其他事件循环中创建的会话无法在这里关闭，随其事件循环一起丢弃
+        if self.session is not None and not self.session.closed and self.session_loop is asyncio.get_running_loop():
+            await self.session.close()
+        self.session = None
+        self.session_loop = None
 
 
 class Endpoint:
-    def __init__(self, name: str, provider: str, max_calls_per_second: int = 20, **kwargs):
+    # 请求优先级，数值越小越先被处理
+    PRIORITY_INTERACTIVE = 0
+    PRIORITY_NORMAL = 5
+    PRIORITY_BATCH = 10
+
+    # 重试的指数退避参数（秒）
+    RETRY_BASE_DELAY = 1.0
+    RETRY_MAX_DELAY = 30.0
+
+    def __init__(self, name: str, provider: str, max_calls_per_second: int = 20,
+                 max_tokens_per_minute: int = None, rate_limit_burst: float = None,
+                 cache: Dict[str, Any] = None, max_queue_size: int = 0, queue_full_policy: str = "block",
+                 max_concurrency: int = None, adaptive_rate: bool = True, coalesce: bool = False,
+                 shared_rate_limit: Dict[str, Any] = None, tracer: Tracer = None, **kwargs):
         self.name = name
         self.provider = provider
         self.max_calls_per_second = max_calls_per_second
-        self.queue: asyncio.Queue = asyncio.Queue()
-        self.timestamps: List[float] = []
-        self.worker = asyncio.create_task(self._worker())
+        self.max_tokens_per_minute = max_tokens_per_minute
+        self.rate_limit_burst = rate_limit_burst
+        # 指定shared_rate_limit时，同一台机器上name相同的Endpoint共享同一份限流配额
+        self.shared_rate_limit = shared_rate_limit
+        self.rate_limiter = RateLimiter(max_calls_per_second, max_tokens_per_minute, rate_limit_burst,
+                                        name, shared_rate_limit)
+        self.max_concurrency = max_concurrency
+        self.concurrency = ConcurrencyLimiter(max_concurrency)
+        self.adaptive_rate = adaptive_rate
+        self.adaptive = AdaptiveController(self.rate_limiter, self.concurrency) if adaptive_rate else None
+        self.cache_config = cache
+        self.cache = ResponseCache(**cache) if cache is not None else None
+        self.coalesce = coalesce
+        self.single_flight = SingleFlight()
+        self.max_queue_size = max_queue_size
+        self.queue_full_policy = queue_full_policy
+        self.queue = RequestQueue(max_queue_size, queue_full_policy)
+        # worker与发送器都在第一次发送时才创建，因此可以在事件循环之外（例如模块级别）创建Endpoint
+        self.worker: asyncio.Task | None = None
+        self.tasks = set()
+        # 发送器与worker所属的事件循环
+        self.loop: asyncio.AbstractEventLoop | None = None
+
+        self.is_healthy = True
+        self.last_error = None
+        self.last_error_time = None
+        self.latency_ewma: float | None = None
+        self.in_flight = 0
+        self.metrics = Metrics("aihub_endpoint", endpoint=name)
+        self.metrics.track_rate("prompt_tokens")
+        self.metrics.track_rate("completion_tokens")
+        self.metrics.gauge("in_flight", lambda: self.in_flight)
+        self.metrics.gauge("queue_size", self.queue.qsize)
+        self.metrics.gauge("rate_limit", lambda: self.rate_limiter.rate)
+        # 未指定时使用进程内共享的追踪器，默认不采样
+        self.tracer = tracer or get_tracer()
 
         self.kwargs = kwargs
-        self.sender = self._create_sender(**self.dict())
+        self.sender: IMessageSender | None = None
+
+    async def start(self):
+        """提前创建发送器并启动worker，避免第一个请求承担导入服务商SDK和创建客户端的耗时；不调用时在第一次发送时自动启动"""
+        self._ensure_started()
+
+    def _ensure_started(self):
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            # 在新的事件循环中使用（例如模块级别的Endpoint被多次asyncio.run调用）时，
+            # 上一个事件循环中创建的客户端、连接池与worker都已无法使用，全部重新创建
+            self.sender = None
+            self.worker = None
+            self.loop = loop
+        if self.sender is None:
+            self.sender = self._create_sender(**self.dict())
+            if self.sender is None:
+                e = ValueError(f"Failed to create sender for {self.name}")
+                self._handle_error(e)
+                raise e
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.create_task(self._worker())
 
     async def send_message(self, message: Any, retry_count: int = 1, **kwargs) -> Any:
+        """
+        发送消息并返回服务商的回复
+        kwargs中的trace_span为上层（Dialogue、Expert）的span，该请求的span作为其子span记录；未指定时由追踪器决定是否采样
+        """
+        with self.tracer.start_span("endpoint.send", kwargs.pop("trace_span", None),
+                                    endpoint=self.name, message=message) as span:
+            response = await self._send_or_reuse(message, retry_count, kwargs, span)
+            span.set(response=response)
+            return response
+
+    async def _send_or_reuse(self, message: Any, retry_count: int, kwargs: dict, span) -> Any:
+        use_cache = kwargs.pop("use_cache", True) and self.cache is not None
+        # 带token回调的请求需要各自的用量数据，不参与合并
+        coalesce = kwargs.pop("coalesce", self.coalesce) and "get_token_callback" not in kwargs
+        kwargs["retry_count"] = retry_count
+        if not use_cache and not coalesce:
+            return await self._enqueue_message(message, kwargs, span)
+
+        key = make_cache_key(self.provider, self.kwargs.get("model"), message, kwargs)
+        if use_cache and (response := await self.cache.get(key)) is not None:
+            self.metrics.inc("cache_hits")
+            span.set(cache_hit=True)
+            return response
+        if coalesce:
+            # 共享的请求不带任何调用方的超时，每个调用方的timeout只限制自己的等待；所有调用方都放弃后共享的请求才被取消
+            # 共享的请求以第一个调用方的优先级排队
+            timeout = kwargs.pop("timeout", None)
+            shared = self.single_flight.do(key, lambda: self._enqueue_message(message, kwargs, span))
+            response = await (shared if timeout is None else asyncio.wait_for(shared, timeout))
+        else:
+            response = await self._enqueue_message(message, kwargs, span)
+        if use_cache:
+            await self.cache.set(key, response)
+        return response
+
+    async def _enqueue_message(self, message: Any, kwargs: dict, span=NOOP_SPAN) -> Any:
+        priority = kwargs.pop("priority", self.PRIORITY_NORMAL)
+        timeout = kwargs.pop("timeout", None)
+        self._ensure_started()
         future = asyncio.get_event_loop().create_future()
-        await self.queue.put((future, message, kwargs))
-        return await future
+        await self.queue.put(future, (message, kwargs, False, time.monotonic(), span), priority, timeout)
+        if timeout is None:
+            return await future
+        # 超时后future被取消：排队中的请求直接出队，处理中的请求被中止
+        return await asyncio.wait_for(future, timeout)
+
+    async def stream_message(self, message: Any, retry_count: int = 1, **kwargs) -> AsyncIterator[Any]:
+        """
+        以流式方式发送消息，逐块返回服务商的回复
+        与send_message共用同一个队列和限流器，获得限流器放行后才开始请求
+        """
+        kwargs["retry_count"] = retry_count
+        priority = kwargs.pop("priority", self.PRIORITY_NORMAL)
+        timeout = kwargs.pop("timeout", None)
+        # 先启动再创建span，发送器创建失败时不会留下一个永远不结束的span
+        self._ensure_started()
+        span = self.tracer.start_span("endpoint.stream", kwargs.pop("trace_span", None),
+                                      endpoint=self.name, message=message)
+        permit = asyncio.get_event_loop().create_future()
+        try:
+            await self.queue.put(permit, (message, kwargs, True, time.monotonic(), span), priority, timeout)
+            estimated_tokens = await (permit if timeout is None else asyncio.wait_for(permit, timeout))
+        except (asyncio.CancelledError, asyncio.TimeoutError) as e:
+            span.end(e)
+            # 放行后才被取消时，由这里结束该队列项；否则已由队列或_worker结束
+            if permit.done() and not permit.cancelled() and permit.exception() is None:
+                self.concurrency.release()
+                self.queue.task_done()
+            raise
+        except Exception as e:
+            span.end(e)
+            raise
+
+        if self.rate_limiter.tracks_tokens:
+            kwargs = {**kwargs, "get_token_callback": self._wrap_token_callback(
+                estimated_tokens, kwargs.get("get_token_callback"))}
+        # 部分服务商的流式接口不返回用量，此时按输出的文本估算
+        reported = False
+
+        def on_usage(prompt_tokens: int, completion_tokens: int):
+            nonlocal reported
+            reported = True
+            self._record_usage(prompt_tokens, completion_tokens)
+
+        kwargs = {**kwargs, "usage_callback": on_usage, "trace_span": span}
+        texts = []
+        error = None
+        self.in_flight += 1
+        try:
+            async for chunk in self._stream_message(message, **kwargs):
+                if isinstance(chunk, str):
+                    texts.append(chunk)
+                yield chunk
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self.in_flight -= 1
+            if not reported:
+                self._record_usage(estimate_tokens(message), estimate_tokens("".join(texts)))
+            self.concurrency.release()
+            self.queue.task_done()
+            span.end(error, response=lambda: "".join(texts))
 
-    async def _send_message(self, message: Any, retry_count: int = 1, **kwargs) -> Any:
-        retry_delay = 1
+    def stream_json(self, message: Any, retry_count: int = 1, **kwargs) -> JsonStream:
+        """
+        以json_format流式发送消息，并在文本块到达时增量解析JSON
+        返回的JsonStream在异步迭代时逐个产出已完成的顶层字段(字段名, 值)或数组元素(序号, 值)，await collect()返回完整对象
+        """
+        kwargs.update(json_format=True, only_text=True)
+        return JsonStream(self.stream_message(message, retry_count, **kwargs), kwargs.get("trace_span", NOOP_SPAN))
 
+    async def _send_message(self, message: Any, retry_count: int = 1, trace_span=NOOP_SPAN, **kwargs) -> Any:
         for attempt in range(retry_count + 1):
+            http_span = trace_span.child("http", attempt=attempt)
             try:
-                response = await self.sender.send_message(message, **kwargs)
-                self.is_healthy = True
+                start = time.monotonic()
+                response = await self.sender.send_message(message, trace_span=http_span, **kwargs)
+                latency = time.monotonic() - start
+                http_span.end()
+                self.metrics.observe("latency_seconds", latency, mode="send")
+                self._on_success(latency)
+                self.metrics.inc("requests", status="success")
                 return response
-            except (ClientError, ClientOSError, ConnectionError, OpenAIError) as e:
-                if attempt < retry_count:
-                    logger.info(
-                        f"Retrying to send message by {self.name}. Attempt {attempt + 1}/{retry_count}. Waiting {retry_delay} seconds.")
-                    await asyncio.sleep(retry_delay)
-                    retry_delay *= 2
-                else:
+            except Exception as e:
+                http_span.end(e)
+                retryable, retry_after = self._on_failure(e)
+                if not retryable or attempt >= retry_count:
                     self._handle_error(e)
+                    self.metrics.inc("requests", status="error")
                     raise
+                await self._wait_before_retry("send", attempt, retry_count, retry_after)
+
+    async def _stream_message(self, message: Any, retry_count: int = 1, trace_span=NOOP_SPAN,
+                              **kwargs) -> AsyncIterator[Any]:
+        for attempt in range(retry_count + 1):
+            started = False
+            start = time.monotonic()
+            http_span = trace_span.child("http", attempt=attempt)
+            try:
+                async for chunk in self.sender.stream_message(message, trace_span=http_span, **kwargs):
+                    if not started:
+                        started = True
+                        self.metrics.observe("time_to_first_chunk_seconds", time.monotonic() - start)
+                        http_span.set(time_to_first_chunk=time.monotonic() - start)
+                    yield chunk
+                http_span.end()
+                self.metrics.observe("latency_seconds", time.monotonic() - start, mode="stream")
+                self._on_success()
+                self.metrics.inc("requests", status="success")
+                return
             except Exception as e:
-                self._handle_error(e)
-                raise
+                http_span.end(e)
+                retryable, retry_after = self._on_failure(e)
+                # 已经向调用方输出过内容时不能重试，否则会产生重复内容
+                if not retryable or started or attempt >= retry_count:
+                    self._handle_error(e)
+                    self.metrics.inc("requests", status="error")
+                    raise
+                await self._wait_before_retry("stream", attempt, retry_count, retry_after)
+
+    def _on_success(self, latency: float = None):
+        self.is_healthy = True
+        if latency is not None:
+            self._record_latency(latency)
+        if self.adaptive is not None:
+            self.adaptive.on_success(latency)
+
+    def _on_failure(self, e: Exception) -> Tuple[bool, float | None]:
+        retryable, throttled, retry_after = _classify_error(e)
+        self.metrics.inc("errors", type=type(e).__name__)
+        if throttled:
+            self.metrics.inc("throttled_responses")
+            if self.adaptive is not None:
+                self.adaptive.on_throttled(retry_after)
+            elif retry_after:
+                self.rate_limiter.pause(retry_after)
+        return retryable, retry_after
+
+    async def _wait_before_retry(self, action: str, attempt: int, retry_count: int, retry_after: float | None):
+        # 带抖动的指数退避；服务商给出Retry-After时以其为准
+        if retry_after is not None:
+            delay = retry_after + random.uniform(0, self.RETRY_BASE_DELAY)
+        else:
+            backoff = min(self.RETRY_MAX_DELAY, self.RETRY_BASE_DELAY * 2 ** attempt)
+            delay = backoff / 2 + random.uniform(0, backoff / 2)
+        self.metrics.inc("retries")
+        logger.info(
+            f"Retrying to {action} message by {self.name}. Attempt {attempt + 1}/{retry_count}. Waiting {delay:.2f} seconds.")
+        await asyncio.sleep(delay)
+        # 重试同样占用限流配额
+        await self.rate_limiter.acquire()
 
     async def _worker(self):
         while True:
-            can_consume, now = self.can_consume_task()
-            # logger.debug(f"{self.name}: can_consume: {can_consume}")
-            if can_consume:
-                future, message, kwargs = await self.queue.get()
-                asyncio.create_task(self._process_message(future, message, kwargs))
-                self.timestamps.append(now)
+            # 先等到并发和限流都有余量再出队，保证出队的总是此刻优先级最高的请求
+            await self.concurrency.acquire()
+            try:
+                waited = await self.rate_limiter.wait()
+                future, (message, kwargs, stream, enqueued, span) = await self.queue.get()
+            except asyncio.CancelledError:
+                # close()或事件循环结束时worker被取消，归还并发配额，否则之后重新启动的worker会永久少一个配额
+                self.concurrency.release()
+                raise
+            queue_wait = time.monotonic() - enqueued
+            span.child("queue", start=enqueued).end()
+            self.metrics.observe("queue_wait_seconds", queue_wait)
+            # 队列为空时worker在限流器上的等待不算作请求被限流的时间
+            throttled = min(waited, queue_wait)
+            tokens = estimate_tokens(message) if self.rate_limiter.tracks_tokens else 0
+            try:
+                throttled += await self.rate_limiter.acquire(tokens)
+            except asyncio.CancelledError:
+                # 已出队的请求无法再被处理，取消它以免调用方一直等待
+                future.cancel()
+                self.concurrency.release()
+                self.queue.task_done()
+                raise
+            if throttled:
+                self.metrics.inc("throttled_seconds", throttled)
+                span.child("rate_limit", start=time.monotonic() - throttled).end(tokens=tokens)
+            if future.done():
+                # 调用方在等待限流期间已取消，归还配额
+                self.rate_limiter.release(tokens)
+                self.concurrency.release()
+                self.queue.task_done()
+            elif stream:
+                future.set_result(tokens)
             else:
-                logger.debug(f"{self.name} is busy. Waiting...")
-                await asyncio.sleep(0.3)
-
-    async def _process_message(self, future, message, kwargs):
+                task = asyncio.create_task(self._process_message(future, message, kwargs, tokens, span))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+                future.add_done_callback(lambda f, t=task: t.cancel() if f.cancelled() else None)
+
+    async def _process_message(self, future, message, kwargs, estimated_tokens: int = 0, span=NOOP_SPAN):
+        if self.rate_limiter.tracks_tokens:
+            kwargs = {**kwargs, "get_token_callback": self._wrap_token_callback(
+                estimated_tokens, kwargs.get("get_token_callback"))}
+        kwargs = {**kwargs, "usage_callback": self._record_usage, "trace_span": span}
+        self.in_flight += 1
         try:
             response = await self._send_message(message, **kwargs)
-            future.set_result(response)
+            if not future.done():
+                future.set_result(response)
         except Exception as e:
-            future.set_exception(e)
+            if not future.done():
+                future.set_exception(e)
         finally:
+            self.in_flight -= 1
+            self.concurrency.release()
             self.queue.task_done()
 
+    def _wrap_token_callback(self, estimated_tokens: int, callback: Callable[[int], None] = None):
+        # 用服务商返回的实际用量修正限流器中的token预估值，并继续调用用户的回调
+        def on_token(total_tokens: int):
+            self.rate_limiter.record_usage(estimated_tokens, total_tokens)
+            if callback:
+                callback(total_tokens)
+
+        return on_token
+
+    def _record_usage(self, prompt_tokens: int, completion_tokens: int):
+        self.metrics.inc("prompt_tokens", prompt_tokens or 0)
+        self.metrics.inc("completion_tokens", completion_tokens or 0)
+
     def can_consume_task(self) -> Tuple[bool, float]:
-        now = time.time()
-        self.timestamps = [t for t in self.timestamps if now - t < 1]
-        return len(self.timestamps) < self.max_calls_per_second, now
+        return self.rate_limiter.has_headroom(), time.time()
+
+    def headroom(self) -> float:
+        """限流器中剩余的请求配额减去排队中的请求数，可为负数"""
+        return self.rate_limiter.available_calls() - self.queue.qsize()
+
+    def suggested_concurrency(self) -> int:
+        """按 速率 x 平均延迟 估算填满限流配额所需的并发数，不超过max_concurrency"""
+        concurrency = math.ceil(self.rate_limiter.rate * (self.latency_ewma or 1.0)) + 1
+        if self.max_concurrency is not None:
+            concurrency = min(concurrency, self.max_concurrency)
+        return max(1, concurrency)
+
+    def _record_latency(self, latency: float, alpha: float = 0.2):
+        if self.latency_ewma is None:
+            self.latency_ewma = latency
+        else:
+            self.latency_ewma += alpha * (latency - self.latency_ewma)
 
     @staticmethod
     def _create_sender(**kwargs) -> IMessageSender:
@@ -171,6 +641,12 @@ class Endpoint:
                 return OpenAIMessageSender(**kwargs)
             elif provider == 'baidu':
                 return BaiduMessageSender(**kwargs)
+            elif provider == 'record':
+                # 通过record_provider指定实际的服务商，其余参数原样传给实际的发送器
+                sender = Endpoint._create_sender(**{**kwargs, "provider": kwargs['record_provider']})
+                return RecordingSender(sender, **kwargs) if sender is not None else None
+            elif provider == 'replay':
+                return ReplaySender(**kwargs)
             else:
                 raise ValueError(f"Unsupported provider: {provider}")
         except KeyError as e:
@@ -191,15 +667,35 @@ class Endpoint:
             "name": self.name,
             "provider": self.provider,
             "is_healthy": self.is_healthy,
+            "rate_limit": self.rate_limiter.get_status(),
+            "queue": self.queue.get_status(),
+            "in_flight": self.in_flight,
+            "latency_ewma": self.latency_ewma,
+            "retries": self.metrics.count("retries"),
+            "metrics": self.metrics.snapshot(),
         }
+        if self.adaptive is not None:
+            status["adaptive"] = self.adaptive.get_status()
+        if self.coalesce or self.single_flight.saved:
+            status["coalescing"] = self.single_flight.get_status()
+        if self.cache is not None:
+            status["cache"] = self.cache.get_status()
+        if isinstance(self.sender, ReplaySender):
+            status["replay"] = self.sender.get_status()
         if not self.is_healthy:
             status["last_error"] = self.last_error
             status["last_error_time"] = self.last_error_time
         status.update(self.kwargs)
         return status
 
+    def to_prometheus(self) -> str:
+        """以Prometheus文本格式导出该Endpoint的指标"""
+        return self.metrics.to_prometheus()
+
     @classmethod
     def load_from_yaml(cls, file_path: str) -> 'Endpoint':
+        import yaml
+
         with open(file_path, 'r') as file:
             data = yaml.safe_load(file)
             logger.debug(f"Loaded endpoint {data['name']} from {file_path}")
@@ -207,12 +703,16 @@ class Endpoint:
 
     @classmethod
     def save_to_yaml(cls, endpoint: 'Endpoint', file_path: str) -> None:
+        import yaml
+
         with open(file_path, 'w') as file:
             yaml.dump(endpoint.dict(), file)
             logger.debug(f"Saved endpoint {endpoint.name} to {file_path}")
 
     @classmethod
     def load_list_from_yaml(cls, file_path: str) -> List['Endpoint']:
+        import yaml
+
         with open(file_path, 'r') as file:
             data = yaml.safe_load(file)
             logger.debug(f"Loaded endpoints from {file_path}")
@@ -220,19 +720,42 @@ class Endpoint:
 
     @classmethod
     def save_list_to_yaml(cls, endpoints: List['Endpoint'], file_path: str) -> None:
+        import yaml
+
         with open(file_path, 'w') as file:
             yaml.dump([endpoint.dict() for endpoint in endpoints], file)
             logger.debug(f"Saved endpoints to {file_path}")
 
     def dict(self) -> dict:
+        options = {
+            "max_calls_per_second": self.max_calls_per_second,
+            "max_tokens_per_minute": self.max_tokens_per_minute,
+            "rate_limit_burst": self.rate_limit_burst,
+            "shared_rate_limit": self.shared_rate_limit,
+            "cache": self.cache_config,
+            "max_queue_size": self.max_queue_size or None,
+            "queue_full_policy": self.queue_full_policy if self.max_queue_size else None,
+            "max_concurrency": self.max_concurrency,
+            "adaptive_rate": None if self.adaptive_rate else False,
+            "coalesce": self.coalesce or None,
+        }
         return {
             "name": self.name,
             "provider": self.provider,
+            **{k: v for k, v in options.items() if v is not None},
             **self.kwargs
         }
 
     async def close(self):
         await self.queue.join()
-        self.worker.cancel()
-        await asyncio.gather(self.worker, return_exceptions=True)
+        if self.worker is not None:
+            self.worker.cancel()
+            await asyncio.gather(self.worker, return_exceptions=True)
+            self.worker = None
+        if self.sender is not None:
+            await self.sender.close()
+            self.sender = None
+        if self.cache is not None:
+            self.cache.close()
+        self.rate_limiter.close()
 
@@ -0,0 +1,124 @@
+import asyncio
+import datetime
+from typing import List, Any, AsyncIterator
+
+from loguru import logger
+
+from .Endpoint import Endpoint, _classify_error
+from .JsonStream import JsonStream
+from .Metrics import export_prometheus
+from .Tracing import NOOP_SPAN
+
+
+class EndpointPool:
+    STRATEGIES = ("headroom", "latency")
+
+    def __init__(self, endpoints: List[Endpoint], name: str = "pool", strategy: str = "headroom",
+                 cooldown: float = 30):
+        """
+        将多个Endpoint组合为一个，对外提供与Endpoint相同的send_message/stream_message接口
+        每个请求都会被路由到当前最合适的Endpoint，遇到可重试的错误（网络错误、5xx、限流）时自动切换到其他Endpoint重试，
+        其他错误（例如参数错误、调用方超时、队列已满）直接抛出
+        :param endpoints: 组成该池的Endpoint列表
+        :param name: 池的名称
+        :param strategy: 路由策略。headroom：选择限流余量最多的Endpoint；latency：选择平均延迟(EWMA)最低的Endpoint
+        :param cooldown: Endpoint出错后被熔断的时间（秒），熔断期间不会被选中，期满后重新尝试
+        """
+        if not endpoints:
+            raise ValueError("Endpoint pool cannot be empty")
+        if strategy not in self.STRATEGIES:
+            raise ValueError(f"Unsupported strategy: {strategy}")
+        # Endpoint在第一次使用时才创建发送器，创建失败的Endpoint会被标记为不健康并在冷却期内跳过
+        self.endpoints = list(endpoints)
+        self.name = name
+        self.strategy = strategy
+        self.cooldown = datetime.timedelta(seconds=cooldown)
+
+    @classmethod
+    def load_from_yaml(cls, file_path: str, **kwargs) -> 'EndpointPool':
+        return cls(Endpoint.load_list_from_yaml(file_path), **kwargs)
+
+    def _is_available(self, endpoint: Endpoint, now: datetime.datetime) -> bool:
+        # 熔断：最近出过错的Endpoint在冷却期内不参与路由
+        if endpoint.is_healthy or endpoint.last_error_time is None:
+            return True
+        return now - endpoint.last_error_time >= self.cooldown
+
+    def _score(self, endpoint: Endpoint) -> tuple:
+        # 分数越小越优先
+        if self.strategy == "latency":
+            # 尚无延迟数据的Endpoint优先，以便尽快获得其延迟
+            return endpoint.latency_ewma or 0.0, -endpoint.headroom()
+        return -endpoint.headroom(), endpoint.latency_ewma or 0.0
+
+    def _select(self, exclude: List[Endpoint]) -> Endpoint | None:
+        candidates = [endpoint for endpoint in self.endpoints if endpoint not in exclude]
+        if not candidates:
+            return None
+        now = datetime.datetime.now()
+        available = [endpoint for endpoint in candidates if self._is_available(endpoint, now)]
+        # 所有Endpoint都处于熔断状态时，选择最早出错的那个进行尝试
+        if not available:
+            return min(candidates, key=lambda endpoint: endpoint.last_error_time)
+        return min(available, key=self._score)
+
+    @staticmethod
+    def _should_fail_over(endpoint: Endpoint, e: Exception) -> bool:
+        # 调用方的超时（asyncio.wait_for抛出的TimeoutError本身）与队列已满不是该Endpoint的故障，换一个Endpoint也无济于事
+        if type(e) in (asyncio.TimeoutError, asyncio.QueueFull):
+            return False
+        # 发送器创建失败说明该Endpoint的配置有误，其他Endpoint仍然可用
+        if endpoint.sender is None:
+            return True
+        retryable, throttled, _ = _classify_error(e)
+        return retryable or throttled
+
+    async def send_message(self, message: Any, retry_count: int = 1, **kwargs) -> Any:
+        """参数与Endpoint.send_message相同，retry_count为每个Endpoint内部的重试次数"""
+        tried = []
+        while endpoint := self._select(tried):
+            tried.append(endpoint)
+            try:
+                return await endpoint.send_message(message, retry_count, **kwargs)
+            except Exception as e:
+                if len(tried) == len(self.endpoints) or not self._should_fail_over(endpoint, e):
+                    raise
+                logger.warning(f"{self.name}: {endpoint.name} failed ({e}), failing over to another endpoint")
+
+    async def stream_message(self, message: Any, retry_count: int = 1, **kwargs) -> AsyncIterator[Any]:
+        tried = []
+        while endpoint := self._select(tried):
+            tried.append(endpoint)
+            started = False
+            try:
+                async for chunk in endpoint.stream_message(message, retry_count, **kwargs):
+                    started = True
+                    yield chunk
+                return
+            except Exception as e:
+                # 已经输出过内容时无法切换，否则调用方会收到重复内容
+                if started or len(tried) == len(self.endpoints) or not self._should_fail_over(endpoint, e):
+                    raise
+                logger.warning(f"{self.name}: {endpoint.name} failed ({e}), failing over to another endpoint")
+
+    def stream_json(self, message: Any, retry_count: int = 1, **kwargs) -> JsonStream:
+        kwargs.update(json_format=True, only_text=True)
+        return JsonStream(self.stream_message(message, retry_count, **kwargs), kwargs.get("trace_span", NOOP_SPAN))
+
+    def suggested_concurrency(self) -> int:
+        return sum(endpoint.suggested_concurrency() for endpoint in self.endpoints)
+
+    def get_status(self) -> dict:
+        return {
+            "name": self.name,
+            "strategy": self.strategy,
+            "is_healthy": any(endpoint.is_healthy for endpoint in self.endpoints),
+            "endpoints": [endpoint.get_status() for endpoint in self.endpoints],
+        }
+
+    def to_prometheus(self) -> str:
+        """以Prometheus文本格式导出池中所有Endpoint的指标"""
+        return export_prometheus(*self.endpoints)
+
+    async def close(self):
+        await asyncio.gather(*(endpoint.close() for endpoint in self.endpoints))
@@ -1,23 +1,55 @@
-import yaml
-from typing import Dict
+import asyncio
+import copy
+import time
+from typing import Dict, AsyncIterator, AsyncIterable, Awaitable, Iterable, NamedTuple, Any, Callable
 from loguru import logger
 
 from .Endpoint import Endpoint
+from .EndpointPool import EndpointPool
 from .Dialogue import Dialogue
+from .JsonStream import JsonStream
+from .Metrics import Metrics, export_prometheus
+from .PromptPacker import PromptPacker
+from .PromptTemplate import PromptLibrary
+from .Tracing import Tracer, NOOP_SPAN, get_tracer
+
+
+class BatchResult(NamedTuple):
+    index: int  # 该参数在输入中的序号
+    params: Dict[str, str]
+    response: Any = None
+    error: Exception | None = None
+
+
+def _as_async_iterator(items: Iterable | AsyncIterable):
+    if hasattr(items, "__aiter__"):
+        return items.__aiter__()
+
+    async def wrapper():
+        for item in items:
+            yield item
+
+    return wrapper()
 
 
 class Expert:
     def __init__(self,
-                 endpoint: Endpoint = None,
+                 endpoint: Endpoint | EndpointPool = None,
                  endpoint_config_path: str = None,
                  prompts: Dict[str, str] = None,
-                 prompts_config_path: str = None):
+                 prompts_config_path: str = None,
+                 prompts_reload_interval: float | None = 1.0,
+                 packing: Dict[str, Any] = None,
+                 tracer: Tracer = None):
         """
         初始化Expert
-        :param endpoint: 该Expert使用的Endpoint
+        :param endpoint: 该Expert使用的Endpoint，也可以是EndpointPool
         :param endpoint_config_path: 该Expert使用的Endpoint的配置文件路径。endpoint和endpoint_config_path必须指定一个
         :param prompts: 该Expert使用的Prompt字典
-        :param prompts_config_path: 该Expert使用的Prompt字典的配置文件路径
+        :param prompts_config_path: 该Expert使用的Prompt字典的配置文件路径。文件修改后会自动重新加载
+        :param prompts_reload_interval: 检查Prompt配置文件是否修改的最小间隔（秒），为None时不自动重新加载
+        :param packing: 合并短提示词的配置，传入PromptPacker的参数（max_batch_size、window、max_batch_tokens、max_item_tokens），为空时不合并
+        :param tracer: 记录请求span的追踪器，为空时使用进程内共享的追踪器
         """
         if not endpoint_config_path and not endpoint:
             raise ValueError("Either endpoint or endpoint_path must be specified")
@@ -25,22 +57,47 @@ class Expert:
             endpoint = Endpoint.load_from_yaml(endpoint_config_path)
         self.endpoint = endpoint
 
-        self.dialogue = Dialogue(endpoint)
+        self.metrics = Metrics("aihub_expert")
+        self.tracer = tracer or get_tracer()
+        self.dialogue = Dialogue(endpoint, tracer=self.tracer)
+        self.packing = packing
+        self.packer = PromptPacker(endpoint, metrics=self.metrics, **packing) if packing is not None else None
+
+        # 提示词在加载时编译并校验占位符
+        self.prompts = PromptLibrary(prompts, prompts_config_path, prompts_reload_interval)
 
-        if prompts_config_path and not prompts:
-            with open(prompts_config_path, 'r', encoding='utf-8') as file:
-                prompts = yaml.safe_load(file)
-        self.prompts = prompts
+    def reload_prompts(self):
+        """立即重新加载Prompt配置文件"""
+        self.prompts.reload(force=True)
 
-    @staticmethod
-    def _replace_placeholders(template: str, values: Dict[str, str]) -> str:
-        # 将模板字符串中的占位符替换为values字典中的值
-        result = template
-        if not values:
-            return result
-        for key, value in values.items():
-            result = result.replace(f'{{{{{key}}}}}', value)
-        return result
+    def _build_prompt(self, message: str = None, prompt_type: str = None,
+                      prompt_params: Dict[str, str] = None) -> str:
+        # prompt_type不为空时使用对应的提示词模板，否则直接使用message
+        if not prompt_type:
+            return message
+        return self.prompts.render(prompt_type, prompt_params)
+
+    def _start_span(self, name: str, prompt_type: str | None, prompt_message: str, kwargs: dict):
+        # 该span作为之后Dialogue、Endpoint中span的父span，通过kwargs向下传递
+        span = self.tracer.start_span(name, kwargs.get("trace_span"), prompt=prompt_type, message=prompt_message)
+        kwargs["trace_span"] = span
+        return span
+
+    async def _timed(self, prompt_type: str | None, request: Awaitable[str], span=NOOP_SPAN) -> str:
+        # 按提示词记录请求数、失败数和端到端耗时
+        prompt = prompt_type or ""
+        start = time.monotonic()
+        try:
+            response = await request
+        except BaseException as e:
+            span.end(e)
+            if isinstance(e, Exception):
+                self.metrics.inc("requests", prompt=prompt, status="error")
+            raise
+        self.metrics.inc("requests", prompt=prompt, status="success")
+        self.metrics.observe("latency_seconds", time.monotonic() - start, prompt=prompt)
+        span.end(response=response)
+        return response
 
     async def get_answer(self, message: str = None, prompt_type: str = None,
                          prompt_params: Dict[str, str] = None, **kwargs) -> str:
@@ -49,23 +106,18 @@ class Expert:
         当prompt_type不为空时，使用prompt_type对应的提示词作为LLM输入，并使用prompt_params对Prompt进行补全。此时忽略message参数
         当prompt_type为空时，直接使用message作为LLM输入
         不包含上下文
+        启用packing时，只带有priority、retry_count、timeout参数的短提示词会与同时到达的其他提示词合并发送，pack=False时不合并
         """
-        if prompt_type:
-            if prompt_type not in self.prompts:
-                raise ValueError(f"Prompt with name '{prompt_type}' not found")
-
-            prompt_template = self.prompts[prompt_type]
-            prompt_message = self._replace_placeholders(prompt_template, prompt_params)
+        prompt_message = self._build_prompt(message, prompt_type, prompt_params)
+        kwargs.setdefault("priority", Endpoint.PRIORITY_BATCH)
+        pack = kwargs.pop("pack", True)
 
-            logger.debug(f"Sending prompt '{prompt_type}' with message: {prompt_message}")
-            response = await self.endpoint.send_message([{"role": "user", "content": prompt_message}], **kwargs)
-            logger.debug(f"Received response: {response}")
+        span = self._start_span("expert.get_answer", prompt_type, prompt_message, kwargs)
+        if pack and self.packer is not None and self.packer.accepts(prompt_message, kwargs):
+            request = self.packer.submit(prompt_message, **kwargs)
         else:
-            logger.debug(f"Sending message: {message}")
-            response = await self.endpoint.send_message([{"role": "user", "content": message}], **kwargs)
-            logger.debug(f"Received response: {response}")
-
-        return response
+            request = self.endpoint.send_message([{"role": "user", "content": prompt_message}], **kwargs)
+        return await self._timed(prompt_type, request, span)
 
     async def communicate(self, message: str = None, prompt_type: str = None,
                           prompt_params: Dict[str, str] = None, **kwargs) -> str:
@@ -75,22 +127,148 @@ class Expert:
         当prompt_type为空时，直接使用message作为LLM输入
         自动维护对话上下文。除非调用restart_dialogue，否则对话历史记录将不断累加
         """
-        if prompt_type:
-            if prompt_type not in self.prompts:
-                raise ValueError(f"Prompt with name '{prompt_type}' not found")
+        prompt_message = self._build_prompt(message, prompt_type, prompt_params)
 
-            prompt_template = self.prompts[prompt_type]
-            prompt_message = self._replace_placeholders(prompt_template, prompt_params)
+        span = self._start_span("expert.communicate", prompt_type, prompt_message, kwargs)
+        return await self._timed(prompt_type, self.dialogue.send_message(prompt_message, **kwargs), span)
 
-            logger.debug(f"Sending prompt '{prompt_type}' with message: {prompt_message}")
-            response = await self.dialogue.send_message(prompt_message, **kwargs)
-            logger.debug(f"Received response: {response}")
-        else:
-            logger.debug(f"Sending message: {message}")
-            response = await self.dialogue.send_message(message, **kwargs)
-            logger.debug(f"Received response: {response}")
+    async def stream_answer(self, message: str = None, prompt_type: str = None,
+                            prompt_params: Dict[str, str] = None, **kwargs) -> AsyncIterator[str]:
+        """
+        与get_answer相同，但以流式方式逐块返回回答
+        不包含上下文
+        """
+        prompt_message = self._build_prompt(message, prompt_type, prompt_params)
+        kwargs.setdefault("priority", Endpoint.PRIORITY_BATCH)
+        span = self._start_span("expert.stream_answer", prompt_type, prompt_message, kwargs)
+        with span:
+            async for chunk in self.endpoint.stream_message([{"role": "user", "content": prompt_message}], **kwargs):
+                yield chunk
 
-        return response
+    async def stream_communicate(self, message: str = None, prompt_type: str = None,
+                                 prompt_params: Dict[str, str] = None, **kwargs) -> AsyncIterator[str]:
+        """
+        与communicate相同，但以流式方式逐块返回回答
+        回答结束后，完整的回复会被追加到对话上下文中
+        """
+        prompt_message = self._build_prompt(message, prompt_type, prompt_params)
+        span = self._start_span("expert.stream_communicate", prompt_type, prompt_message, kwargs)
+        with span:
+            async for chunk in self.dialogue.stream_message(prompt_message, **kwargs):
+                yield chunk
+
+    def stream_json(self, message: str = None, prompt_type: str = None,
+                    prompt_params: Dict[str, str] = None, **kwargs) -> JsonStream:
+        """
+        与get_answer相同，但要求以JSON格式回答，并在回答生成过程中增量解析
+        异步迭代返回的JsonStream时，每个顶层字段或数组元素完成后立即产出，不必等待整个回答生成完毕
+        """
+        prompt_message = self._build_prompt(message, prompt_type, prompt_params)
+        kwargs.setdefault("priority", Endpoint.PRIORITY_BATCH)
+        return self.endpoint.stream_json([{"role": "user", "content": prompt_message}], **kwargs)
+
+    async def get_json(self, message: str = None, prompt_type: str = None,
+                       prompt_params: Dict[str, str] = None, **kwargs) -> Any:
+        """与stream_json相同，但直接返回解析后的对象，文本在接收过程中已被解析，无需再次完整解析"""
+        span = self._start_span("expert.get_json", prompt_type,
+                                lambda: self._build_prompt(message, prompt_type, prompt_params), kwargs)
+        return await self._timed(prompt_type, self.stream_json(message, prompt_type, prompt_params, **kwargs).collect(),
+                                 span)
+
+    async def get_answers_batch(self, params: Iterable[Dict[str, str]] | AsyncIterable[Dict[str, str]],
+                                prompt_type: str, ordered: bool = True, concurrency: int = None,
+                                retry_count: int = 1,
+                                progress_callback: Callable[[dict], None] = None,
+                                **kwargs) -> AsyncIterator[BatchResult]:
+        """
+        使用同一个提示词，对大量prompt_params批量获取回答，逐个产出BatchResult
+        输入按需读取，同时处理中的请求数有上限，因此内存占用与输入规模无关
+        单个请求失败不会影响整批，异常记录在对应BatchResult的error中
+        :param params: prompt_params的可迭代对象或异步可迭代对象
+        :param prompt_type: 提示词名称
+        :param ordered: 为True时按输入顺序产出结果，为False时按完成顺序产出
+        :param concurrency: 同时处理中的最大请求数，默认根据Endpoint的限流速率和平均延迟估算，启用packing时再乘以max_batch_size
+        :param retry_count: 每个请求失败后的最大重试次数
+        :param progress_callback: 每完成一个请求调用一次，参数为包含completed、failed、in_flight、elapsed、throughput的字典
+        """
+        self.prompts.get(prompt_type)  # 提示词不存在时在开始前抛出ValueError
+        if concurrency is None:
+            concurrency = self.endpoint.suggested_concurrency()
+            if self.packer is not None:
+                # 合并发送时每个请求可以容纳max_batch_size个提示词
+                concurrency *= self.packer.max_batch_size
+        # 按顺序产出时，限制已完成但尚未产出的结果数量，避免个别慢请求导致结果堆积
+        window = concurrency * 2
+
+        async def answer(index: int, prompt_params: Dict[str, str]) -> BatchResult:
+            try:
+                response = await self.get_answer(prompt_type=prompt_type, prompt_params=prompt_params,
+                                                 retry_count=retry_count, **kwargs)
+                return BatchResult(index, prompt_params, response)
+            except Exception as e:
+                return BatchResult(index, prompt_params, error=e)
+
+        source = _as_async_iterator(params)
+        pending = set()
+        buffered: Dict[int, BatchResult] = {}
+        next_index = next_yield = completed = failed = 0
+        exhausted = False
+        start = time.monotonic()
+        try:
+            while True:
+                while not exhausted and len(pending) < concurrency and \
+                        (not ordered or next_index - next_yield < window):
+                    try:
+                        prompt_params = await source.__anext__()
+                    except StopAsyncIteration:
+                        exhausted = True
+                        break
+                    pending.add(asyncio.create_task(answer(next_index, prompt_params)))
+                    next_index += 1
+                if not pending:
+                    break
+
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    result = task.result()
+                    completed += 1
+                    failed += result.error is not None
+                    self.metrics.inc("batch_items", prompt=prompt_type,
+                                     status="error" if result.error is not None else "success")
+                    if progress_callback:
+                        elapsed = time.monotonic() - start
+                        progress_callback({"completed": completed, "failed": failed, "in_flight": len(pending),
+                                           "elapsed": elapsed, "throughput": completed / elapsed if elapsed else 0.0})
+                    if ordered:
+                        buffered[result.index] = result
+                    else:
+                        yield result
+                while next_yield in buffered:
+                    yield buffered.pop(next_yield)
+                    next_yield += 1
+        finally:
+            for task in pending:
+                task.cancel()
+            elapsed = time.monotonic() - start
+            logger.debug(f"Batch '{prompt_type}' finished: {completed} completed, {failed} failed in {elapsed:.2f}s")
+
+    def to_prometheus(self) -> str:
+        """以Prometheus文本格式导出该Expert及其对话的指标"""
+        return export_prometheus(self, self.dialogue)
+
+    def fork(self, **kwargs) -> 'Expert':
+        """
+        从当前对话创建一个分支Expert，用于在同一上下文上尝试不同的后续问题或提示词
+        分支与当前Expert共用Endpoint、提示词、指标和packing，对话历史以写时复制的方式共享，创建分支不复制消息
+        :param kwargs: 覆盖分支Dialogue的构造参数，例如endpoint
+        """
+        expert = copy.copy(self)
+        expert.dialogue = self.dialogue.fork(**kwargs)
+        if "endpoint" in kwargs:
+            expert.endpoint = kwargs["endpoint"]
+            if self.packing is not None:
+                expert.packer = PromptPacker(expert.endpoint, metrics=self.metrics, **self.packing)
+        return expert
 
     def restart_dialogue(self):
         self.dialogue.clear_messages()
@@ -0,0 +1,93 @@
+import asyncio
+from typing import Dict, Any, Tuple
+
+from loguru import logger
+
+DEFAULT_HTTP_CONFIG = {
+    "pool_size": 100,  # 连接池最大连接数
+    "pool_size_per_host": 0,  # 每个主机的最大连接数，0表示不限制
+    "keepalive_timeout": 30,  # 空闲连接保持时间（秒）
+    "dns_cache_ttl": 300,  # DNS缓存时间（秒），仅对aiohttp生效
+    "timeout": 600,  # 单次请求总超时（秒）
+    "connect_timeout": 10,  # 建立连接超时（秒）
+}
+
+_shared_httpx_clients: Dict[Tuple, Tuple['httpx.AsyncClient', int]] = {}
+
+
+def resolve_http_config(config: Dict[str, Any] = None) -> Dict[str, Any]:
+    """将Endpoint配置中的http字段与默认值合并，未知字段直接报错"""
+    config = config or {}
+    unknown = set(config) - set(DEFAULT_HTTP_CONFIG)
+    if unknown:
+        raise ValueError(f"Unknown http config keys: {', '.join(sorted(unknown))}")
+    return {**DEFAULT_HTTP_CONFIG, **config}
+
+
+def create_aiohttp_session(config: Dict[str, Any] = None) -> 'aiohttp.ClientSession':
+    """创建带连接池的aiohttp会话，必须在事件循环中调用"""
+    import aiohttp
+
+    config = resolve_http_config(config)
+    connector = aiohttp.TCPConnector(
+        limit=config["pool_size"],
+        limit_per_host=config["pool_size_per_host"],
+        keepalive_timeout=config["keepalive_timeout"],
+        ttl_dns_cache=config["dns_cache_ttl"],
+        use_dns_cache=True,
+    )
+    timeout = aiohttp.ClientTimeout(total=config["timeout"], sock_connect=config["connect_timeout"])
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+
+def acquire_httpx_client(api_base: str = None, config: Dict[str, Any] = None) -> 'httpx.AsyncClient':
+    """
+    获取当前事件循环中指向同一api_base、相同连接池配置的共享httpx客户端
+    连接池中的连接属于创建它们的事件循环，因此不同事件循环（例如多次asyncio.run）各自使用独立的客户端
+    每次获取都会增加引用计数，使用完毕后需调用release_httpx_client释放
+    """
+    config = resolve_http_config(config)
+    loop = _running_loop()
+    # 已关闭的事件循环上的客户端无法再使用，也无法关闭，直接丢弃
+    for stale in [key for key in _shared_httpx_clients if key[0] is not None and key[0].is_closed()]:
+        del _shared_httpx_clients[stale]
+    key = (loop, api_base, tuple(sorted(config.items())))
+    if key in _shared_httpx_clients:
+        client, refs = _shared_httpx_clients[key]
+    else:
+        import httpx
+
+        client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=config["pool_size"],
+                                max_keepalive_connections=config["pool_size"],
+                                keepalive_expiry=config["keepalive_timeout"]),
+            timeout=httpx.Timeout(config["timeout"], connect=config["connect_timeout"]),
+            follow_redirects=True,
+        )
+        refs = 0
+        logger.debug(f"Shared httpx client created for {api_base or 'default api base'}")
+    _shared_httpx_clients[key] = (client, refs + 1)
+    return client
+
+
+def _running_loop() -> asyncio.AbstractEventLoop | None:
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+
+async def release_httpx_client(client: 'httpx.AsyncClient') -> None:
+    """释放共享httpx客户端，引用计数归零时关闭连接池"""
+    for key, (shared, refs) in list(_shared_httpx_clients.items()):
+        if shared is client:
+            if refs > 1:
+                _shared_httpx_clients[key] = (shared, refs - 1)
+                return
+            del _shared_httpx_clients[key]
+            break
+    else:
+        # 所属的事件循环已关闭，客户端已被丢弃
+        return
+    if not client.is_closed:
+        await client.aclose()
@@ -0,0 +1,224 @@
+import json
+import re
+import time
+from typing import Any, AsyncIterator, List, Tuple
+
+from .Tracing import NOOP_SPAN
+
+# 值内部只需关心字符串边界与括号，其余字符整段跳过
+_STRUCTURE = re.compile(r'["{}\[\]]')
+_STRING_END = re.compile(r'["\\]')
+_SCALAR_END = re.compile(r'[\s,}\]]')
+_WHITESPACE = re.compile(r'\s*')
+
+
+class IncrementalJSONParser:
+    def __init__(self):
+        """
+        增量解析顶层为对象或数组的JSON文本
+        每当一个顶层字段或数组元素结束，立即解析该元素并返回，已解析的部分从缓冲区中移除
+        尚未结束的元素以文本块列表保存，新到达的文本块只扫描一次，元素结束时才拼接，因此每个字符只被扫描和复制常数次
+        第一个{或[之前的内容（例如```json代码块标记）以及结束之后的内容会被忽略
+        """
+        self.buffer = ""
+        self.position = 0
+        self.state = "root"
+        self.value = None
+        self.key = None
+        self.done = False
+        # 当前顶层元素的文本块（第一块从元素开头开始）、嵌套深度、是否在字符串中、
+        # 上一块是否以转义符结尾以及最后一块中下次继续扫描的位置
+        self.parts: List[str] = []
+        self.depth = 0
+        self.in_string = False
+        self.scalar = False
+        self.escape = False
+        self.scan = 0
+
+    def feed(self, text: str) -> List[Tuple[Any, Any]]:
+        """
+        输入一段文本，返回本次新完成的顶层元素：对象为(字段名, 值)，数组为(序号, 值)
+        JSON格式错误时抛出ValueError
+        """
+        if self.done or not text:
+            return []
+        if self.state == "in_value":
+            self.parts.append(text)
+            # 转义符后的字符在新的文本块开头，跳过它
+            self.scan, self.escape = int(self.escape), False
+        else:
+            self.buffer = self.buffer[self.position:] + text
+            self.position = 0
+        events = []
+        while not self.done:
+            if self.state == "in_value":
+                part = self.parts[-1]
+                end = self._scan_value(part)
+                if end < 0:
+                    break
+                self.parts[-1] = part[:end]
+                try:
+                    value = json.loads("".join(self.parts))
+                except ValueError as e:
+                    raise ValueError(f"Invalid JSON value: {e}") from e
+                if isinstance(self.value, dict):
+                    self.value[self.key] = value
+                    events.append((self.key, value))
+                else:
+                    events.append((len(self.value), value))
+                    self.value.append(value)
+                # 丢弃已解析的部分，缓冲区中只保留之后的文本
+                self.buffer = part[end:]
+                self.position = 0
+                self.parts = []
+                self.state = "after"
+                continue
+
+            i = _WHITESPACE.match(self.buffer, self.position).end()
+            if i >= len(self.buffer):
+                self.position = i
+                break
+            c = self.buffer[i]
+            if self.state == "root":
+                if c == "{":
+                    self.value, self.state = {}, "key"
+                elif c == "[":
+                    self.value, self.state = [], "value"
+                self.position = i + 1
+            elif self.state == "key":
+                if c == "}":
+                    self._finish()
+                    continue
+                if c != '"':
+                    raise ValueError(f"Expected a field name, got {c!r}")
+                end = self._string_end(i + 1)
+                if end < 0:
+                    self.position = i
+                    break
+                self.key = json.loads(self.buffer[i:end + 1])
+                self.position, self.state = end + 1, "colon"
+            elif self.state == "colon":
+                if c != ":":
+                    raise ValueError(f"Expected ':', got {c!r}")
+                self.position, self.state = i + 1, "value"
+            elif self.state == "value":
+                if c == "]" and isinstance(self.value, list):
+                    self._finish()
+                    continue
+                self.depth = 1 if c in "{[" else 0
+                self.in_string = c == '"'
+                self.scalar = c not in '{["'
+                self.parts = [self.buffer[i:]]
+                self.scan = 0 if self.scalar else 1
+                self.buffer = ""
+                self.position = 0
+                self.state = "in_value"
+            elif self.state == "after":
+                if c == ",":
+                    self.state = "key" if isinstance(self.value, dict) else "value"
+                elif c in "}]":
+                    self._finish()
+                    continue
+                else:
+                    raise ValueError(f"Expected ',' or end of JSON, got {c!r}")
+                self.position = i + 1
+        return events
+
+    def _finish(self):
+        self.done = True
+        self.buffer = ""
+        self.position = 0
+        self.parts = []
+
+    def _string_end(self, i: int) -> int:
+        """返回从i开始的字符串的结束引号位置，字符串尚未结束时返回-1"""
+        buffer = self.buffer
+        while match := _STRING_END.search(buffer, i):
+            i = match.start()
+            if buffer[i] == '"':
+                return i
+            i += 2
+        return -1
+
+    def _scan_value(self, buffer: str) -> int:
+        """从上次停下的位置继续扫描当前顶层元素的最后一个文本块，返回元素在该块中的结束位置（不含），尚未结束时返回-1"""
+        i = self.scan
+        if self.scalar:
+            match = _SCALAR_END.search(buffer, i)
+            if match is None:
+                self.scan = len(buffer)
+                return -1
+            return match.start()
+        while True:
+            match = (_STRING_END if self.in_string else _STRUCTURE).search(buffer, i)
+            if match is None:
+                self.scan = len(buffer)
+                return -1
+            i = match.start()
+            c = buffer[i]
+            if self.in_string:
+                if c == "\\":
+                    if i + 1 >= len(buffer):
+                        # 转义符后的字符尚未到达
+                        self.escape = True
+                        self.scan = len(buffer)
+                        return -1
+                    i += 2
+                    continue
+                self.in_string = False
+                if self.depth == 0:
+                    return i + 1
+            elif c == '"':
+                self.in_string = True
+            elif c in "{[":
+                self.depth += 1
+            else:
+                self.depth -= 1
+                if self.depth == 0:
+                    return i + 1
+            i += 1
+
+    def close(self) -> Any:
+        """输入结束后调用，返回解析得到的完整对象；JSON不完整时抛出ValueError"""
+        if not self.done:
+            raise ValueError("Incomplete JSON: the response ended before the top-level value was closed")
+        return self.value
+
+
+class JsonStream:
+    def __init__(self, chunks: AsyncIterator[str], trace_span=NOOP_SPAN):
+        """
+        将流式回复的文本块增量解析为JSON
+        异步迭代时逐个产出已完成的顶层元素：对象为(字段名, 值)，数组为(序号, 值)
+        迭代结束后value为完整的解析结果，也可以直接await collect()获取
+        :param trace_span: 被采样时，在其下记录一个parse子span，耗时为所有文本块的解析时间之和
+        """
+        self.chunks = chunks
+        self.parser = IncrementalJSONParser()
+        self.value = None
+        self.trace_span = trace_span
+
+    async def __aiter__(self) -> AsyncIterator[Tuple[Any, Any]]:
+        if not self.trace_span.sampled:
+            async for chunk in self.chunks:
+                for event in self.parser.feed(chunk):
+                    yield event
+            self.value = self.parser.close()
+            return
+
+        parse_time = 0.0
+        count = 0
+        async for chunk in self.chunks:
+            start = time.monotonic()
+            events = self.parser.feed(chunk)
+            parse_time += time.monotonic() - start
+            count += len(events)
+            for event in events:
+                yield event
+        self.value = self.parser.close()
+        self.trace_span.child("parse", start=time.monotonic() - parse_time).end(elements=count)
+
+    async def collect(self) -> Any:
+        async for _ in self:
+            pass
+        return self.value
@@ -0,0 +1,210 @@
+import bisect
+import math
+import time
+from collections import deque
+from typing import Any, Callable, Dict, Iterable, List, Tuple
+
+# 延迟类指标的默认分桶上界（秒）
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 60, 120, 300)
+# token数类指标的默认分桶上界
+TOKEN_BUCKETS = tuple(2 ** i for i in range(6, 18))
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "count", "sum", "max")
+
+    def __init__(self, buckets: Iterable[float] = LATENCY_BUCKETS):
+        """
+        固定分桶的直方图。记录一次观测只需一次二分查找，分位数按桶内线性插值估算
+        """
+        self.buckets = tuple(buckets)
+        # 最后一个桶对应+Inf
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q: float) -> float | None:
+        if not self.count:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            if count and cumulative + count >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.max
+                return min(lower + (upper - lower) * (rank - cumulative) / count, self.max)
+            cumulative += count
+        return self.max
+
+    def snapshot(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+        }
+
+
+class RateMeter:
+    __slots__ = ("window", "slots")
+
+    def __init__(self, window: int = 60):
+        """按秒分段累计，返回最近window秒内的平均每秒速率"""
+        self.window = window
+        self.slots: deque[List[float]] = deque()
+
+    def add(self, value: float, now: float = None):
+        second = int(now if now is not None else time.monotonic())
+        if self.slots and self.slots[-1][0] == second:
+            self.slots[-1][1] += value
+        else:
+            self.slots.append([second, value])
+            self._expire(second)
+
+    def _expire(self, second: int):
+        while self.slots and self.slots[0][0] <= second - self.window:
+            self.slots.popleft()
+
+    def rate(self, now: float = None) -> float:
+        self._expire(int(now if now is not None else time.monotonic()))
+        return sum(value for _, value in self.slots) / self.window
+
+
+def _labels_key(labels: Dict[str, str]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items())) if labels else ()
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + "}"
+
+
+def _label_string(labels: Labels) -> str:
+    # 快照中带标签的指标以"key=value,..."作为键
+    return ",".join(f"{key}={value}" for key, value in labels)
+
+
+class Metrics:
+    def __init__(self, namespace: str, **labels: str):
+        """
+        一组指标：计数器、直方图、速率以及在读取时计算的gauge
+        所有指标都在内存中累加，记录时不加锁、不分配大对象，开销可以忽略
+        :param namespace: 指标名前缀，例如aihub_endpoint
+        :param labels: 附加到所有指标的标签，例如endpoint="gpt-4"
+        """
+        self.namespace = namespace
+        self.labels = _labels_key(labels)
+        self.counters: Dict[str, Dict[Labels, float]] = {}
+        self.histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self.meters: Dict[str, RateMeter] = {}
+        self.gauges: Dict[str, Callable[[], float]] = {}
+
+    def inc(self, name: str, value: float = 1, **labels: str):
+        series = self.counters.setdefault(name, {})
+        key = _labels_key(labels)
+        series[key] = series.get(key, 0) + value
+        if (meter := self.meters.get(name)) is not None:
+            meter.add(value)
+
+    def observe(self, name: str, value: float, buckets: Iterable[float] = LATENCY_BUCKETS, **labels: str):
+        series = self.histograms.setdefault(name, {})
+        key = _labels_key(labels)
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = series[key] = Histogram(buckets)
+        histogram.observe(value)
+
+    def track_rate(self, name: str, window: int = 60):
+        """为计数器name额外记录最近window秒的每秒速率，在快照中以name_per_second给出"""
+        self.meters[name] = RateMeter(window)
+
+    def gauge(self, name: str, func: Callable[[], float]):
+        self.gauges[name] = func
+
+    def count(self, name: str, **labels: str) -> float:
+        return self.counters.get(name, {}).get(_labels_key(labels), 0)
+
+    def snapshot(self) -> dict:
+        result = {}
+        for name, series in self.counters.items():
+            result[name] = series.get((), 0) if list(series) == [()] else \
+                {_label_string(labels): value for labels, value in series.items()}
+        for name, meter in self.meters.items():
+            result[f"{name}_per_second"] = meter.rate()
+        for name, series in self.histograms.items():
+            result[name] = series[()].snapshot() if list(series) == [()] else \
+                {_label_string(labels): histogram.snapshot() for labels, histogram in series.items()}
+        for name, func in self.gauges.items():
+            result[name] = func()
+        return result
+
+    def samples(self) -> Iterable[Tuple[str, str, str, Labels, float]]:
+        """逐个返回(指标族名, 类型, 样本名, 标签, 值)"""
+        for name, series in self.counters.items():
+            family = f"{self.namespace}_{name}_total"
+            for labels, value in series.items():
+                yield family, "counter", family, self.labels + labels, value
+        for name, series in self.histograms.items():
+            family = f"{self.namespace}_{name}"
+            for labels, histogram in series.items():
+                labels = self.labels + labels
+                cumulative = 0
+                for bound, count in zip((*histogram.buckets, math.inf), histogram.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == math.inf else repr(float(bound))
+                    yield family, "histogram", f"{family}_bucket", labels + (("le", le),), cumulative
+                yield family, "histogram", f"{family}_sum", labels, histogram.sum
+                yield family, "histogram", f"{family}_count", labels, histogram.count
+        for name, func in self.gauges.items():
+            family = f"{self.namespace}_{name}"
+            value = func()
+            if value is not None:
+                yield family, "gauge", family, self.labels, value
+
+    def to_prometheus(self) -> str:
+        return export_prometheus(self)
+
+
+def export_prometheus(*sources) -> str:
+    """
+    将多个Metrics（或带metrics属性的对象，例如Endpoint、Dialogue、Expert）导出为Prometheus文本格式
+    同名指标合并为一个指标族，可以直接作为/metrics接口的响应内容
+    同一个Metrics只导出一次；前缀与标签都相同的不同来源（例如两个Expert）额外带上source标签以区分，
+    取值为来源的name属性，没有name或name重复时为该来源在参数中的序号
+    """
+    groups: Dict[Tuple[str, Labels], List[Tuple[int, Any, Metrics]]] = {}
+    exported = set()
+    for index, source in enumerate(sources):
+        metrics = source if isinstance(source, Metrics) else source.metrics
+        if id(metrics) in exported:
+            continue
+        exported.add(id(metrics))
+        groups.setdefault((metrics.namespace, metrics.labels), []).append((index, source, metrics))
+
+    families: Dict[str, Tuple[str, List[str]]] = {}
+    for group in groups.values():
+        names = [getattr(source, "name", None) for _, source, _ in group]
+        for (index, _, metrics), name in zip(group, names):
+            source_label = () if len(group) == 1 else \
+                (("source", name if isinstance(name, str) and names.count(name) == 1 else str(index)),)
+            for family, kind, sample, labels, value in metrics.samples():
+                families.setdefault(family, (kind, []))[1].append(
+                    f"{sample}{_format_labels(source_label + labels)} {float(value)!r}")
+    lines = []
+    for family, (kind, samples) in families.items():
+        lines.append(f"# TYPE {family} {kind}")
+        lines.extend(samples)
+    return "\n".join(lines) + "\n"
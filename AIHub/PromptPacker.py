@@ -0,0 +1,175 @@
+import asyncio
+import json
+from typing import Any, Dict, List
+
+from loguru import logger
+
+from .Endpoint import Endpoint
+from .EndpointPool import EndpointPool
+from .Metrics import Metrics
+from .RateLimiter import estimate_tokens
+
+PACK_PROMPT = ("下面的JSON数组中有{count}个相互独立的请求，请逐个完成，每个请求的回答不受其他请求影响。"
+               "以JSON对象回复，格式为{{\"answers\": [...]}}，answers中第i个元素为第i个请求的回答，类型为字符串，共{count}个。")
+
+# 只带有这些参数的请求才会被合并，其余参数（例如json_format、only_text、回调）可能改变回复的格式或含义
+PACKABLE_KWARGS = frozenset({"priority", "retry_count", "timeout", "trace_span"})
+
+
+class _PackedItem:
+    __slots__ = ("prompt", "future", "trace_span")
+
+    def __init__(self, prompt: str, future: asyncio.Future, trace_span):
+        self.prompt = prompt
+        self.future = future
+        self.trace_span = trace_span
+
+
+class _PendingBatch:
+    __slots__ = ("items", "tokens", "timer")
+
+    def __init__(self):
+        self.items: List[_PackedItem] = []
+        self.tokens = 0
+        self.timer: asyncio.TimerHandle | None = None
+
+
+class PromptPacker:
+    def __init__(self, endpoint: Endpoint | EndpointPool, max_batch_size: int = 10, window: float = 0.05,
+                 max_batch_tokens: int = 2000, max_item_tokens: int = 200, metrics: Metrics = None):
+        """
+        将短时间内到达的多个短提示词合并为一次请求，要求服务商以JSON数组依次回答，再将回答分发给各个调用方
+        适用于限流按请求数计算、而每个请求都很短的场景（例如分类、改写），合并后同样的请求数配额可以处理多倍的提示词
+        合并的请求以json_format发送；某一项的回答为空或格式错误时该提示词单独重新发送；
+        整个合并请求失败或回答数量与提示词数量不符（无法确定对应关系）时，所有提示词都单独重新发送
+        :param endpoint: 发送请求的Endpoint或EndpointPool
+        :param max_batch_size: 每次合并的最大提示词数，达到后立即发送
+        :param window: 第一个提示词到达后最多等待多久（秒）再发送
+        :param max_batch_tokens: 每次合并的提示词的token总数上限（按字符数估算），加入下一个提示词会超出时先发送已有的部分
+        :param max_item_tokens: 超过该token数的提示词不参与合并，直接单独发送
+        :param metrics: 记录packed_calls、packed_items与pack_fallbacks的Metrics，为空时创建新的
+        """
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be at least 1")
+        self.endpoint = endpoint
+        self.max_batch_size = max_batch_size
+        self.window = window
+        self.max_batch_tokens = max_batch_tokens
+        self.max_item_tokens = max_item_tokens
+        self.metrics = metrics if metrics is not None else Metrics("aihub_packer")
+        # 优先级和重试次数不同的请求分开合并
+        self.pending: Dict[tuple, _PendingBatch] = {}
+        self.tasks = set()
+
+    def accepts(self, prompt: str, kwargs: dict) -> bool:
+        return kwargs.keys() <= PACKABLE_KWARGS and estimate_tokens(prompt) <= self.max_item_tokens
+
+    async def submit(self, prompt: str, **kwargs) -> str:
+        """加入待合并的提示词，返回该提示词的回答。kwargs只能包含PACKABLE_KWARGS中的参数"""
+        timeout = kwargs.pop("timeout", None)
+        trace_span = kwargs.pop("trace_span", None)
+        key = (kwargs.get("priority", Endpoint.PRIORITY_BATCH), kwargs.get("retry_count", 1))
+        future = asyncio.get_event_loop().create_future()
+        tokens = estimate_tokens(prompt)
+
+        batch = self.pending.get(key)
+        if batch is not None and batch.tokens + tokens > self.max_batch_tokens:
+            self._flush(key)
+            batch = None
+        if batch is None:
+            batch = self.pending[key] = _PendingBatch()
+            batch.timer = asyncio.get_event_loop().call_later(self.window, self._flush, key)
+        batch.items.append(_PackedItem(prompt, future, trace_span))
+        batch.tokens += tokens
+        if len(batch.items) >= self.max_batch_size:
+            self._flush(key)
+
+        # 调用方取消或超时后future被取消，合并发送时跳过该项
+        return await (future if timeout is None else asyncio.wait_for(future, timeout))
+
+    def _flush(self, key: tuple):
+        batch = self.pending.pop(key, None)
+        if batch is None:
+            return
+        batch.timer.cancel()
+        task = asyncio.create_task(self._send(batch.items, *key))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _send(self, items: List[_PackedItem], priority: int, retry_count: int):
+        items = [item for item in items if not item.future.done()]
+        if len(items) == 1:
+            await self._send_single(items[0], priority, retry_count)
+            return
+        if not items:
+            return
+
+        prompts = json.dumps([item.prompt for item in items], ensure_ascii=False)
+        message = [{"role": "user", "content": f"{PACK_PROMPT.format(count=len(items))}\n\n{prompts}"}]
+        self.metrics.inc("packed_calls")
+        try:
+            response = await self.endpoint.send_message(message, retry_count=retry_count, priority=priority,
+                                                        json_format=True, only_text=True)
+            answers = self._parse_answers(response)
+        except Exception as e:
+            logger.warning(f"Packed request of {len(items)} prompts failed, sending them individually: {e}")
+            answers = []
+        if answers and len(answers) != len(items):
+            # 回答数量不符时无法确定哪个回答缺失或多余，按序号分配可能把回答错配给其他提示词
+            logger.warning(f"Packed request of {len(items)} prompts returned {len(answers)} answers, "
+                           f"sending them individually")
+            answers = []
+
+        retries = []
+        for i, item in enumerate(items):
+            answer = answers[i] if i < len(answers) else None
+            if isinstance(answer, str) and answer:
+                self.metrics.inc("packed_items")
+                if item.trace_span is not None:
+                    item.trace_span.set(packed=len(items))
+                if not item.future.done():
+                    item.future.set_result(answer)
+            else:
+                retries.append(item)
+        if retries:
+            self.metrics.inc("pack_fallbacks", len(retries))
+            await asyncio.gather(*(self._send_single(item, priority, retry_count) for item in retries))
+
+    @staticmethod
+    def _parse_answers(response: Any) -> list:
+        data = json.loads(response) if isinstance(response, str) else response
+        answers = data.get("answers") if isinstance(data, dict) else data
+        if not isinstance(answers, list):
+            raise ValueError("The response does not contain an answers array")
+        return answers
+
+    async def _send_single(self, item: _PackedItem, priority: int, retry_count: int):
+        if item.future.done():
+            return
+        kwargs = {"priority": priority}
+        if item.trace_span is not None:
+            kwargs["trace_span"] = item.trace_span
+        try:
+            response = await self.endpoint.send_message([{"role": "user", "content": item.prompt}],
+                                                        retry_count=retry_count, **kwargs)
+        except Exception as e:
+            if not item.future.done():
+                item.future.set_exception(e)
+            return
+        if not item.future.done():
+            item.future.set_result(response)
+
+    async def flush(self):
+        """立即发送所有等待中的提示词，并等待已发送的合并请求完成"""
+        for key in list(self.pending):
+            self._flush(key)
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    def get_status(self) -> dict:
+        return {
+            "pending": sum(len(batch.items) for batch in self.pending.values()),
+            "packed_calls": self.metrics.count("packed_calls"),
+            "packed_items": self.metrics.count("packed_items"),
+            "pack_fallbacks": self.metrics.count("pack_fallbacks"),
+        }
@@ -0,0 +1,142 @@
+import os
+import re
+import time
+from typing import Any, Dict, List
+
+from loguru import logger
+
+# \{{表示字面的{{，不作为占位符的开始
+PLACEHOLDER_PATTERN = re.compile(r"\\\{\{|\{\{(.*?)\}\}", re.S)
+PLACEHOLDER_NAME = re.compile(r"\w+")
+
+
+class PromptTemplate:
+    def __init__(self, name: str, template: str):
+        """
+        编译后的提示词模板。模板在创建时被拆分为文本片段与占位符交替的列表，渲染时只需一次join
+        占位符格式为{{name}}，name只能包含字母、数字、下划线或汉字，格式不正确时抛出ValueError
+        需要字面的{{时写作\{{，例如\{{name}}渲染为{{name}}
+        """
+        if not isinstance(template, str):
+            raise ValueError(f"Prompt '{name}' must be a string, got {type(template).__name__}")
+        self.name = name
+        self.template = template
+        # 偶数位置为文本片段，奇数位置为占位符名称
+        self.segments: List[str] = []
+        text = []
+        position = 0
+        for match in PLACEHOLDER_PATTERN.finditer(template):
+            text.append(template[position:match.start()])
+            position = match.end()
+            key = match.group(1)
+            if key is None:
+                text.append("{{")
+                continue
+            if not PLACEHOLDER_NAME.fullmatch(key):
+                raise ValueError(f"Prompt '{name}' has an invalid placeholder '{match.group(0)}'")
+            self.segments.append("".join(text))
+            self.segments.append(key)
+            text = []
+        text.append(template[position:])
+        self.segments.append("".join(text))
+        self.placeholders = frozenset(self.segments[1::2])
+
+    def render(self, values: Dict[str, Any] = None) -> str:
+        """
+        使用values中的值替换占位符
+        缺少占位符对应的值时抛出ValueError；values中多余的键会被忽略并记录警告
+        """
+        values = values or {}
+        missing = self.placeholders.difference(values)
+        if missing:
+            raise ValueError(f"Prompt '{self.name}' is missing values for placeholders: {sorted(missing)}")
+        if len(values) > len(self.placeholders):
+            logger.warning(f"Prompt '{self.name}' got unknown params: {sorted(set(values) - self.placeholders)}")
+        segments = self.segments.copy()
+        for i in range(1, len(segments), 2):
+            segments[i] = str(values[segments[i]])
+        return "".join(segments)
+
+
+def compile_prompts(prompts: Dict[str, str]) -> Dict[str, PromptTemplate]:
+    if not isinstance(prompts, dict):
+        raise ValueError("Prompts must be a mapping from prompt name to template")
+    return {name: PromptTemplate(name, template) for name, template in prompts.items()}
+
+
+class PromptLibrary:
+    def __init__(self, prompts: Dict[str, str] = None, path: str = None, reload_interval: float | None = 1.0):
+        """
+        一组编译后的提示词模板
+        从文件加载时，每隔reload_interval秒检查一次文件的修改时间，文件变化后自动重新加载
+        重新加载失败（文件不存在、YAML格式错误或模板不合法）时保留原有的提示词并记录错误
+        :param prompts: 提示词字典，指定时不从文件加载
+        :param path: 提示词yaml文件路径
+        :param reload_interval: 检查文件变化的最小间隔（秒），为None时不自动重新加载
+        """
+        self.path = None if prompts else path
+        self.reload_interval = reload_interval
+        self.mtime = None
+        self.checked_at = 0.0
+        self.templates: Dict[str, PromptTemplate] = {}
+        if prompts:
+            self.templates = compile_prompts(prompts)
+        elif path:
+            self.mtime = os.stat(path).st_mtime_ns
+            self.templates = self._load(path)
+            self.checked_at = time.monotonic()
+
+    @staticmethod
+    def _load(path: str) -> Dict[str, PromptTemplate]:
+        import yaml
+
+        with open(path, 'r', encoding='utf-8') as file:
+            return compile_prompts(yaml.safe_load(file) or {})
+
+    def reload(self, force: bool = False):
+        if self.path is None:
+            return
+        import yaml
+
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+            if not force and mtime == self.mtime:
+                return
+            # 先记录修改时间，加载失败时不会反复重试同一个文件版本
+            self.mtime = mtime
+            self.templates = self._load(self.path)
+            logger.info(f"Reloaded {len(self.templates)} prompts from {self.path}")
+        except (OSError, yaml.YAMLError, ValueError) as e:
+            logger.error(f"Failed to reload prompts from {self.path}: {e}")
+
+    def _maybe_reload(self):
+        if self.path is None or self.reload_interval is None:
+            return
+        now = time.monotonic()
+        if now - self.checked_at < self.reload_interval:
+            return
+        self.checked_at = now
+        self.reload()
+
+    def get(self, name: str) -> PromptTemplate:
+        self._maybe_reload()
+        template = self.templates.get(name)
+        if template is None:
+            raise ValueError(f"Prompt with name '{name}' not found")
+        return template
+
+    def render(self, name: str, values: Dict[str, Any] = None) -> str:
+        return self.get(name).render(values)
+
+    def __contains__(self, name: str) -> bool:
+        self._maybe_reload()
+        return name in self.templates
+
+    def __getitem__(self, name: str) -> str:
+        return self.get(name).template
+
+    def __iter__(self):
+        return iter(self.templates)
+
+    def __len__(self) -> int:
+        return len(self.templates)
@@ -0,0 +1,285 @@
+import asyncio
+import re
+import time
+from collections import deque
+from typing import Any, Dict, Optional
+
+from .SharedTokenBucket import ITokenBucket, create_shared_bucket
+
+_CJK_PATTERN = re.compile(r'[\u3000-\u9fff\uac00-\ud7af\uff00-\uffef]')
+
+
+def estimate_tokens(message: Any) -> int:
+    """
+    粗略估计消息的token数：中日韩字符按每字1个token计，其余字符按每4个字符1个token计
+    message可以是字符串、单条消息字典或消息列表
+    """
+    if not message:
+        return 0
+    if isinstance(message, str):
+        cjk = len(_CJK_PATTERN.findall(message))
+        return cjk + (len(message) - cjk + 3) // 4
+    if isinstance(message, dict):
+        return estimate_tokens(message.get("content")) + 4
+    if isinstance(message, (list, tuple)):
+        return sum(estimate_tokens(item) for item in message)
+    return estimate_tokens(str(message))
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = None):
+        """
+        令牌桶
+        :param rate: 每秒补充的令牌数
+        :param capacity: 桶容量，即无需等待即可连续消耗的最大令牌数。默认等于rate
+        """
+        if rate is None or rate <= 0:
+            raise ValueError("Rate must be positive")
+        self.rate = float(rate)
+        self.capacity = float(capacity) if capacity else self.rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def delay(self, amount: float, now: float = None) -> float:
+        """返回凑齐amount个令牌还需等待的秒数，不消耗令牌"""
+        self._refill(time.monotonic() if now is None else now)
+        deficit = amount - self.tokens
+        return deficit / self.rate if deficit > 0 else 0.0
+
+    def available(self, now: float = None) -> float:
+        """返回当前桶内的令牌数，透支时为负数"""
+        self._refill(time.monotonic() if now is None else now)
+        return self.tokens
+
+    def consume(self, amount: float):
+        """直接扣除令牌，允许透支，透支部分在后续补充中偿还"""
+        self.tokens -= amount
+
+    def refund(self, amount: float):
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+    def set_rate(self, rate: float, capacity: float):
+        self._refill(time.monotonic())
+        self.rate, self.capacity = rate, capacity
+        self.tokens = min(self.tokens, capacity)
+
+
+class RateLimiter:
+    def __init__(self, max_calls_per_second: float,
+                 max_tokens_per_minute: Optional[int] = None,
+                 burst: Optional[float] = None,
+                 name: str = None, shared: Dict[str, Any] = None):
+        """
+        基于令牌桶的限流器，同时支持每秒请求数与每分钟token数两种预算
+        有余量时不产生任何等待；余量不足时精确计算并等待到令牌补足的时刻
+        :param max_calls_per_second: 每秒最大请求数
+        :param max_tokens_per_minute: 每分钟最大token数，为空时不限制
+        :param burst: 请求数的突发容量，默认等于max_calls_per_second
+        :param name: 共享令牌桶的名称，相同名称的限流器共享配额
+        :param shared: 共享令牌桶的配置，例如{"backend": "mmap"}，为空时只在进程内限流
+        """
+        self.shared = shared
+        self.calls = self._create_bucket(f"{name}.calls", max_calls_per_second, burst)
+        self.tokens = self._create_bucket(f"{name}.tokens", max_tokens_per_minute / 60, max_tokens_per_minute) \
+            if max_tokens_per_minute else None
+        # 共享令牌桶的速率可能已被其他进程调整，上限以本进程的配置为准
+        self.max_rate = float(max_calls_per_second)
+        self.max_capacity = float(burst) if burst else self.max_rate
+        self.paused_until = 0.0
+
+    def _create_bucket(self, key: str, rate: float, capacity: float = None) -> ITokenBucket:
+        if self.shared is None:
+            return TokenBucket(rate, capacity)
+        return create_shared_bucket(key, rate, capacity, **self.shared)
+
+    @property
+    def tracks_tokens(self) -> bool:
+        return self.tokens is not None
+
+    @property
+    def rate(self) -> float:
+        return self.calls.rate
+
+    def set_rate(self, rate: float):
+        """调整每秒请求数，突发容量按比例缩放，且不超过初始配置"""
+        rate = min(max(rate, 1e-3), self.max_rate)
+        self.calls.set_rate(rate, max(1.0, self.max_capacity * rate / self.max_rate))
+
+    def pause(self, seconds: float):
+        """在接下来的seconds秒内暂停放行，用于遵守服务商返回的Retry-After"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def delay(self, tokens: int = 0) -> float:
+        now = time.monotonic()
+        wait = max(self.calls.delay(1, now), self.paused_until - now)
+        if self.tokens is not None and tokens:
+            # 单个请求超过桶容量时，只要求桶满即可放行，透支部分由后续请求偿还
+            wait = max(wait, self.tokens.delay(min(tokens, self.tokens.capacity), now))
+        return wait
+
+    def available_calls(self) -> float:
+        return self.calls.available()
+
+    def has_headroom(self, tokens: int = 0) -> bool:
+        return self.delay(tokens) <= 0
+
+    async def wait(self, tokens: int = 0) -> float:
+        """等待直到有足够的配额，但不消耗配额，返回等待的秒数"""
+        waited = 0.0
+        while (wait := self.delay(tokens)) > 0:
+            await asyncio.sleep(wait)
+            waited += wait
+        return waited
+
+    async def acquire(self, tokens: int = 0) -> float:
+        """
+        获取一次请求的配额，tokens为该请求预估消耗的token数
+        返回因限流而等待的秒数
+        """
+        waited = await self.wait(tokens)
+        self.calls.consume(1)
+        if self.tokens is not None and tokens:
+            self.tokens.consume(tokens)
+        return waited
+
+    def release(self, tokens: int = 0):
+        """归还一次已获取但未使用的配额"""
+        self.calls.refund(1)
+        if self.tokens is not None and tokens:
+            self.tokens.refund(tokens)
+
+    def record_usage(self, estimated: int, actual: int):
+        """请求完成后，用服务商返回的实际token数修正预估值"""
+        if self.tokens is None or actual is None:
+            return
+        diff = actual - estimated
+        if diff > 0:
+            self.tokens.consume(diff)
+        elif diff < 0:
+            self.tokens.refund(-diff)
+
+    def get_status(self) -> dict:
+        status = {"available_calls": round(self.calls.available(), 3)}
+        if self.tokens is not None:
+            status["available_tokens"] = int(self.tokens.available())
+        if self.shared is not None:
+            status["shared"] = self.shared.get("backend", "mmap")
+        return status
+
+    def close(self):
+        for bucket in (self.calls, self.tokens):
+            if hasattr(bucket, "close"):
+                bucket.close()
+
+
+class ConcurrencyLimiter:
+    def __init__(self, limit: Optional[int] = None):
+        """
+        可动态调整上限的并发限制器，limit为空时不限制
+        """
+        self.limit = limit
+        self.max_limit = limit
+        self.active = 0
+        self.waiters: deque[asyncio.Future] = deque()
+
+    def _wakeup(self):
+        while self.waiters and (self.limit is None or self.active < self.limit):
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
+    async def acquire(self):
+        while self.limit is not None and self.active >= self.limit:
+            waiter = asyncio.get_event_loop().create_future()
+            self.waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                waiter.cancel()
+                self._wakeup()
+                raise
+        self.active += 1
+
+    def release(self):
+        self.active -= 1
+        self._wakeup()
+
+    def set_limit(self, limit: int):
+        if self.max_limit is None:
+            return
+        self.limit = min(max(limit, 1), self.max_limit)
+        for _ in range(len(self.waiters)):
+            self._wakeup()
+
+
+class AdaptiveController:
+    def __init__(self, rate_limiter: RateLimiter, concurrency: ConcurrencyLimiter,
+                 decrease_factor: float = 0.5, increase_ratio: float = 0.05,
+                 latency_factor: float = None, min_rate: float = None, cooldown: float = 1.0):
+        """
+        AIMD(加性增、乘性减)速率控制器
+        遇到限流(429、Retry-After)时，按decrease_factor成倍降低速率和并发上限；请求成功时按increase_ratio逐步恢复，
+        但不会超过Endpoint配置的上限
+        :param decrease_factor: 每次降低时保留的比例
+        :param increase_ratio: 每次成功时速率增加量占配置上限的比例
+        :param latency_factor: 单次延迟超过长期平均延迟的该倍数时也视为拥塞，为空时不根据延迟降低速率
+            延迟主要取决于回复长度，较长的回复并不意味着服务商拥塞，因此默认关闭
+        :param min_rate: 速率下限，默认为配置上限的5%
+        :param cooldown: 两次降低之间的最小间隔（秒），避免同一批失败的请求使速率连续下降
+        """
+        self.rate_limiter = rate_limiter
+        self.concurrency = concurrency
+        self.decrease_factor = decrease_factor
+        self.increase_ratio = increase_ratio
+        self.latency_factor = latency_factor
+        self.min_rate = min_rate if min_rate is not None else rate_limiter.max_rate * 0.05
+        self.cooldown = cooldown
+        self.baseline_latency: Optional[float] = None
+        self.last_decrease = 0.0
+        self.throttled_count = 0
+
+    def _decrease(self):
+        now = time.monotonic()
+        if now - self.last_decrease < self.cooldown:
+            return
+        self.last_decrease = now
+        self.rate_limiter.set_rate(max(self.min_rate, self.rate_limiter.rate * self.decrease_factor))
+        if self.concurrency.limit is not None:
+            self.concurrency.set_limit(int(self.concurrency.limit * self.decrease_factor))
+
+    def _is_congested(self, latency: float) -> bool:
+        # 单次延迟显著高于长期平均延迟，视为服务商拥塞的前兆
+        if self.baseline_latency is None:
+            self.baseline_latency = latency
+            return False
+        congested = latency > self.baseline_latency * self.latency_factor
+        self.baseline_latency += 0.05 * (latency - self.baseline_latency)
+        return congested
+
+    def on_success(self, latency: float = None):
+        if self.latency_factor is not None and latency is not None and self._is_congested(latency):
+            self._decrease()
+            return
+        if self.rate_limiter.rate < self.rate_limiter.max_rate:
+            self.rate_limiter.set_rate(self.rate_limiter.rate + self.rate_limiter.max_rate * self.increase_ratio)
+        if self.concurrency.limit is not None and self.concurrency.limit < self.concurrency.max_limit:
+            self.concurrency.set_limit(self.concurrency.limit + 1)
+
+    def on_throttled(self, retry_after: Optional[float] = None):
+        self.throttled_count += 1
+        if retry_after:
+            self.rate_limiter.pause(retry_after)
+        self._decrease()
+
+    def get_status(self) -> dict:
+        return {
+            "rate": round(self.rate_limiter.rate, 3),
+            "max_concurrency": self.concurrency.limit,
+            "throttled": self.throttled_count,
+        }
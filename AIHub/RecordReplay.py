@@ -0,0 +1,183 @@
+import asyncio
+import hashlib
+import json
+import mmap
+import os
+import time
+from typing import Any, AsyncIterator, Dict, List
+
+from loguru import logger
+
+from .ResponseCache import key_kwargs
+
+# 每条记录占一行：64位十六进制的请求哈希、制表符、紧凑的JSON
+HASH_LENGTH = 64
+
+
+def request_hash(message: Any, kwargs: Dict[str, Any], stream: bool) -> str:
+    """根据消息、影响回复的参数以及是否流式计算请求哈希，不包含服务商与模型，因此一个文件只应记录一个模型的流量"""
+    payload = {
+        "stream": stream,
+        "message": message,
+        "kwargs": key_kwargs(kwargs),
+    }
+    canonical = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class ReplayMissError(LookupError):
+    def __init__(self, key: str, path: str):
+        super().__init__(f"No recorded response for request {key[:12]} in {path}")
+        self.key = key
+
+
+class RecordingSender:
+    def __init__(self, sender, record_path: str, **kwargs):
+        """
+        包装真实的发送器，将每个成功的请求与回复以及耗时追加写入record_path
+        写入失败的请求不会被记录，流式请求只在完整输出后才被记录
+        :param sender: 实际发送请求的发送器
+        :param record_path: 记录文件路径，文件已存在时在末尾追加
+        """
+        if not record_path:
+            raise ValueError("Record path cannot be empty")
+        self.sender = sender
+        self.record_path = record_path
+        self.file = open(record_path, 'a', encoding='utf-8')
+        self.recorded = 0
+
+    def _write(self, key: str, record: dict):
+        # 整行一次写入并立即刷新，进程中断时文件中只会缺少最后一条，不会出现半条记录
+        line = json.dumps(record, ensure_ascii=False, separators=(",", ":"), default=str)
+        self.file.write(f"{key}\t{line}\n")
+        self.file.flush()
+        self.recorded += 1
+
+    @staticmethod
+    def _capture_usage(kwargs: dict, usage: list) -> dict:
+        callback = kwargs.get("usage_callback")
+
+        def on_usage(prompt_tokens: int, completion_tokens: int):
+            usage[:] = [prompt_tokens, completion_tokens]
+            if callback:
+                callback(prompt_tokens, completion_tokens)
+
+        return {**kwargs, "usage_callback": on_usage}
+
+    async def send_message(self, message: Any, **kwargs) -> Any:
+        usage = []
+        start = time.monotonic()
+        response = await self.sender.send_message(message, **self._capture_usage(kwargs, usage))
+        self._write(request_hash(message, kwargs, False),
+                    {"latency": round(time.monotonic() - start, 4), "usage": usage or None, "response": response})
+        return response
+
+    async def stream_message(self, message: Any, **kwargs) -> AsyncIterator[Any]:
+        usage, chunks = [], []
+        start = time.monotonic()
+        async for chunk in self.sender.stream_message(message, **self._capture_usage(kwargs, usage)):
+            # 记录每块相对请求开始的时间，回放时可以还原首块延迟与块间间隔
+            chunks.append([round(time.monotonic() - start, 4), chunk])
+            yield chunk
+        self._write(request_hash(message, kwargs, True),
+                    {"latency": round(time.monotonic() - start, 4), "usage": usage or None, "chunks": chunks})
+
+    async def close(self) -> None:
+        self.file.close()
+        await self.sender.close()
+
+
+class ReplaySender:
+    def __init__(self, record_path: str, replay_latency: bool = False, latency_scale: float = 1.0, **kwargs):
+        """
+        从RecordingSender写入的文件中按请求哈希返回记录的回复，不访问任何服务商
+        文件以只读方式映射到内存，创建时只扫描一遍建立 哈希->偏移 的索引，记录在第一次命中时才被解析
+        同一请求有多条记录时按记录顺序轮流返回
+        :param record_path: 记录文件路径
+        :param replay_latency: 是否按记录的耗时等待后再返回，流式请求同时还原每块的间隔
+        :param latency_scale: 还原耗时的缩放比例，例如0.5表示以两倍速度回放
+        """
+        if not record_path:
+            raise ValueError("Record path cannot be empty")
+        self.record_path = record_path
+        self.replay_latency = replay_latency
+        self.latency_scale = latency_scale
+        self.offsets: Dict[str, List[int]] = {}
+        self.records: Dict[int, dict] = {}
+        self.cursors: Dict[str, int] = {}
+        self.hits = 0
+        self.misses = 0
+        self.file = open(record_path, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        # 空文件无法映射
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        self._build_index()
+        logger.debug(f"Loaded {sum(map(len, self.offsets.values()))} recorded responses from {record_path}")
+
+    def _build_index(self):
+        data, position = self.data, 0
+        while position < len(data):
+            end = data.find(b"\n", position)
+            if end < 0:
+                # 最后一行不完整，说明记录时被中断
+                logger.warning(f"Ignoring truncated record at offset {position} in {self.record_path}")
+                break
+            if end - position > HASH_LENGTH and data[position + HASH_LENGTH:position + HASH_LENGTH + 1] == b"\t":
+                key = data[position:position + HASH_LENGTH].decode("ascii")
+                self.offsets.setdefault(key, []).append(position + HASH_LENGTH + 1)
+            position = end + 1
+
+    def _lookup(self, message: Any, kwargs: dict, stream: bool) -> dict:
+        key = request_hash(message, kwargs, stream)
+        offsets = self.offsets.get(key)
+        if not offsets:
+            self.misses += 1
+            raise ReplayMissError(key, self.record_path)
+        self.hits += 1
+        cursor = self.cursors.get(key, 0)
+        self.cursors[key] = (cursor + 1) % len(offsets)
+        offset = offsets[cursor]
+        record = self.records.get(offset)
+        if record is None:
+            record = self.records[offset] = json.loads(self.data[offset:self.data.find(b"\n", offset)])
+        return record
+
+    @staticmethod
+    def _report_usage(record: dict, kwargs: dict):
+        if not record.get("usage"):
+            return
+        prompt_tokens, completion_tokens = record["usage"]
+        if get_token := kwargs.get("get_token_callback", None):
+            get_token(prompt_tokens + completion_tokens)
+        if on_usage := kwargs.get("usage_callback", None):
+            on_usage(prompt_tokens, completion_tokens)
+
+    async def send_message(self, message: Any, **kwargs) -> Any:
+        record = self._lookup(message, kwargs, False)
+        if self.replay_latency:
+            await asyncio.sleep(record["latency"] * self.latency_scale)
+        self._report_usage(record, kwargs)
+        return record["response"]
+
+    async def stream_message(self, message: Any, **kwargs) -> AsyncIterator[Any]:
+        record = self._lookup(message, kwargs, True)
+        start = time.monotonic()
+        for offset, chunk in record["chunks"]:
+            if self.replay_latency:
+                delay = start + offset * self.latency_scale - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            yield chunk
+        self._report_usage(record, kwargs)
+
+    async def close(self) -> None:
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.file.close()
+
+    def get_status(self) -> dict:
+        return {
+            "requests": len(self.offsets),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
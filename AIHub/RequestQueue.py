@@ -0,0 +1,160 @@
+import asyncio
+import heapq
+import itertools
+import time
+from collections import deque
+from typing import Any, List, Tuple
+
+QUEUED, TAKEN, REMOVED = range(3)
+
+
+class QueueEntry:
+    __slots__ = ("priority", "seq", "deadline", "future", "item", "state")
+
+    def __init__(self, priority: int, seq: int, deadline: float | None, future: asyncio.Future, item: Any):
+        self.priority = priority
+        self.seq = seq
+        self.deadline = deadline
+        self.future = future
+        self.item = item
+        self.state = QUEUED
+
+    def __lt__(self, other: 'QueueEntry') -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+    def expired(self, now: float) -> bool:
+        return self.deadline is not None and now >= self.deadline
+
+
+class RequestQueue:
+    FULL_POLICIES = ("block", "reject")
+
+    def __init__(self, maxsize: int = 0, full_policy: str = "block"):
+        """
+        有界优先级队列。priority越小越先出队，相同优先级按入队顺序出队
+        每个请求都关联调用方等待的future：future被取消时请求立即出队并让出容量，不会再被取出处理；
+        过期的请求在出队时被丢弃，其future被设置为asyncio.TimeoutError
+        :param maxsize: 队列最大长度，0表示不限制
+        :param full_policy: 队列已满时的行为。block：等待直到有空位；reject：立即抛出asyncio.QueueFull
+        """
+        if full_policy not in self.FULL_POLICIES:
+            raise ValueError(f"Unsupported queue full policy: {full_policy}")
+        self.maxsize = maxsize
+        self.full_policy = full_policy
+        self.heap: List[QueueEntry] = []
+        self.size = 0
+        self.unfinished = 0
+        self.counter = itertools.count()
+        self.getters: deque[asyncio.Future] = deque()
+        self.putters: deque[asyncio.Future] = deque()
+        self.finished = asyncio.Event()
+        self.finished.set()
+        self.expired_count = 0
+        self.cancelled_count = 0
+        self.rejected_count = 0
+
+    def qsize(self) -> int:
+        return self.size
+
+    def full(self) -> bool:
+        return 0 < self.maxsize <= self.size
+
+    @staticmethod
+    def _wakeup_next(waiters: deque):
+        while waiters:
+            waiter = waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+
+    async def put(self, future: asyncio.Future, item: Any, priority: int = 0, timeout: float = None):
+        """
+        放入一个请求
+        :param future: 调用方等待的future
+        :param item: 请求内容
+        :param priority: 优先级，越小越先出队
+        :param timeout: 请求的有效期（秒），过期后尚未出队的请求会被丢弃
+        """
+        while self.full():
+            if self.full_policy == "reject":
+                self.rejected_count += 1
+                raise asyncio.QueueFull()
+            putter = asyncio.get_event_loop().create_future()
+            self.putters.append(putter)
+            try:
+                await putter
+            except asyncio.CancelledError:
+                putter.cancel()
+                if not self.full():
+                    self._wakeup_next(self.putters)
+                raise
+
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        entry = QueueEntry(priority, next(self.counter), deadline, future, item)
+        heapq.heappush(self.heap, entry)
+        self.size += 1
+        self.unfinished += 1
+        self.finished.clear()
+        future.add_done_callback(lambda _: self._discard(entry))
+        self._wakeup_next(self.getters)
+
+    async def get(self) -> Tuple[asyncio.Future, Any]:
+        """取出优先级最高且未过期的请求，返回(future, item)"""
+        while True:
+            while not self.heap:
+                getter = asyncio.get_event_loop().create_future()
+                self.getters.append(getter)
+                try:
+                    await getter
+                except asyncio.CancelledError:
+                    getter.cancel()
+                    if self.heap:
+                        self._wakeup_next(self.getters)
+                    raise
+            entry = heapq.heappop(self.heap)
+            if entry.state == REMOVED:
+                continue
+            entry.state = TAKEN
+            self.size -= 1
+            self._wakeup_next(self.putters)
+            if entry.expired(time.monotonic()):
+                self.expired_count += 1
+                self.task_done()
+                if not entry.future.done():
+                    entry.future.set_exception(asyncio.TimeoutError("Request expired while waiting in queue"))
+                continue
+            return entry.future, entry.item
+
+    def _discard(self, entry: QueueEntry):
+        # 移除尚未出队的请求，已经出队的请求不受影响
+        if entry.state != QUEUED:
+            return
+        entry.state = REMOVED
+        self.size -= 1
+        self.cancelled_count += 1
+        # 被移除的请求延迟到出队时才从堆中清除，堆中残留过多时整体重建
+        if len(self.heap) > 2 * self.size + 64:
+            self.heap = [item for item in self.heap if item.state == QUEUED]
+            heapq.heapify(self.heap)
+        self.task_done()
+        self._wakeup_next(self.putters)
+
+    def task_done(self):
+        if self.unfinished <= 0:
+            raise ValueError("task_done() called too many times")
+        self.unfinished -= 1
+        if self.unfinished == 0:
+            self.finished.set()
+
+    async def join(self):
+        if self.unfinished > 0:
+            await self.finished.wait()
+
+    def get_status(self) -> dict:
+        return {
+            "size": self.size,
+            "maxsize": self.maxsize,
+            "expired": self.expired_count,
+            "cancelled": self.cancelled_count,
+            "rejected": self.rejected_count,
+        }
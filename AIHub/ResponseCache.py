@@ -0,0 +1,168 @@
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from loguru import logger
+
+# 会影响回复内容的参数及其在Endpoint中的默认值，参与缓存键的计算
+CACHE_KEY_KWARGS = {"system_prompt": None, "json_format": False, "only_text": True}
+
+_MISSING = object()
+
+
+def key_kwargs(kwargs: Dict[str, Any]) -> Dict[str, Any]:
+    """取出影响回复的参数，未传入的参数按默认值计入，省略only_text与显式传入only_text=True得到相同的结果"""
+    return {k: kwargs.get(k, default) for k, default in CACHE_KEY_KWARGS.items()}
+
+
+def make_cache_key(provider: str, model: Optional[str], message: Any, kwargs: Dict[str, Any]) -> str:
+    """根据服务商、模型、消息及影响回复的参数计算规范化的哈希值"""
+    payload = {
+        "provider": provider,
+        "model": model,
+        "message": message,
+        "kwargs": key_kwargs(kwargs),
+    }
+    canonical = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class MemoryCache:
+    def __init__(self, max_entries: int = 1024, ttl: float = None):
+        """
+        带过期时间的LRU内存缓存
+        :param max_entries: 最大缓存条数，超出时淘汰最久未使用的条目
+        :param ttl: 条目有效期（秒），为空时永不过期
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries: OrderedDict[str, Tuple[float, Any]] = OrderedDict()
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: str) -> Any:
+        item = self.entries.get(key)
+        if item is None:
+            return _MISSING
+        created, value = item
+        if self.ttl is not None and time.time() - created > self.ttl:
+            del self.entries[key]
+            self.expirations += 1
+            return _MISSING
+        self.entries.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: Any, created: float = None):
+        self.entries[key] = (time.time() if created is None else created, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class DiskCache:
+    def __init__(self, path: str, ttl: float = None):
+        """
+        基于SQLite的持久化缓存，进程重启后依然有效
+        所有读写都在线程池中执行，不会阻塞事件循环
+        """
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, created REAL, value TEXT)")
+            self.conn.commit()
+
+    def _get(self, key: str) -> Tuple[float, Any]:
+        with self.lock:
+            row = self.conn.execute("SELECT created, value FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return 0.0, _MISSING
+            created, value = row
+            if self.ttl is not None and time.time() - created > self.ttl:
+                self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.conn.commit()
+                return 0.0, _MISSING
+        return created, json.loads(value)
+
+    def _set(self, key: str, value: Any):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO responses (key, created, value) VALUES (?, ?, ?)",
+                              (key, time.time(), json.dumps(value, ensure_ascii=False)))
+            self.conn.commit()
+
+    async def get(self, key: str) -> Tuple[float, Any]:
+        return await asyncio.to_thread(self._get, key)
+
+    async def set(self, key: str, value: Any):
+        await asyncio.to_thread(self._set, key, value)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class ResponseCache:
+    def __init__(self, max_entries: int = 1024, ttl: float = 3600, path: str = None):
+        """
+        Endpoint的回复缓存，由内存LRU层和可选的SQLite持久层组成
+        :param max_entries: 内存层最大缓存条数
+        :param ttl: 缓存有效期（秒），为空时永不过期
+        :param path: SQLite文件路径，为空时只使用内存层
+        """
+        self.memory = MemoryCache(max_entries, ttl)
+        self.disk = DiskCache(path, ttl) if path else None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    async def get(self, key: str) -> Any:
+        """返回缓存的回复，未命中时返回None"""
+        value = self.memory.get(key)
+        if value is not _MISSING:
+            self.hits += 1
+            return value
+        if self.disk is not None:
+            created, value = await self.disk.get(key)
+            if value is not _MISSING:
+                self.hits += 1
+                self.disk_hits += 1
+                self.memory.set(key, value, created)
+                return value
+        self.misses += 1
+        return None
+
+    async def set(self, key: str, value: Any):
+        if value is None:
+            return
+        self.memory.set(key, value)
+        if self.disk is not None:
+            try:
+                await self.disk.set(key, value)
+            except (TypeError, ValueError, sqlite3.Error) as e:
+                logger.warning(f"Failed to persist cached response: {e}")
+
+    def close(self):
+        if self.disk is not None:
+            self.disk.close()
+
+    def get_status(self) -> dict:
+        return {
+            "entries": len(self.memory),
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.memory.evictions,
+            "expirations": self.memory.expirations,
+        }
@@ -0,0 +1,154 @@
+import mmap
+import os
+import re
+import struct
+import tempfile
+import time
+from typing import Callable, Dict, Protocol, runtime_checkable
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+@runtime_checkable
+class ITokenBucket(Protocol):
+    """
+    RateLimiter使用的令牌桶接口。共享后端（例如基于Redis的实现）实现该接口后通过register_bucket_backend注册即可
+    rate与capacity只通过set_rate修改，修改后对共享同一个桶的所有进程生效
+    """
+    rate: float
+    capacity: float
+
+    def delay(self, amount: float, now: float = None) -> float:
+        pass
+
+    def available(self, now: float = None) -> float:
+        pass
+
+    def consume(self, amount: float):
+        pass
+
+    def refund(self, amount: float):
+        pass
+
+    def set_rate(self, rate: float, capacity: float):
+        pass
+
+
+# 令牌数、上次补充时间、每秒补充的令牌数、桶容量
+_STATE = struct.Struct("<dddd")
+
+
+def _default_directory() -> str:
+    # 优先使用内存文件系统，重启后自动清空
+    return "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+
+class MmapTokenBucket:
+    def __init__(self, key: str, rate: float, capacity: float = None, path: str = None):
+        """
+        状态保存在内存映射文件中的令牌桶，同一台机器上以相同key创建的桶共享同一份配额
+        每次读写都在文件锁内完成，开销为两次flock系统调用，约几微秒
+        时间使用time.monotonic()，在同一台机器的所有进程间一致
+        :param key: 桶的名称，例如Endpoint的name
+        :param rate: 每秒补充的令牌数，仅在创建共享状态时生效，之后以共享状态为准
+        :param capacity: 桶容量，默认等于rate
+        :param path: 状态文件所在的目录，默认为/dev/shm或系统临时目录
+        """
+        if fcntl is None:
+            raise ValueError("Shared rate limiting requires fcntl, which is not available on this platform")
+        if rate is None or rate <= 0:
+            raise ValueError("Rate must be positive")
+        self.key = key
+        name = re.sub(r"[^\w.-]", "_", key)
+        self.path = os.path.join(path or _default_directory(), f"aihub-ratelimit-{name}.bin")
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        # 第一个进程负责初始化共享状态，文件锁保证其他进程不会看到未初始化的状态
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self.fd).st_size < _STATE.size:
+                os.ftruncate(self.fd, _STATE.size)
+            self.map = mmap.mmap(self.fd, _STATE.size)
+            if _STATE.unpack_from(self.map)[2] <= 0:
+                capacity = float(capacity) if capacity else float(rate)
+                _STATE.pack_into(self.map, 0, capacity, time.monotonic(), float(rate), capacity)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def _lock(self, now: float = None) -> list:
+        """加锁并补充令牌，返回[令牌数, 补充时间, 速率, 容量]，修改后必须调用_unlock写回并解锁"""
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        state = list(_STATE.unpack_from(self.map))
+        now = time.monotonic() if now is None else now
+        tokens, updated, rate, capacity = state
+        # 机器重启后monotonic时钟归零，此时以当前时间重新开始
+        if now > updated or updated - now > 1:
+            state[0] = min(capacity, tokens + max(0.0, now - updated) * rate)
+            state[1] = now
+        return state
+
+    def _unlock(self, state: list):
+        _STATE.pack_into(self.map, 0, *state)
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    @property
+    def rate(self) -> float:
+        return _STATE.unpack_from(self.map)[2]
+
+    @property
+    def capacity(self) -> float:
+        return _STATE.unpack_from(self.map)[3]
+
+    def delay(self, amount: float, now: float = None) -> float:
+        state = self._lock(now)
+        self._unlock(state)
+        deficit = amount - state[0]
+        return deficit / state[2] if deficit > 0 else 0.0
+
+    def available(self, now: float = None) -> float:
+        state = self._lock(now)
+        self._unlock(state)
+        return state[0]
+
+    def consume(self, amount: float):
+        # delay与consume之间其他进程可能已取走令牌，此时透支，由后续补充偿还，长期速率不受影响
+        state = self._lock()
+        state[0] -= amount
+        self._unlock(state)
+
+    def refund(self, amount: float):
+        state = self._lock()
+        state[0] = min(state[3], state[0] + amount)
+        self._unlock(state)
+
+    def set_rate(self, rate: float, capacity: float):
+        state = self._lock()
+        state[2], state[3] = rate, capacity
+        state[0] = min(state[0], capacity)
+        self._unlock(state)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+_bucket_backends: Dict[str, Callable[..., ITokenBucket]] = {"mmap": MmapTokenBucket}
+
+
+def register_bucket_backend(name: str, factory: Callable[..., ITokenBucket]):
+    """注册共享令牌桶后端，factory以(key, rate, capacity, **options)调用并返回实现了ITokenBucket的对象"""
+    _bucket_backends[name] = factory
+
+
+def create_shared_bucket(key: str, rate: float, capacity: float = None, backend: str = "mmap",
+                         **options) -> ITokenBucket:
+    factory = _bucket_backends.get(backend)
+    if factory is None:
+        raise ValueError(f"Unsupported rate limit backend: {backend}")
+    return factory(key, rate, capacity, **options)
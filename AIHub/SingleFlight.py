@@ -0,0 +1,49 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict
+
+
+class _Call:
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    def __init__(self):
+        """
+        合并同一时刻键相同的调用：第一个调用者发起实际请求，后续调用者共享其结果或异常
+        实际请求运行在独立的任务中，单个调用者取消不会影响其他调用者；所有调用者都取消后实际请求才被取消
+        """
+        self.calls: Dict[str, _Call] = {}
+        self.saved = 0
+
+    async def do(self, key: str, func: Callable[[], Awaitable[Any]]) -> Any:
+        call = self.calls.get(key)
+        if call is None:
+            call = _Call(asyncio.ensure_future(func()))
+            self.calls[key] = call
+            call.task.add_done_callback(lambda _: self._forget(key, call))
+        else:
+            self.saved += 1
+
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                # 最后一个调用者也已取消，此时立即移除，后续的调用者会发起新的请求
+                self._forget(key, call)
+                call.task.cancel()
+
+    def _forget(self, key: str, call: _Call):
+        if self.calls.get(key) is call:
+            del self.calls[key]
+
+    def get_status(self) -> dict:
+        return {
+            "saved_calls": self.saved,
+            "in_flight": len(self.calls),
+        }
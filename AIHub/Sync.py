@@ -0,0 +1,212 @@
+import asyncio
+import concurrent.futures
+import os
+import threading
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterable, Iterator, List, Tuple
+
+from loguru import logger
+
+from .Endpoint import Endpoint
+from .EndpointPool import EndpointPool
+from .Expert import Expert, BatchResult
+
+
+async def _next(iterator: AsyncIterator) -> Any:
+    return await iterator.__anext__()
+
+
+async def _call(func: Callable, *args) -> Any:
+    return func(*args)
+
+
+class BackgroundLoop:
+    def __init__(self, name: str = "aihub-loop"):
+        """
+        在独立的守护线程中运行的事件循环，供同步代码提交协程
+        所有Endpoint的状态只在该线程中访问，因此无需加锁，多个调用线程共享同一组连接池与限流器
+        """
+        self.name = name
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coroutine: Awaitable) -> concurrent.futures.Future:
+        """提交协程并立即返回concurrent.futures.Future，可在任意线程中调用"""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def run(self, coroutine: Awaitable, timeout: float = None) -> Any:
+        """提交协程并阻塞等待结果。在事件循环线程中调用会造成死锁，因此直接抛出RuntimeError"""
+        if threading.current_thread() is self.thread:
+            coroutine.close()
+            raise RuntimeError(f"Cannot block on {self.name} from its own thread, await the coroutine instead")
+        future = self.submit(coroutine)
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise
+
+    def call(self, func: Callable, *args) -> Any:
+        """在事件循环线程中执行同步函数并返回结果，用于读取只应在该线程中访问的状态"""
+        return self.run(_call(func, *args))
+
+    def iterate(self, iterator: AsyncIterator) -> Iterator:
+        """将异步迭代器转换为同步迭代器，每次取下一个元素都在事件循环线程中执行"""
+        try:
+            while True:
+                try:
+                    yield self.run(_next(iterator))
+                except StopAsyncIteration:
+                    return
+        finally:
+            # 调用方提前结束迭代时关闭异步生成器，释放其占用的队列项与限流配额
+            if hasattr(iterator, "aclose"):
+                self.run(iterator.aclose())
+
+    def stop(self):
+        if self.loop.is_closed():
+            return
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+_default_loop: BackgroundLoop | None = None
+_default_loop_pid: int | None = None
+_default_loop_lock = threading.Lock()
+
+
+def get_background_loop() -> BackgroundLoop:
+    """返回进程内共享的后台事件循环，第一次调用时启动；fork出的子进程中会重新启动"""
+    global _default_loop, _default_loop_pid
+    with _default_loop_lock:
+        # fork后子进程中只剩调用fork的线程，父进程的事件循环线程不再运行
+        if _default_loop is None or _default_loop_pid != os.getpid():
+            _default_loop = BackgroundLoop()
+            _default_loop_pid = os.getpid()
+            logger.debug(f"Started background event loop in process {_default_loop_pid}")
+        return _default_loop
+
+
+class SyncEndpoint:
+    def __init__(self, endpoint: Endpoint | EndpointPool = None, loop: BackgroundLoop = None, **kwargs):
+        """
+        Endpoint的同步封装，可以在任意线程中调用，所有请求都在同一个后台事件循环中执行
+        :param endpoint: 被封装的Endpoint或EndpointPool，为空时以kwargs创建Endpoint
+        :param loop: 执行请求的后台事件循环，默认使用进程内共享的事件循环
+        """
+        self.endpoint = endpoint if endpoint is not None else Endpoint(**kwargs)
+        self.loop = loop or get_background_loop()
+
+    @classmethod
+    def load_from_yaml(cls, file_path: str, loop: BackgroundLoop = None) -> 'SyncEndpoint':
+        return cls(Endpoint.load_from_yaml(file_path), loop)
+
+    @property
+    def name(self) -> str:
+        return self.endpoint.name
+
+    def send_message(self, message: Any, retry_count: int = 1, **kwargs) -> Any:
+        return self.loop.run(self.endpoint.send_message(message, retry_count=retry_count, **kwargs))
+
+    def send_message_future(self, message: Any, retry_count: int = 1, **kwargs) -> concurrent.futures.Future:
+        """立即返回concurrent.futures.Future，取消该Future会取消对应的请求"""
+        return self.loop.submit(self.endpoint.send_message(message, retry_count=retry_count, **kwargs))
+
+    def stream_message(self, message: Any, retry_count: int = 1, **kwargs) -> Iterator[Any]:
+        return self.loop.iterate(self.endpoint.stream_message(message, retry_count=retry_count, **kwargs))
+
+    def stream_json(self, message: Any, **kwargs) -> Iterator[Tuple[Any, Any]]:
+        return self.loop.iterate(self.endpoint.stream_json(message, **kwargs).__aiter__())
+
+    def get_status(self) -> dict:
+        return self.loop.call(self.endpoint.get_status)
+
+    def to_prometheus(self) -> str:
+        return self.loop.call(self.endpoint.to_prometheus)
+
+    def close(self):
+        self.loop.run(self.endpoint.close())
+
+    def __enter__(self) -> 'SyncEndpoint':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class SyncExpert:
+    def __init__(self, expert: Expert = None, loop: BackgroundLoop = None, **kwargs):
+        """
+        Expert的同步封装，可以在任意线程中调用，所有请求都在同一个后台事件循环中执行
+        :param expert: 被封装的Expert，为空时以kwargs创建Expert；kwargs中的endpoint可以是SyncEndpoint
+        :param loop: 执行请求的后台事件循环，默认与SyncEndpoint相同，否则使用进程内共享的事件循环
+        """
+        if expert is None:
+            endpoint = kwargs.get("endpoint")
+            if isinstance(endpoint, SyncEndpoint):
+                kwargs["endpoint"] = endpoint.endpoint
+                loop = loop or endpoint.loop
+            expert = Expert(**kwargs)
+        self.expert = expert
+        self.loop = loop or get_background_loop()
+
+    def get_answer(self, message: str = None, prompt_type: str = None,
+                   prompt_params: Dict[str, str] = None, **kwargs) -> str:
+        return self.loop.run(self.expert.get_answer(message, prompt_type, prompt_params, **kwargs))
+
+    def get_answer_future(self, message: str = None, prompt_type: str = None,
+                          prompt_params: Dict[str, str] = None, **kwargs) -> concurrent.futures.Future:
+        return self.loop.submit(self.expert.get_answer(message, prompt_type, prompt_params, **kwargs))
+
+    def communicate(self, message: str = None, prompt_type: str = None,
+                    prompt_params: Dict[str, str] = None, **kwargs) -> str:
+        return self.loop.run(self.expert.communicate(message, prompt_type, prompt_params, **kwargs))
+
+    def communicate_future(self, message: str = None, prompt_type: str = None,
+                           prompt_params: Dict[str, str] = None, **kwargs) -> concurrent.futures.Future:
+        """同一对话中的请求在Dialogue内依次执行，多次提交时按提交顺序加入上下文"""
+        return self.loop.submit(self.expert.communicate(message, prompt_type, prompt_params, **kwargs))
+
+    def stream_answer(self, message: str = None, prompt_type: str = None,
+                      prompt_params: Dict[str, str] = None, **kwargs) -> Iterator[str]:
+        return self.loop.iterate(self.expert.stream_answer(message, prompt_type, prompt_params, **kwargs))
+
+    def stream_communicate(self, message: str = None, prompt_type: str = None,
+                           prompt_params: Dict[str, str] = None, **kwargs) -> Iterator[str]:
+        return self.loop.iterate(self.expert.stream_communicate(message, prompt_type, prompt_params, **kwargs))
+
+    def get_json(self, message: str = None, prompt_type: str = None,
+                 prompt_params: Dict[str, str] = None, **kwargs) -> Any:
+        return self.loop.run(self.expert.get_json(message, prompt_type, prompt_params, **kwargs))
+
+    def stream_json(self, message: str = None, prompt_type: str = None,
+                    prompt_params: Dict[str, str] = None, **kwargs) -> Iterator[Tuple[Any, Any]]:
+        """逐个返回已完成的顶层字段(字段名, 值)或数组元素(序号, 值)"""
+        return self.loop.iterate(self.expert.stream_json(message, prompt_type, prompt_params, **kwargs).__aiter__())
+
+    def get_answers_batch(self, params: Iterable[Dict[str, str]], prompt_type: str, **kwargs) -> Iterator[BatchResult]:
+        """
+        与Expert.get_answers_batch相同，逐个返回BatchResult
+        params在事件循环线程中读取，因此不应在迭代时执行阻塞的IO；progress_callback同样在事件循环线程中调用
+        """
+        return self.loop.iterate(self.expert.get_answers_batch(params, prompt_type, **kwargs))
+
+    def get_messages(self) -> List[Dict[str, str]]:
+        return self.loop.call(lambda: list(self.expert.dialogue.iter_messages()))
+
+    def fork(self, **kwargs) -> 'SyncExpert':
+        return SyncExpert(self.loop.call(lambda: self.expert.fork(**kwargs)), self.loop)
+
+    def restart_dialogue(self):
+        self.loop.call(self.expert.restart_dialogue)
+
+    def reload_prompts(self):
+        self.expert.reload_prompts()
+
+    def to_prometheus(self) -> str:
+        return self.loop.call(self.expert.to_prometheus)
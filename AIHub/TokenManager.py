@@ -0,0 +1,167 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from typing import Dict
+
+from loguru import logger
+
+from .SingleFlight import SingleFlight
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# 服务商未返回expires_in时使用的有效期（秒），百度的access token有效期为30天
+DEFAULT_EXPIRES_IN = 30 * 24 * 3600
+
+
+class AccessToken:
+    __slots__ = ("access_token", "obtained_at", "expires_at")
+
+    def __init__(self, access_token: str, obtained_at: float, expires_at: float):
+        self.access_token = access_token
+        self.obtained_at = obtained_at
+        self.expires_at = expires_at
+
+    def refresh_at(self, refresh_ratio: float) -> float:
+        return self.obtained_at + (self.expires_at - self.obtained_at) * refresh_ratio
+
+    def to_dict(self) -> dict:
+        return {"access_token": self.access_token, "obtained_at": self.obtained_at, "expires_at": self.expires_at}
+
+
+class AccessTokenManager:
+    def __init__(self, cache_path: str = None, refresh_ratio: float = 0.8):
+        """
+        管理百度的access token
+        同一组(api_base, api_key)同一时刻只有一个刷新请求，并发的请求共享其结果
+        有效期过了refresh_ratio后在后台提前刷新，期间继续使用旧的token；已过期或没有token时才等待刷新
+        指定cache_path时token同时保存在该文件中，同一台机器上的所有进程共享，刷新时以文件锁保证只有一个进程请求新token
+        :param cache_path: token缓存文件路径，为空时只在进程内缓存
+        :param refresh_ratio: 有效期过了多少比例后开始提前刷新
+        """
+        self.cache_path = cache_path
+        self.refresh_ratio = refresh_ratio
+        self.tokens: Dict[str, AccessToken] = {}
+        self.single_flight = SingleFlight()
+        self.tasks = set()
+        self.refreshes = 0
+        self.cache_loads = 0
+
+    @staticmethod
+    def _key(api_base: str, api_key: str) -> str:
+        # 缓存文件中不保存明文的api_key
+        return hashlib.sha256(f"{api_base}|{api_key}".encode("utf-8")).hexdigest()
+
+    def _read_cache(self) -> Dict[str, AccessToken]:
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as file:
+                data = json.load(file)
+            return {key: AccessToken(**value) for key, value in data.items()}
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError, TypeError) as e:
+            logger.warning(f"Ignoring unreadable access token cache {self.cache_path}: {e}")
+            return {}
+
+    def _write_cache(self, key: str, token: AccessToken):
+        tokens = self._read_cache()
+        tokens[key] = token
+        # 先写入临时文件再替换，读取方不需要加锁也不会读到写了一半的文件
+        temp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            json.dump({key: token.to_dict() for key, token in tokens.items()}, file)
+        os.replace(temp_path, self.cache_path)
+
+    def _lock(self):
+        file = open(f"{self.cache_path}.lock", 'a')
+        if fcntl is not None:
+            fcntl.flock(file, fcntl.LOCK_EX)
+        return file
+
+    async def get(self, session, api_base: str, api_key: str, secret_key: str) -> str:
+        key = self._key(api_base, api_key)
+        token = self.tokens.get(key)
+        if token is None and self.cache_path:
+            token = self._read_cache().get(key)
+            if token is not None:
+                self.cache_loads += 1
+                self.tokens[key] = token
+        now = time.time()
+        if token is None or now >= token.expires_at:
+            token = await self.single_flight.do(key, lambda: self._refresh(session, key, api_base, api_key, secret_key))
+        elif now >= token.refresh_at(self.refresh_ratio) and key not in self.single_flight.calls:
+            task = asyncio.create_task(self._refresh_in_background(session, key, api_base, api_key, secret_key))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        return token.access_token
+
+    async def _refresh_in_background(self, session, key: str, api_base: str, api_key: str, secret_key: str):
+        try:
+            await self.single_flight.do(key, lambda: self._refresh(session, key, api_base, api_key, secret_key))
+        except Exception as e:
+            # 旧的token仍然有效，下一次请求会再次尝试
+            logger.warning(f"Failed to refresh Baidu access token in background: {e}")
+
+    async def _refresh(self, session, key: str, api_base: str, api_key: str, secret_key: str) -> AccessToken:
+        lock = await asyncio.to_thread(self._lock) if self.cache_path else None
+        try:
+            if self.cache_path:
+                # 等待文件锁期间其他进程可能已经刷新过；与当前token相同说明文件中的也已失效
+                current = self.tokens.get(key)
+                token = self._read_cache().get(key)
+                if token is not None and time.time() < token.refresh_at(self.refresh_ratio) and \
+                        (current is None or token.access_token != current.access_token):
+                    self.cache_loads += 1
+                    self.tokens[key] = token
+                    return token
+            token = await self._fetch(session, api_base, api_key, secret_key)
+            self.tokens[key] = token
+            if self.cache_path:
+                self._write_cache(key, token)
+            return token
+        finally:
+            if lock is not None:
+                lock.close()
+
+    async def _fetch(self, session, api_base: str, api_key: str, secret_key: str) -> AccessToken:
+        url = f"{api_base}/oauth/2.0/token"
+        params = {"grant_type": "client_credentials", "client_id": api_key, "client_secret": secret_key}
+        async with session.post(url, params=params) as response:
+            response_json = await response.json(content_type=None)
+        if "access_token" not in response_json:
+            raise ValueError(f"Failed to get Baidu access token: "
+                             f"{response_json.get('error_description') or response_json.get('error')}")
+        now = time.time()
+        self.refreshes += 1
+        logger.debug("Baidu access token refreshed")
+        return AccessToken(response_json["access_token"], now, now + response_json.get("expires_in", DEFAULT_EXPIRES_IN))
+
+    def invalidate(self, api_base: str, api_key: str, access_token: str):
+        """服务商认为token无效时调用，只移除仍是该token的缓存，避免覆盖并发请求已经刷新的新token"""
+        key = self._key(api_base, api_key)
+        token = self.tokens.get(key)
+        if token is not None and token.access_token == access_token:
+            # 将过期时间设为现在，下一次get会同步刷新；文件缓存中的旧token在刷新时被覆盖
+            token.expires_at = token.obtained_at = time.time()
+
+    def get_status(self) -> dict:
+        return {
+            "tokens": len(self.tokens),
+            "refreshes": self.refreshes,
+            "cache_loads": self.cache_loads,
+        }
+
+
+_token_managers: Dict[str | None, AccessTokenManager] = {}
+
+
+def get_token_manager(cache_path: str = None) -> AccessTokenManager:
+    """返回进程内共享的token管理器，使用同一缓存文件（或都不使用缓存文件）的发送器共享同一个管理器"""
+    manager = _token_managers.get(cache_path)
+    if manager is None:
+        manager = _token_managers[cache_path] = AccessTokenManager(cache_path)
+    return manager
@@ -0,0 +1,189 @@
+import json
+import random
+import time
+from typing import Any, Callable, Dict, List, Protocol, runtime_checkable
+
+from loguru import logger
+
+
+class Span:
+    __slots__ = ("tracer", "name", "trace_id", "span_id", "parent_id", "start", "end_time", "fields", "error")
+
+    sampled = True
+
+    def __init__(self, tracer: 'Tracer', name: str, trace_id: int, parent_id: int | None,
+                 start: float = None, fields: Dict[str, Any] = None):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = random.getrandbits(64)
+        self.parent_id = parent_id
+        self.start = time.monotonic() if start is None else start
+        self.end_time = None
+        self.fields = fields or {}
+        self.error = None
+
+    def child(self, name: str, start: float = None, **fields) -> 'Span':
+        """创建子span；start为time.monotonic()时间，用于记录已经开始的阶段（例如排队）"""
+        return Span(self.tracer, name, self.trace_id, self.span_id, start, fields)
+
+    def set(self, **fields):
+        """记录字段。值可以是无参函数，只在导出时才被调用"""
+        self.fields.update(fields)
+
+    def end(self, error: BaseException = None, **fields):
+        if self.end_time is not None:
+            return
+        self.end_time = time.monotonic()
+        if fields:
+            self.fields.update(fields)
+        if error is not None:
+            self.error = error
+        self.tracer.export(self)
+
+    @property
+    def duration(self) -> float:
+        return (self.end_time if self.end_time is not None else time.monotonic()) - self.start
+
+    def __enter__(self) -> 'Span':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # 调用方提前结束流式迭代时异步生成器收到GeneratorExit，不视为错误
+        self.end(None if exc_type is GeneratorExit else exc_value)
+
+
+class _NoopSpan:
+    """未被采样的请求使用的span，所有方法都不做任何事，子span仍是它自己"""
+    __slots__ = ()
+
+    sampled = False
+
+    def child(self, name: str, start: float = None, **fields) -> '_NoopSpan':
+        return self
+
+    def set(self, **fields):
+        pass
+
+    def end(self, error: BaseException = None, **fields):
+        pass
+
+    def __enter__(self) -> '_NoopSpan':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+@runtime_checkable
+class ISpanExporter(Protocol):
+    def export(self, span: Dict[str, Any]) -> None:
+        pass
+
+
+class LoggerExporter:
+    def __init__(self, level: str = "DEBUG"):
+        """通过loguru输出每个结束的span"""
+        self.level = level
+
+    def export(self, span: Dict[str, Any]) -> None:
+        fields = " ".join(f"{key}={value}" for key, value in span["fields"].items())
+        error = f" error={span['error']}" if span["error"] else ""
+        logger.log(self.level, f"[trace {span['trace_id']}] {span['name']} {span['duration'] * 1000:.1f}ms{error} {fields}")
+
+
+class MemoryExporter:
+    def __init__(self, max_spans: int = 10000):
+        """将结束的span保存在内存中，用于调试或在测试中检查"""
+        self.max_spans = max_spans
+        self.spans: List[Dict[str, Any]] = []
+
+    def export(self, span: Dict[str, Any]) -> None:
+        self.spans.append(span)
+        if len(self.spans) > self.max_spans:
+            del self.spans[:len(self.spans) - self.max_spans]
+
+
+class Tracer:
+    def __init__(self, sample_rate: float = 0.0, exporter: ISpanExporter = None, max_payload: int | None = 200,
+                 redact: Callable[[str, Any], Any] = None):
+        """
+        按请求采样的追踪器
+        是否采样在创建根span时决定，子span沿用根span的决定；未采样的请求只得到NOOP_SPAN，不记录任何字段，开销只有一次随机数比较
+        字段只保存引用，截断、脱敏与无参函数的求值都在span结束并导出时才进行
+        :param sample_rate: 采样比例，0表示关闭，1表示记录所有请求
+        :param exporter: 接收结束的span的导出器，默认为LoggerExporter
+        :param max_payload: 文本、消息等字段导出时的最大长度，超出部分被截断；为0时不导出这些字段，为None时不截断
+        :param redact: 脱敏函数，以(字段名, 值)调用并返回导出的值
+        """
+        self.sample_rate = sample_rate
+        self.exporter = exporter or LoggerExporter()
+        self.max_payload = max_payload
+        self.redact = redact
+
+    def configure(self, sample_rate: float = None, exporter: ISpanExporter = None, max_payload: int | None = ...,
+                  redact: Callable[[str, Any], Any] = ...):
+        """修改追踪器的配置，已经引用该追踪器的Endpoint、Dialogue、Expert立即生效"""
+        if sample_rate is not None:
+            self.sample_rate = sample_rate
+        if exporter is not None:
+            self.exporter = exporter
+        if max_payload is not ...:
+            self.max_payload = max_payload
+        if redact is not ...:
+            self.redact = redact
+
+    def start_span(self, name: str, parent: Span | _NoopSpan = None, **fields) -> Span | _NoopSpan:
+        """指定parent时创建其子span，否则按采样比例决定是否开始一个新的追踪"""
+        if parent is not None:
+            return parent.child(name, **fields)
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return NOOP_SPAN
+        return Span(self, name, random.getrandbits(64), None, fields=fields)
+
+    def _format(self, name: str, value: Any) -> Any:
+        if callable(value):
+            value = value()
+        if self.redact is not None:
+            value = self.redact(name, value)
+        if value is None or isinstance(value, (bool, int, float)):
+            return value
+        if self.max_payload == 0:
+            return None
+        text = value if isinstance(value, str) else json.dumps(value, ensure_ascii=False, default=str)
+        if self.max_payload is not None and len(text) > self.max_payload:
+            text = f"{text[:self.max_payload]}...(+{len(text) - self.max_payload} chars)"
+        return text
+
+    def export(self, span: Span):
+        try:
+            fields = {name: self._format(name, value) for name, value in span.fields.items()}
+            self.exporter.export({
+                "trace_id": f"{span.trace_id:016x}",
+                "span_id": f"{span.span_id:016x}",
+                "parent_id": f"{span.parent_id:016x}" if span.parent_id is not None else None,
+                "name": span.name,
+                "timestamp": time.time() - (time.monotonic() - span.start),
+                "duration": span.duration,
+                "error": repr(span.error) if span.error is not None else None,
+                "fields": {name: value for name, value in fields.items() if value is not None},
+            })
+        except Exception as e:
+            # 追踪不能影响请求本身
+            logger.warning(f"Failed to export span {span.name}: {e}")
+
+
+_default_tracer = Tracer()
+
+
+def get_tracer() -> Tracer:
+    """返回进程内共享的默认追踪器，未指定tracer的Endpoint、Dialogue、Expert都使用它"""
+    return _default_tracer
+
+
+def configure_tracing(sample_rate: float = None, exporter: ISpanExporter = None, max_payload: int | None = ...,
+                      redact: Callable[[str, Any], Any] = ...):
+    _default_tracer.configure(sample_rate, exporter, max_payload, redact)
@@ -1,5 +1,10 @@
 from .Endpoint import Endpoint
+from .EndpointPool import EndpointPool
 from .Dialogue import Dialogue
-from .Expert import Expert
+from .DialogueStore import DialogueStore
+from .Expert import Expert, BatchResult
+from .Sync import SyncEndpoint, SyncExpert
+from .Tracing import Tracer, configure_tracing, get_tracer
 
-__all__ = ['Dialogue', 'Endpoint', 'Expert']
+__all__ = ['BatchResult', 'Dialogue', 'DialogueStore', 'Endpoint', 'EndpointPool', 'Expert', 'SyncEndpoint', 'SyncExpert',
+           'Tracer', 'configure_tracing', 'get_tracer']
@@ -0,0 +1,36 @@
+import unittest
+
+from AIHub.RateLimiter import AdaptiveController, ConcurrencyLimiter, RateLimiter
+
+
+class AdaptiveControllerTest(unittest.TestCase):
+    def setUp(self):
+        self.rate_limiter = RateLimiter(10)
+        self.concurrency = ConcurrencyLimiter(8)
+        self.controller = AdaptiveController(self.rate_limiter, self.concurrency, cooldown=0)
+
+    def test_latency_variance_does_not_decrease_rate(self):
+        # 回复长度不同导致延迟相差十倍以上，但没有限流信号
+        for latency in [0.1, 2.0, 0.2, 5.0, 0.1, 3.0] * 10:
+            self.controller.on_success(latency)
+        self.assertEqual(self.rate_limiter.rate, 10)
+        self.assertEqual(self.concurrency.limit, 8)
+
+    def test_throttling_decreases_and_success_recovers(self):
+        self.controller.on_throttled()
+        self.assertEqual(self.rate_limiter.rate, 5)
+        self.assertEqual(self.concurrency.limit, 4)
+        for _ in range(20):
+            self.controller.on_success(0.1)
+        self.assertEqual(self.rate_limiter.rate, 10)
+        self.assertEqual(self.concurrency.limit, 8)
+
+    def test_latency_trigger_is_opt_in(self):
+        controller = AdaptiveController(self.rate_limiter, self.concurrency, latency_factor=2.0, cooldown=0)
+        controller.on_success(0.1)
+        controller.on_success(1.0)
+        self.assertEqual(self.rate_limiter.rate, 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,376 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import aiohttp
+from loguru import logger
+
+from AIHub import Endpoint, Expert, DialogueStore
+from FakeServer import DEFAULT_CONFIG, start_server
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+
+# 回归检查的方向：吞吐类指标不能明显下降，延迟与内存类指标不能明显上升
+HIGHER_IS_BETTER = {"throughput", "success_rate"}
+LOWER_IS_BETTER = {"p50", "p95", "p99", "ttft_p50", "ttft_p95", "peak_memory_mb"}
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def summarize(latencies: list, elapsed: float) -> dict:
+    return {
+        "throughput": len(latencies) / elapsed,
+        "p50": percentile(latencies, 0.5),
+        "p95": percentile(latencies, 0.95),
+        "p99": percentile(latencies, 0.99),
+    }
+
+
+class Bench:
+    def __init__(self, base_url: str, scale: float):
+        self.base_url = base_url
+        self.scale = scale
+        self.session: aiohttp.ClientSession | None = None
+        # 当前场景的参数（请求数量、限流速率以及模拟服务的配置），与结果一起写入基准
+        self.params: dict = {}
+
+    def count(self, n: int) -> int:
+        return max(1, int(n * self.scale))
+
+    async def configure(self, params: dict, **config):
+        self.params = {**params, "server": config}
+        # 每个场景都从默认配置开始，避免受到前一个场景的影响
+        async with self.session.post(f"{self.base_url}/config", json={**DEFAULT_CONFIG, **config}) as response:
+            response.raise_for_status()
+        async with self.session.post(f"{self.base_url}/reset") as response:
+            response.raise_for_status()
+
+    async def stats(self) -> dict:
+        async with self.session.get(f"{self.base_url}/stats") as response:
+            return await response.json()
+
+    async def endpoint(self, provider: str, name: str, **kwargs) -> Endpoint:
+        if provider == "openai":
+            endpoint = Endpoint(name=name, provider="openai", api_key="sk-benchmark", model="fake-model",
+                                api_base=f"{self.base_url}/v1", **kwargs)
+        else:
+            endpoint = Endpoint(name=name, provider="baidu", api_key="benchmark", secret_key="benchmark",
+                                api_base=self.base_url, **kwargs)
+        # 服务商SDK的导入与客户端的创建不计入压测时间
+        await endpoint.start()
+        return endpoint
+
+    @staticmethod
+    def rate_accuracy(stats: dict, rate: float) -> float | None:
+        """
+        服务端观测到的稳态请求速率与配置速率之比，越接近1越准确
+        请求在第一秒内就已全部到达（例如--scale较小）时没有稳态区间，返回None
+        """
+        if not stats["steady_rate"]:
+            return None
+        return stats["steady_rate"] / rate
+
+    async def burst(self) -> dict:
+        """大量请求同时到达，检查限流器放行的速率和排队延迟"""
+        rate, total = 200, self.count(1000)
+        await self.configure({"rate": rate, "total": total}, latency=0.05)
+        endpoint = await self.endpoint("baidu", "burst", max_calls_per_second=rate, adaptive_rate=False)
+        message = [{"role": "user", "content": "你好"}]
+
+        async def call() -> float:
+            start = time.monotonic()
+            await endpoint.send_message(message)
+            return time.monotonic() - start
+
+        start = time.monotonic()
+        latencies = await asyncio.gather(*(call() for _ in range(total)))
+        elapsed = time.monotonic() - start
+        await endpoint.close()
+        stats = await self.stats()
+        # 新的发送器同时收到大量请求，也只应请求一次access token
+        return summarize(latencies, elapsed) | {"rate_accuracy": self.rate_accuracy(stats, rate),
+                                                "server_throttled": stats["throttled"],
+                                                "token_requests": stats["token_requests"]}
+
+    async def sustained(self) -> dict:
+        """固定数量的并发调用方持续发送请求，服务端限流略高于客户端限流，不应出现429"""
+        rate, burst, workers, total = 100, 10, 50, self.count(800)
+        await self.configure({"rate": rate, "burst": burst, "workers": workers, "total": total},
+                             latency=0.1, max_rps=int(rate * 1.2))
+        # 留出少量突发容量，吸收事件循环调度带来的等待误差
+        endpoint = await self.endpoint("baidu", "sustained", max_calls_per_second=rate, rate_limit_burst=burst)
+        message = [{"role": "user", "content": "你好"}]
+        latencies = []
+        remaining = total
+
+        async def worker():
+            nonlocal remaining
+            while remaining > 0:
+                remaining -= 1
+                start = time.monotonic()
+                await endpoint.send_message(message)
+                latencies.append(time.monotonic() - start)
+
+        start = time.monotonic()
+        await asyncio.gather(*(worker() for _ in range(workers)))
+        elapsed = time.monotonic() - start
+        await endpoint.close()
+        stats = await self.stats()
+        return summarize(latencies, elapsed) | {"rate_accuracy": self.rate_accuracy(stats, rate),
+                                                "server_throttled": stats["throttled"]}
+
+    async def streaming(self) -> dict:
+        """两个服务商的流式请求，记录首块延迟"""
+        total = self.count(200)
+        await self.configure({"total": total}, latency=0.05, stream_chunks=8, chunk_interval=0.005)
+        endpoints = [await self.endpoint("openai", "stream-openai", max_calls_per_second=200),
+                     await self.endpoint("baidu", "stream-baidu", max_calls_per_second=200)]
+        message = [{"role": "user", "content": "你好"}]
+        latencies, first_chunks = [], []
+
+        async def call(endpoint: Endpoint):
+            start = time.monotonic()
+            first = None
+            async for _ in endpoint.stream_message(message):
+                first = first or time.monotonic() - start
+            first_chunks.append(first)
+            latencies.append(time.monotonic() - start)
+
+        start = time.monotonic()
+        await asyncio.gather(*(call(endpoints[i % 2]) for i in range(total)))
+        elapsed = time.monotonic() - start
+        await asyncio.gather(*(endpoint.close() for endpoint in endpoints))
+        return summarize(latencies, elapsed) | {"ttft_p50": percentile(first_chunks, 0.5),
+                                                "ttft_p95": percentile(first_chunks, 0.95)}
+
+    async def faults(self) -> dict:
+        """注入限流与服务端错误，通过Expert批量请求检查重试后的成功率"""
+        total = self.count(300)
+        await self.configure({"total": total, "retry_count": 3},
+                             latency=0.05, error_429_rate=0.02, error_5xx_rate=0.02, retry_after=0.1)
+        endpoint = await self.endpoint("openai", "faults", max_calls_per_second=200)
+        expert = Expert(endpoint, prompts={"echo": "请重复：{{text}}"})
+        succeeded = 0
+        params = ({"text": f"第{i}条"} for i in range(total))
+
+        start = time.monotonic()
+        async for result in expert.get_answers_batch(params, "echo", retry_count=3):
+            succeeded += result.error is None
+        elapsed = time.monotonic() - start
+        await endpoint.close()
+        stats = await self.stats()
+        return {"throughput": total / elapsed, "success_rate": succeeded / total,
+                "server_throttled": stats["throttled"], "server_errors": stats["errors"]}
+
+    async def sessions(self) -> dict:
+        """大量会话同时进行多轮对话，超出内存上限的会话被写入磁盘，记录内存峰值"""
+        users, turns = self.count(1000), 3
+        await self.configure({"users": users, "turns": turns, "max_sessions": 100, "max_context_tokens": 200},
+                             latency=0.02)
+        endpoint = await self.endpoint("baidu", "sessions", max_calls_per_second=1000)
+        path = os.path.join(os.path.dirname(BASELINE_PATH), ".benchmark_sessions.db")
+        if os.path.exists(path):
+            os.remove(path)
+        store = DialogueStore(endpoint, path, max_sessions=100, max_context_tokens=200)
+        latencies = []
+
+        async def user(session_id: str):
+            for turn in range(turns):
+                start = time.monotonic()
+                await store.send_message(session_id, f"第{turn}轮：你好")
+                latencies.append(time.monotonic() - start)
+
+        tracemalloc.start()
+        start = time.monotonic()
+        await asyncio.gather(*(user(f"user-{i}") for i in range(users)))
+        elapsed = time.monotonic() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        evictions = store.evictions
+        await store.close()
+        await endpoint.close()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+        return summarize(latencies, elapsed) | {"peak_memory_mb": peak / 2 ** 20, "evictions": evictions}
+
+    async def replay(self) -> dict:
+        """先通过record服务商录制一批请求，再以远高于真实服务的速率回放，不访问模拟服务"""
+        distinct, total = self.count(200), self.count(5000)
+        await self.configure({"distinct": distinct, "total": total}, latency=0.02)
+        path = os.path.join(os.path.dirname(BASELINE_PATH), ".benchmark_replay.jsonl")
+        if os.path.exists(path):
+            os.remove(path)
+        recorder = Endpoint(name="record", provider="record", record_provider="baidu", record_path=path,
+                            api_key="benchmark", secret_key="benchmark", api_base=self.base_url,
+                            max_calls_per_second=500)
+        messages = [[{"role": "user", "content": f"第{i}条"}] for i in range(distinct)]
+        await asyncio.gather(*(recorder.send_message(message) for message in messages))
+        await recorder.close()
+
+        endpoint = Endpoint(name="replay", provider="replay", record_path=path, max_calls_per_second=total,
+                            adaptive_rate=False)
+        latencies = []
+
+        async def call(message: list):
+            start = time.monotonic()
+            await endpoint.send_message(message)
+            latencies.append(time.monotonic() - start)
+
+        start = time.monotonic()
+        await asyncio.gather(*(call(messages[i % distinct]) for i in range(total)))
+        elapsed = time.monotonic() - start
+        misses = endpoint.get_status()["replay"]["misses"]
+        await endpoint.close()
+        os.remove(path)
+        return summarize(latencies, elapsed) | {"misses": misses}
+
+    async def packing(self) -> dict:
+        """请求数限流较低时，通过Expert合并大量短提示词，部分回答缺失时单独重发"""
+        rate, total = 20, self.count(1000)
+        await self.configure({"rate": rate, "total": total, "max_batch_size": 20, "window": 0.05},
+                             latency=0.2, pack_drop_rate=0.01)
+        endpoint = await self.endpoint("openai", "packing", max_calls_per_second=rate, adaptive_rate=False)
+        expert = Expert(endpoint, prompts={"classify": "判断情感倾向：{{text}}"},
+                        packing={"max_batch_size": 20, "window": 0.05})
+        succeeded = 0
+        params = ({"text": f"第{i}条评论"} for i in range(total))
+        start = time.monotonic()
+        async for result in expert.get_answers_batch(params, "classify", ordered=False):
+            succeeded += result.error is None
+        elapsed = time.monotonic() - start
+        await endpoint.close()
+        stats = await self.stats()
+        return {"throughput": total / elapsed, "success_rate": succeeded / total,
+                "provider_calls": stats["requests"], "fallbacks": expert.metrics.count("pack_fallbacks")}
+
+
+SCENARIOS = ("burst", "sustained", "streaming", "faults", "sessions", "replay", "packing")
+
+
+def merge_runs(runs: list) -> dict:
+    """
+    合并同一场景多次运行的结果，降低单次运行受机器负载影响产生的波动
+    吞吐类指标取最大值，延迟与内存类指标取最小值，其余指标取中位数
+    """
+    merged = {}
+    for name in runs[0]:
+        values = [run[name] for run in runs if run[name] is not None]
+        if not values:
+            merged[name] = None
+        elif name in HIGHER_IS_BETTER:
+            merged[name] = max(values)
+        elif name in LOWER_IS_BETTER:
+            merged[name] = min(values)
+        else:
+            merged[name] = sorted(values)[len(values) // 2]
+    return merged
+
+
+def comparable(result: dict, expected: dict) -> str | None:
+    """检查本次结果与基准是否在相同的条件下得到，不同时返回原因"""
+    for key in ("scale", "repeat", "params"):
+        if result[key] != expected.get(key):
+            return f"{key} {json.dumps(result[key], ensure_ascii=False)} != " \
+                   f"baseline {json.dumps(expected.get(key), ensure_ascii=False)}"
+    return None
+
+
+def check_regressions(results: dict, baseline: dict, tolerance: float, rate_tolerance: float) -> tuple:
+    """返回回归列表以及因条件不同而跳过比较的场景"""
+    failures, skipped = [], []
+    for scenario, result in results.items():
+        if scenario not in baseline:
+            skipped.append(f"{scenario}: not in baseline")
+            continue
+        reason = comparable(result, baseline[scenario])
+        if reason:
+            skipped.append(f"{scenario}: {reason}")
+            continue
+        expected = baseline[scenario]["metrics"]
+        for name, value in result["metrics"].items():
+            if value is None:
+                continue
+            if name == "rate_accuracy" and abs(value - 1) > rate_tolerance:
+                failures.append(f"{scenario}.{name}: {value:.3f} is off by more than {rate_tolerance:.0%}")
+            if expected.get(name) is None:
+                continue
+            if name in HIGHER_IS_BETTER and value < expected[name] * (1 - tolerance):
+                failures.append(f"{scenario}.{name}: {value:.4g} < baseline {expected[name]:.4g}")
+            elif name in LOWER_IS_BETTER and value > expected[name] * (1 + tolerance):
+                failures.append(f"{scenario}.{name}: {value:.4g} > baseline {expected[name]:.4g}")
+    return failures, skipped
+
+
+async def run(scenarios: list, scale: float, repeat: int) -> dict:
+    process, base_url = start_server()
+    bench = Bench(base_url, scale)
+    results = {}
+    try:
+        async with aiohttp.ClientSession() as bench.session:
+            for scenario in scenarios:
+                runs = [await getattr(bench, scenario)() for _ in range(repeat)]
+                results[scenario] = {"scale": scale, "repeat": repeat, "params": bench.params,
+                                     "metrics": merge_runs(runs)}
+                print(f"{scenario}: {json.dumps(results[scenario]['metrics'], ensure_ascii=False)}")
+    finally:
+        process.terminate()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="使用本地模拟服务对Endpoint、Dialogue、Expert进行离线压测")
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS, help="只运行指定的场景，可重复指定")
+    parser.add_argument("--scale", type=float, default=1.0, help="请求数量的缩放比例")
+    parser.add_argument("--repeat", type=int, default=3, help="每个场景的运行次数，取其中最好的结果")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="相对基准允许的性能下降比例")
+    parser.add_argument("--rate-tolerance", type=float, default=0.1, help="限流速率允许的相对误差")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="基准结果文件路径")
+    parser.add_argument("--update-baseline", action="store_true", help="将本次结果写入基准文件")
+    args = parser.parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+
+    results = asyncio.run(run(args.scenario or list(SCENARIOS), args.scale, args.repeat))
+    if args.update_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline, 'r', encoding='utf-8') as file:
+                baseline = json.load(file)
+        baseline.update(results)
+        with open(args.baseline, 'w', encoding='utf-8') as file:
+            json.dump(baseline, file, indent=2, ensure_ascii=False)
+        print(f"Baseline written to {args.baseline}")
+        return
+
+    if not os.path.exists(args.baseline):
+        print(f"Baseline {args.baseline} not found, run with --update-baseline first")
+        sys.exit(1)
+    with open(args.baseline, 'r', encoding='utf-8') as file:
+        baseline = json.load(file)
+    failures, skipped = check_regressions(results, baseline, args.tolerance, args.rate_tolerance)
+    for reason in skipped:
+        print(f"SKIPPED {reason}")
+    for failure in failures:
+        print(f"REGRESSION {failure}")
+    if failures:
+        sys.exit(1)
+    if len(skipped) == len(results):
+        # 没有任何场景能与基准比较时不能视为通过
+        print("No scenario matches the baseline, run with the same --scale/--repeat or --update-baseline")
+        sys.exit(1)
+    print("No regressions")
+
+
+if __name__ == '__main__':
+    main()
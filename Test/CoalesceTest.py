@@ -0,0 +1,47 @@
+import asyncio
+import time
+import unittest
+
+from AIHub import Endpoint
+from FakeServer import REPLY, start_server
+
+
+class CoalesceTimeoutTest(unittest.IsolatedAsyncioTestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.process, cls.base_url = start_server(latency=1.0, latency_distribution="fixed")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.process.terminate()
+
+    async def asyncSetUp(self):
+        self.endpoint = Endpoint(name="coalesce", provider="openai", api_key="sk-test", model="fake-model",
+                                 api_base=f"{self.base_url}/v1", coalesce=True)
+        await self.endpoint.start()
+        self.message = [{"role": "user", "content": "相同的问题"}]
+
+    async def asyncTearDown(self):
+        await self.endpoint.close()
+
+    async def test_follower_timeout_applies_to_follower(self):
+        leader = asyncio.create_task(self.endpoint.send_message(self.message))
+        await asyncio.sleep(0.05)
+        start = time.monotonic()
+        with self.assertRaises(asyncio.TimeoutError):
+            await self.endpoint.send_message(self.message, timeout=0.1)
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertEqual(await leader, REPLY)
+
+    async def test_leader_timeout_does_not_affect_follower(self):
+        leader = asyncio.create_task(self.endpoint.send_message(self.message, timeout=0.2))
+        await asyncio.sleep(0.05)
+        follower = asyncio.create_task(self.endpoint.send_message(self.message))
+        with self.assertRaises(asyncio.TimeoutError):
+            await leader
+        self.assertEqual(await follower, REPLY)
+        self.assertEqual(self.endpoint.single_flight.saved, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+import asyncio
+import faulthandler
+import os
+import tempfile
+import time
+import unittest
+
+from AIHub import Dialogue, DialogueStore
+from AIHub.DialogueStore import _measure
+
+
+class SlowEndpoint:
+    """只模拟延迟的Endpoint，不发出网络请求"""
+    name = "slow"
+
+    def __init__(self, latency: float = 0.02):
+        self.latency = latency
+
+    async def send_message(self, message, **kwargs):
+        await asyncio.sleep(self.latency)
+        return "ok"
+
+
+class DialogueStoreTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "sessions.db")
+        # 事件循环空转时asyncio的超时无法生效，由看门狗线程打印堆栈并退出
+        faulthandler.dump_traceback_later(120, exit=True)
+
+    def tearDown(self):
+        faulthandler.cancel_dump_traceback_later()
+        self.directory.cleanup()
+
+    async def test_load_while_persisting_under_eviction_pressure(self):
+        store = DialogueStore(SlowEndpoint(), self.path, max_sessions=100)
+        users, turns = 1000, 3
+
+        async def user(session_id: str):
+            for turn in range(turns):
+                await store.send_message(session_id, f"第{turn}轮")
+
+        await asyncio.gather(*(user(f"user-{i}") for i in range(users)))
+        self.assertGreater(store.evictions, 0)
+        for i in range(0, users, 97):
+            messages = await store.get_messages(f"user-{i}")
+            self.assertEqual([message["content"] for message in messages[::2]], [f"第{t}轮" for t in range(turns)])
+        await store.close()
+
+    async def test_eviction_does_not_wait_for_storage(self):
+        store = DialogueStore(SlowEndpoint(), self.path, max_sessions=1)
+        write = store.storage._write
+
+        def slow_write(*args):
+            time.sleep(0.2)
+            write(*args)
+
+        store.storage._write = slow_write
+        start = time.monotonic()
+        for i in range(5):
+            await store.send_message(f"user-{i}", "你好")
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertEqual(store.evictions, 4)
+        messages = await store.get_messages("user-0")
+        self.assertEqual([message["content"] for message in messages], ["你好", "ok"])
+        await store.close()
+
+    async def test_incremental_size_matches_full_measure(self):
+        store = DialogueStore(SlowEndpoint(latency=0), self.path, max_context_tokens=60)
+
+        def assert_sizes():
+            for session in store.sessions.values():
+                self.assertEqual(session.size, _measure(session.dialogue.iter_messages()))
+            self.assertEqual(store.total_bytes, sum(session.size for session in store.sessions.values()))
+
+        for turn in range(20):
+            # 较长的消息使滑动窗口裁剪较早的轮次，裁剪后重新计算全部消息
+            await store.send_message("a", f"第{turn}轮：" + "内容" * turn)
+            assert_sizes()
+        self.assertGreater(store.sessions["a"].dialogue.revision, 0)
+        await store.fork("a", "b")
+        for turn in range(3):
+            await store.send_message("b", f"分支第{turn}轮")
+            assert_sizes()
+        await store.close()
+
+    def test_iter_messages_from_start_across_forks(self):
+        dialogue = Dialogue(SlowEndpoint())
+        dialogue.messages = [{"role": "user", "content": str(i)} for i in range(3)]
+        forked = dialogue.fork()
+        forked._append({"role": "user", "content": "3"})
+        forked = forked.fork()
+        forked._append({"role": "user", "content": "4"})
+        for start in range(7):
+            self.assertEqual([message["content"] for message in forked.iter_messages(start)],
+                             [str(i) for i in range(start, 5)])
+
+
+if __name__ == '__main__':
+    unittest.main()
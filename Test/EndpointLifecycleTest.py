@@ -0,0 +1,83 @@
+import asyncio
+import unittest
+
+import aiohttp
+
+from AIHub import Endpoint
+from FakeServer import REPLY, start_server
+
+
+class EndpointLifecycleTest(unittest.IsolatedAsyncioTestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.process, cls.base_url = start_server(latency=0.01)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.process.terminate()
+
+    def create_endpoint(self, **kwargs) -> Endpoint:
+        return Endpoint(name="lifecycle", provider="openai", api_key="sk-test", model="fake-model",
+                        api_base=f"{self.base_url}/v1", **kwargs)
+
+    async def test_restart_after_close_keeps_concurrency(self):
+        endpoint = self.create_endpoint(max_concurrency=2)
+        message = [{"role": "user", "content": "你好"}]
+        for _ in range(4):
+            # close()取消空闲的worker，下一次发送时重新启动
+            self.assertEqual(await asyncio.wait_for(endpoint.send_message(message), 5), REPLY)
+            await endpoint.close()
+            self.assertEqual(endpoint.concurrency.active, 0)
+
+
+class ModuleLevelEndpointTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.process, cls.base_url = start_server(latency=0.01)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.process.terminate()
+
+    def test_reuse_across_event_loops(self):
+        # 模块级别的Endpoint在事件循环之外创建，之后被多次asyncio.run使用且从不关闭
+        endpoints = [
+            Endpoint(name="module-openai", provider="openai", api_key="sk-test", model="fake-model",
+                     api_base=f"{self.base_url}/v1", max_concurrency=2),
+            Endpoint(name="module-baidu", provider="baidu", api_key="test", secret_key="test",
+                     api_base=self.base_url, max_concurrency=2),
+        ]
+        message = [{"role": "user", "content": "你好"}]
+
+        async def run():
+            return await asyncio.wait_for(asyncio.gather(*(endpoint.send_message(message)
+                                                           for endpoint in endpoints for _ in range(3))), 5)
+
+        for _ in range(4):
+            self.assertEqual(asyncio.run(run()), [REPLY] * 6)
+
+
+class RetryOwnershipTest(unittest.IsolatedAsyncioTestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.process, cls.base_url = start_server(latency=0.01, error_429_rate=1.0, retry_after=0)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.process.terminate()
+
+    async def test_sdk_does_not_retry_behind_the_endpoint(self):
+        endpoint = Endpoint(name="throttled", provider="openai", api_key="sk-test", model="fake-model",
+                            api_base=f"{self.base_url}/v1")
+        with self.assertRaises(Exception):
+            await endpoint.send_message([{"role": "user", "content": "你好"}], 0)
+        await endpoint.close()
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f"{self.base_url}/stats") as response:
+                stats = await response.json()
+        self.assertEqual(stats["requests"], 1)
+        self.assertEqual(endpoint.adaptive.throttled_count, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
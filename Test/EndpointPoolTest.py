@@ -0,0 +1,40 @@
+import asyncio
+import unittest
+
+from AIHub import Endpoint, EndpointPool, Expert
+from FakeServer import REPLY, start_server
+
+
+class EndpointPoolTest(unittest.IsolatedAsyncioTestCase):
+    @classmethod
+    def setUpClass(cls):
+        # 20%的合并回答被替换为null，同时覆盖合并发送与单独重发两条路径
+        cls.process, cls.base_url = start_server(latency=0.01, pack_drop_rate=0.2)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.process.terminate()
+
+    def create_pool(self) -> EndpointPool:
+        return EndpointPool([Endpoint(name=f"pool-{i}", provider="openai", api_key="sk-test", model="fake-model",
+                                      api_base=f"{self.base_url}/v1", max_calls_per_second=50) for i in range(2)])
+
+    async def test_positional_retry_count(self):
+        pool = self.create_pool()
+        message = [{"role": "user", "content": "你好"}]
+        self.assertEqual(await pool.send_message(message, 2), REPLY)
+        self.assertEqual("".join([chunk async for chunk in pool.stream_message(message, 2)]), REPLY)
+        await pool.close()
+
+    async def test_expert_packing_over_pool(self):
+        pool = self.create_pool()
+        expert = Expert(pool, packing={"max_batch_size": 10, "window": 0.02})
+        answers = await asyncio.gather(*(expert.get_answer(f"第{i}个问题") for i in range(50)))
+        self.assertEqual(answers, [REPLY] * 50)
+        self.assertGreater(expert.metrics.count("packed_calls"), 0)
+        self.assertGreater(expert.metrics.count("packed_items"), 0)
+        await pool.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
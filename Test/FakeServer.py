@@ -0,0 +1,252 @@
+import asyncio
+import json
+import multiprocessing
+import random
+import time
+import uuid
+from collections import deque
+
+from aiohttp import web
+
+DEFAULT_CONFIG = {
+    "latency": 0.05,  # 平均响应延迟（秒）
+    "latency_distribution": "lognormal",  # fixed / uniform / lognormal
+    "latency_sigma": 0.5,  # lognormal分布的sigma；uniform分布在[0, 2 * latency]间均匀分布
+    "error_429_rate": 0.0,  # 随机返回限流错误的概率
+    "error_5xx_rate": 0.0,  # 随机返回服务端错误的概率
+    "retry_after": 0.1,  # 限流错误附带的Retry-After（秒）
+    "max_rps": None,  # 服务端限流：每秒最多处理的请求数，超过时返回限流错误
+    "stream_chunks": 8,  # 流式回复的分块数
+    "chunk_interval": 0.005,  # 流式回复每块之间的间隔（秒）
+    "completion_tokens": 32,  # 每个回复的token数
+    "token_expires_in": 2592000,  # 百度access token的有效期（秒）
+    "pack_drop_rate": 0.0,  # 回答合并请求时，每个回答被替换为null的概率
+}
+
+REPLY = "这是一个用于压力测试的回复。"
+# 请求指定response_format为json_object时的回复
+JSON_REPLY = json.dumps({"summary": "用于压力测试的回复", "items": [{"id": i, "text": f"第{i}项"} for i in range(8)],
+                         "done": True}, ensure_ascii=False)
+
+
+class FakeServer:
+    def __init__(self, **config):
+        """
+        本地模拟OpenAI与百度接口的服务，用于离线压测
+        支持OpenAI的/v1/chat/completions，百度的/oauth/2.0/token与completions_pro，均支持流式输出
+        可以通过POST /config修改延迟分布与错误注入，通过GET /stats读取服务端统计，通过POST /reset清空统计
+        """
+        self.config = {**DEFAULT_CONFIG, **config}
+        self.reset()
+        self.app = web.Application()
+        self.app.router.add_post("/v1/chat/completions", self.openai_completions)
+        self.app.router.add_post("/oauth/2.0/token", self.baidu_token)
+        self.app.router.add_post("/rpc/2.0/ai_custom/v1/wenxinworkshop/chat/completions_pro", self.baidu_completions)
+        self.app.router.add_post("/config", self.update_config)
+        self.app.router.add_post("/reset", self.reset_stats)
+        self.app.router.add_get("/stats", self.get_stats)
+
+    def reset(self):
+        self.arrivals = []
+        self.window = deque()
+        self.throttled = 0
+        self.errors = 0
+        self.token_requests = 0
+
+    def _latency(self) -> float:
+        latency, distribution = self.config["latency"], self.config["latency_distribution"]
+        if distribution == "fixed":
+            return latency
+        if distribution == "uniform":
+            return random.uniform(0, 2 * latency)
+        # 以latency为中位数的对数正态分布，模拟长尾延迟
+        return random.lognormvariate(0, self.config["latency_sigma"]) * latency
+
+    def _admit(self) -> str | None:
+        """记录一次请求，返回需要注入的错误类型"""
+        now = time.monotonic()
+        self.arrivals.append(now)
+        if max_rps := self.config["max_rps"]:
+            while self.window and self.window[0] <= now - 1:
+                self.window.popleft()
+            if len(self.window) >= max_rps:
+                self.throttled += 1
+                return "429"
+            self.window.append(now)
+        roll = random.random()
+        if roll < self.config["error_429_rate"]:
+            self.throttled += 1
+            return "429"
+        if roll < self.config["error_429_rate"] + self.config["error_5xx_rate"]:
+            self.errors += 1
+            return "5xx"
+        return None
+
+    def _usage(self, messages: list) -> dict:
+        prompt_tokens = sum(len(str(message.get("content", ""))) for message in messages)
+        completion_tokens = self.config["completion_tokens"]
+        return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens}
+
+    def _json_reply(self, messages: list) -> str:
+        # PromptPacker合并的请求以JSON数组结尾，按数组长度逐个回答
+        try:
+            prompts = json.loads(str(messages[-1].get("content", "")).rsplit("\n\n", 1)[-1])
+        except ValueError:
+            prompts = None
+        if not isinstance(prompts, list):
+            return JSON_REPLY
+        answers = [None if random.random() < self.config["pack_drop_rate"] else REPLY for _ in prompts]
+        return json.dumps({"answers": answers}, ensure_ascii=False)
+
+    def _chunks(self, reply: str = REPLY) -> list:
+        count = self.config["stream_chunks"]
+        size = max(1, len(reply) // count)
+        return [reply[i:i + size] for i in range(0, len(reply), size)]
+
+    async def openai_completions(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        error = self._admit()
+        await asyncio.sleep(self._latency())
+        if error == "429":
+            return web.json_response({"error": {"message": "Rate limit reached", "type": "requests"}}, status=429,
+                                     headers={"Retry-After": str(self.config["retry_after"])})
+        if error == "5xx":
+            return web.json_response({"error": {"message": "Server error", "type": "server_error"}}, status=500)
+
+        completion_id, created, model = f"chatcmpl-{uuid.uuid4().hex}", int(time.time()), body.get("model")
+        json_format = (body.get("response_format") or {}).get("type") == "json_object"
+        reply = self._json_reply(body["messages"]) if json_format else REPLY
+        if not body.get("stream"):
+            return web.json_response({
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": reply}, "finish_reason": "stop"}],
+                "usage": self._usage(body["messages"]),
+            })
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for chunk in [*self._chunks(reply), None]:
+            delta = {"content": chunk} if chunk is not None else {}
+            data = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": None if chunk else "stop"}]}
+            await response.write(f"data: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8"))
+            await asyncio.sleep(self.config["chunk_interval"])
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def baidu_token(self, request: web.Request) -> web.Response:
+        self.token_requests += 1
+        return web.json_response({"access_token": f"fake-{uuid.uuid4().hex}",
+                                  "expires_in": self.config["token_expires_in"]})
+
+    async def baidu_completions(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        error = self._admit()
+        await asyncio.sleep(self._latency())
+        # 百度的错误以HTTP 200和error_code返回
+        if error == "429":
+            return web.json_response({"error_code": 18, "error_msg": "Open api qps request limit reached"})
+        if error == "5xx":
+            return web.json_response({"error_code": 336100, "error_msg": "internal error"})
+
+        completion_id, created = f"as-{uuid.uuid4().hex[:10]}", int(time.time())
+        if not body.get("stream"):
+            return web.json_response({"id": completion_id, "object": "chat.completion", "created": created,
+                                      "result": REPLY, "is_truncated": False, "need_clear_history": False,
+                                      "usage": self._usage(body["messages"])})
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        chunks = self._chunks()
+        for i, chunk in enumerate(chunks):
+            data = {"id": completion_id, "object": "chat.completion", "created": created, "sentence_id": i,
+                    "is_end": i == len(chunks) - 1, "result": chunk}
+            if data["is_end"]:
+                data["usage"] = self._usage(body["messages"])
+            await response.write(f"data: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8"))
+            await asyncio.sleep(self.config["chunk_interval"])
+        await response.write_eof()
+        return response
+
+    async def update_config(self, request: web.Request) -> web.Response:
+        config = await request.json()
+        unknown = set(config) - set(DEFAULT_CONFIG)
+        if unknown:
+            return web.json_response({"error": f"Unknown config keys: {sorted(unknown)}"}, status=400)
+        self.config.update(config)
+        return web.json_response(self.config)
+
+    async def reset_stats(self, request: web.Request) -> web.Response:
+        self.reset()
+        return web.json_response({})
+
+    async def get_stats(self, request: web.Request) -> web.Response:
+        arrivals = self.arrivals
+        duration = arrivals[-1] - arrivals[0] if len(arrivals) > 1 else 0.0
+        # 任意1秒窗口内到达的最大请求数，用于检查客户端限流的准确性
+        peak, start = 0, 0
+        for end, arrival in enumerate(arrivals):
+            while arrival - arrivals[start] >= 1:
+                start += 1
+            peak = max(peak, end - start + 1)
+        # 跳过第1秒（初始突发以及建立连接的耗时）后的平均到达速率
+        steady = [arrival for arrival in arrivals if arrival >= arrivals[0] + 1] if arrivals else []
+        steady_duration = steady[-1] - steady[0] if len(steady) > 1 else 0.0
+        return web.json_response({
+            "requests": len(arrivals),
+            "duration": duration,
+            "rate": (len(arrivals) - 1) / duration if duration else 0.0,
+            "steady_rate": (len(steady) - 1) / steady_duration if steady_duration else 0.0,
+            "peak_rate": peak,
+            "throttled": self.throttled,
+            "errors": self.errors,
+            "token_requests": self.token_requests,
+        })
+
+
+def _serve(port: int, config: dict, ready):
+    random.seed(0)
+
+    async def main():
+        runner = web.AppRunner(FakeServer(**config).app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", port)
+        await site.start()
+        ready.send(site._server.sockets[0].getsockname()[1])
+        ready.close()
+        await asyncio.Event().wait()
+
+    asyncio.run(main())
+
+
+def start_server(port: int = 0, **config) -> tuple:
+    """
+    在独立的进程中启动FakeServer，避免服务端与被测客户端争用同一个事件循环
+    返回(进程, 基础URL)，使用完毕后调用process.terminate()
+    """
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=_serve, args=(port, config, sender), daemon=True)
+    process.start()
+    sender.close()
+    port = receiver.recv()
+    return process, f"http://127.0.0.1:{port}"
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="本地模拟OpenAI与百度接口的服务")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=DEFAULT_CONFIG["latency"])
+    parser.add_argument("--error-429-rate", type=float, default=0.0)
+    parser.add_argument("--error-5xx-rate", type=float, default=0.0)
+    parser.add_argument("--max-rps", type=int, default=None)
+    args = parser.parse_args()
+    web.run_app(FakeServer(latency=args.latency, error_429_rate=args.error_429_rate,
+                           error_5xx_rate=args.error_5xx_rate, max_rps=args.max_rps).app,
+                host="127.0.0.1", port=args.port)
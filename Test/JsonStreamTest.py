@@ -0,0 +1,49 @@
+import json
+import random
+import unittest
+
+from AIHub.JsonStream import IncrementalJSONParser
+
+
+class IncrementalJSONParserTest(unittest.TestCase):
+    DOCUMENTS = [
+        {"a": 1, "b": "x\\\"y\\\\", "c": [1, {"d": "}]\\n"}], "e": None, "f": True, "g": -1.5e3, "h": {}},
+        [1, "two", [3, [4]], {"k": "v\\\\"}, False, 0],
+        {"answers": ["第一", "第二\"", "三"]},
+        [],
+    ]
+
+    def feed_in_chunks(self, text: str, sizes) -> tuple:
+        parser = IncrementalJSONParser()
+        events = []
+        i = 0
+        for size in sizes:
+            events += parser.feed(text[i:i + size])
+            i += size
+            if i >= len(text):
+                break
+        return events, parser.close()
+
+    def test_random_chunk_boundaries(self):
+        rng = random.Random(0)
+        for document in self.DOCUMENTS:
+            text = f"```json\n{json.dumps(document, ensure_ascii=False, indent=2)}\n```"
+            for _ in range(200):
+                events, value = self.feed_in_chunks(text, iter(lambda: rng.randint(1, 6), None))
+                self.assertEqual(value, document)
+                self.assertEqual(len(events), len(document))
+
+    def test_escape_at_chunk_end(self):
+        parser = IncrementalJSONParser()
+        self.assertEqual(parser.feed('["a\\'), [])
+        self.assertEqual(parser.feed('"b", 1]'), [(0, 'a"b'), (1, 1)])
+        self.assertEqual(parser.close(), ['a"b', 1])
+
+    def test_long_value_across_many_chunks(self):
+        text = json.dumps({"text": "字" * 100000, "n": 1}, ensure_ascii=False)
+        events, value = self.feed_in_chunks(text, [3] * len(text))
+        self.assertEqual(events, [("text", "字" * 100000), ("n", 1)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -9,6 +9,7 @@ setup(
         'pyyaml'
         'aiohttp',
         'openai',
+        'httpx',
         'setuptools',
         'dynaconf'
     ],